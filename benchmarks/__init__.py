@@ -0,0 +1,11 @@
+"""
+maproxy benchmarks.
+
+Starts local backends (echo and sink servers, plain and SSL), a proxy process (tcp2tcp, tcp2ssl, ssl2tcp or
+ssl2ssl) in front of them, and generates load. The results are printed as JSON, so they can be saved and
+compared across releases:
+
+    python -m benchmarks.run --modes tcp2tcp,ssl2ssl --concurrency 50 --message-size 1024 --output results.json
+
+See benchmarks/run.py for all the options.
+"""
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Load generator of the benchmarks (asyncio clients).
+Each test runs "concurrency" clients for "duration" seconds and returns a dictionary of results.
+"""
+
+import asyncio
+import time
+
+
+
+def percentile(values,q):
+    """
+    The q-th percentile (0..1) of the values (None if there are no values)
+    """
+    if not values:
+        return None
+    values=sorted(values)
+    return values[min(len(values)-1,int(round(q*(len(values)-1))))]
+
+def _latency_ms(latencies):
+    return {"p50":_ms(percentile(latencies,0.5)),"p99":_ms(percentile(latencies,0.99))}
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds*1000,3)
+
+
+async def _open(port,ssl_context):
+    return await asyncio.open_connection("127.0.0.1",port,ssl=ssl_context)
+
+def _close(writer):
+    writer.transport.abort()
+
+
+async def connect_rate(port,ssl_context,concurrency,message_size,duration):
+    """
+    Each client connects, sends a message, waits for the echo and closes, again and again.
+    Returns the connections per second and the latency (connect + echo) percentiles
+    """
+    loop=asyncio.get_running_loop()
+    payload=b"x"*message_size
+    deadline=loop.time()+duration
+    latencies=[]
+    errors=[0]
+    async def client():
+        while loop.time() < deadline:
+            start=time.perf_counter()
+            try:
+                reader,writer=await _open(port,ssl_context)
+            except OSError:
+                errors[0]+=1
+                continue
+            try:
+                writer.write(payload)
+                await reader.readexactly(message_size)
+                latencies.append(time.perf_counter()-start)
+            except (OSError,asyncio.IncompleteReadError):
+                errors[0]+=1
+            finally:
+                _close(writer)
+    start=loop.time()
+    await asyncio.gather(*[client() for i in range(concurrency)])
+    elapsed=loop.time()-start
+    return {"connections_per_second":round(len(latencies)/elapsed,1),
+            "connect_latency_ms":_latency_ms(latencies),
+            "connect_errors":errors[0]}
+
+
+async def echo_latency(port,ssl_context,concurrency,message_size,duration):
+    """
+    Each client (a persistent connection) sends a message and waits for the echo, again and again.
+    Returns the round-trip latency percentiles
+    """
+    loop=asyncio.get_running_loop()
+    payload=b"x"*message_size
+    connections=[await _open(port,ssl_context) for i in range(concurrency)]
+    deadline=loop.time()+duration
+    latencies=[]
+    async def client(reader,writer):
+        while loop.time() < deadline:
+            start=time.perf_counter()
+            writer.write(payload)
+            await reader.readexactly(message_size)
+            latencies.append(time.perf_counter()-start)
+    try:
+        await asyncio.gather(*[client(reader,writer) for reader,writer in connections])
+    finally:
+        for reader,writer in connections:
+            _close(writer)
+    return {"echo_latency_ms":_latency_ms(latencies),
+            "echo_requests_per_second":round(len(latencies)/duration,1)}
+
+
+async def throughput(port,ssl_context,concurrency,message_size,duration,received):
+    """
+    Each client (a persistent connection) sends messages to the sink as fast as it can.
+    The sink counts the bytes that it got (received is a shared counter) , so the throughput is measured
+    after the proxy (and not in the clients' buffers)
+    """
+    loop=asyncio.get_running_loop()
+    payload=b"x"*max(message_size,1)
+    connections=[await _open(port,ssl_context) for i in range(concurrency)]
+    stop=[False]
+    async def client(writer):
+        while not stop[0]:
+            writer.write(payload)
+            await writer.drain()
+            # drain() does not yield while the transport is not paused
+            await asyncio.sleep(0)
+    tasks=[asyncio.ensure_future(client(writer)) for reader,writer in connections]
+    # Warm-up , then measure
+    await asyncio.sleep(min(1.0,duration/5.0))
+    start_bytes,start=received.value,time.perf_counter()
+    await asyncio.sleep(duration)
+    total,elapsed=received.value-start_bytes,time.perf_counter()-start
+    stop[0]=True
+    for reader,writer in connections:
+        _close(writer)
+    await asyncio.gather(*tasks,return_exceptions=True)
+    return {"throughput_mb_per_second":round(total/elapsed/1e6,3)}
+
+
+def rss(pid):
+    """
+    Resident set size (bytes) of the process (Linux only, None if unknown)
+    """
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])*1024
+    except (IOError,OSError,ValueError):
+        pass
+    return None
+
+
+async def memory(port,ssl_context,concurrency,message_size,proxy_pid):
+    """
+    Open "concurrency" sessions (each one echoes a message, so both sides of the session are connected) , and
+    measure the proxy's RSS before and after. Returns the RSS per connection (bytes)
+    """
+    payload=b"x"*max(message_size,1)
+    await asyncio.sleep(0.2)
+    before=rss(proxy_pid)
+    connections=[]
+    try:
+        for i in range(concurrency):
+            reader,writer=await _open(port,ssl_context)
+            connections.append((reader,writer))
+            writer.write(payload)
+            await reader.readexactly(len(payload))
+        await asyncio.sleep(0.5)
+        after=rss(proxy_pid)
+    finally:
+        for reader,writer in connections:
+            _close(writer)
+    if before is None or after is None:
+        return {"rss_per_connection_bytes":None}
+    return {"rss_per_connection_bytes":int((after-before)/concurrency),"proxy_rss_bytes":after}
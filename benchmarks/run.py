@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Run the benchmarks and print the results (JSON).
+
+    python -m benchmarks.run [--modes tcp2tcp,tcp2ssl,ssl2tcp,ssl2ssl] [--tests memory,connect,echo,throughput]
+                             [--concurrency 50] [--message-size 1024] [--duration 5]
+                             [--engine tornado|asyncio|splice] [--uvloop] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import multiprocessing.sharedctypes
+import platform
+import ssl
+import time
+import tornado
+import benchmarks.servers
+import benchmarks.loadgen
+
+
+
+TESTS=("memory","connect","echo","throughput")
+
+def parse_args(argv=None):
+    parser=argparse.ArgumentParser(description="maproxy benchmarks")
+    parser.add_argument("--modes",default=",".join(benchmarks.servers.MODES),
+                        help="comma separated list of: %s" % ",".join(benchmarks.servers.MODES))
+    parser.add_argument("--tests",default=",".join(TESTS),help="comma separated list of: %s" % ",".join(TESTS))
+    parser.add_argument("--concurrency",type=int,default=50,help="number of concurrent clients")
+    parser.add_argument("--message-size",type=int,default=1024,help="size (bytes) of each message")
+    parser.add_argument("--duration",type=float,default=5.0,help="duration (seconds) of each test")
+    parser.add_argument("--engine",choices=("tornado","asyncio","splice"),default="tornado",
+                        help="the proxy's engine (default: tornado)")
+    parser.add_argument("--uvloop",action="store_true",help="run the asyncio engine on uvloop")
+    parser.add_argument("--output",default=None,help="write the JSON to this file (default: stdout)")
+    args=parser.parse_args(argv)
+    args.modes=args.modes.split(",")
+    args.tests=args.tests.split(",")
+    for mode in args.modes:
+        if mode not in benchmarks.servers.MODES:
+            parser.error("unknown mode: %s" % mode)
+    for test in args.tests:
+        if test not in TESTS:
+            parser.error("unknown test: %s" % test)
+    return args
+
+
+def _start_process(context,target,*args):
+    """
+    Start a process that sends its ports (a dictionary) when it's ready. Returns (process,ports)
+    """
+    parent_conn,child_conn=context.Pipe()
+    process=context.Process(target=target,args=(child_conn,)+args)
+    process.daemon=True
+    process.start()
+    if not parent_conn.poll(30):
+        process.terminate()
+        raise RuntimeError("%s did not start" % target.__name__)
+    return process,parent_conn.recv()
+
+
+async def run_mode(args,mode,proxy_pid,proxy_ports,received):
+    client_ssl,server_ssl=benchmarks.servers.MODES[mode]
+    ssl_context=None
+    if client_ssl:
+        ssl_context=ssl.create_default_context()
+        ssl_context.check_hostname=False
+        ssl_context.verify_mode=ssl.CERT_NONE
+    result={"mode":mode}
+    # The memory test runs first , while the proxy process is "fresh"
+    if "memory" in args.tests:
+        result.update(await benchmarks.loadgen.memory(proxy_ports["echo"],ssl_context,args.concurrency,
+                                                      args.message_size,proxy_pid))
+    if "connect" in args.tests:
+        result.update(await benchmarks.loadgen.connect_rate(proxy_ports["echo"],ssl_context,args.concurrency,
+                                                            args.message_size,args.duration))
+    if "echo" in args.tests:
+        result.update(await benchmarks.loadgen.echo_latency(proxy_ports["echo"],ssl_context,args.concurrency,
+                                                            args.message_size,args.duration))
+    if "throughput" in args.tests:
+        result.update(await benchmarks.loadgen.throughput(proxy_ports["sink"],ssl_context,args.concurrency,
+                                                          args.message_size,args.duration,received))
+    return result
+
+
+def run(args):
+    # Clean processes (not forked from a process that already has an event-loop)
+    context=multiprocessing.get_context("spawn")
+    received=multiprocessing.sharedctypes.RawValue("q",0)
+    backends,backend_ports=_start_process(context,benchmarks.servers.run_backends,received)
+    results=[]
+    try:
+        for mode in args.modes:
+            # A new proxy process for each mode (so the memory measurements are not affected by the previous mode)
+            proxy,proxy_ports=_start_process(context,benchmarks.servers.run_proxy,mode,args.engine,backend_ports,
+                                             args.uvloop)
+            try:
+                results.append(asyncio.run(run_mode(args,mode,proxy.pid,proxy_ports,received)))
+            finally:
+                proxy.terminate()
+                proxy.join()
+    finally:
+        backends.terminate()
+        backends.join()
+    return {"benchmark":"maproxy",
+            "time":time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime()),
+            "python":platform.python_version(),
+            "tornado":tornado.version,
+            "platform":platform.platform(),
+            "engine":args.engine+("+uvloop" if args.uvloop else ""),
+            "concurrency":args.concurrency,
+            "message_size":args.message_size,
+            "duration":args.duration,
+            "results":results}
+
+
+def main(argv=None):
+    args=parse_args(argv)
+    report=json.dumps(run(args),indent=2,sort_keys=True)
+    if args.output:
+        with open(args.output,"w") as f:
+            f.write(report+"\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
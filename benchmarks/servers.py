@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Local backends (echo and sink servers) and the proxy process of the benchmarks.
+Each one runs in its own process (with its own IOLoop) , so the load-generator does not share the CPU (or the
+memory) with the proxy.
+"""
+
+import os
+import collections
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
+
+
+
+DEMOS_DIR=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"demos")
+SSL_OPTIONS={"certfile":os.path.join(DEMOS_DIR,"certificate.pem"),
+             "keyfile":os.path.join(DEMOS_DIR,"privatekey.pem")}
+
+# The modes: (client->proxy is SSL , proxy->server is SSL)
+MODES=collections.OrderedDict([("tcp2tcp",(False,False)),
+                               ("tcp2ssl",(False,True)),
+                               ("ssl2tcp",(True,False)),
+                               ("ssl2ssl",(True,True))])
+
+
+class EchoServer(tornado.tcpserver.TCPServer):
+    """
+    Sends back everything that it reads
+    """
+    def handle_stream(self,stream,address):
+        stream.set_nodelay(True)
+        def on_read(data):
+            stream.write(data)
+            read()
+        def read():
+            try:
+                stream.read_bytes(stream.read_chunk_size,on_read,partial=True)
+            except tornado.iostream.StreamClosedError:
+                pass
+        read()
+
+
+class SinkServer(tornado.tcpserver.TCPServer):
+    """
+    Reads (and drops) everything. The total number of bytes is kept in a shared counter (multiprocessing.RawValue)
+    so the benchmark (another process) can measure the throughput
+    """
+    def __init__(self,received,*args,**kwargs):
+        super(SinkServer,self).__init__(*args,**kwargs)
+        self.received=received
+
+    def handle_stream(self,stream,address):
+        received=self.received
+        def on_read(data):
+            received.value+=len(data)
+            read()
+        def read():
+            try:
+                stream.read_bytes(stream.read_chunk_size,on_read,partial=True)
+            except tornado.iostream.StreamClosedError:
+                pass
+        read()
+
+
+def _listen(server):
+    server.listen(0,"127.0.0.1")
+    return list(server._sockets.values())[0].getsockname()[1]
+
+def run_backends(conn,received):
+    """
+    Process entry-point: run the echo and sink servers (plain and SSL) , and send their ports to the parent:
+    {"echo":port,"echo_ssl":port,"sink":port,"sink_ssl":port}
+    """
+    ioloop=tornado.ioloop.IOLoop()
+    ioloop.make_current()
+    ports={"echo":_listen(EchoServer()),
+           "echo_ssl":_listen(EchoServer(ssl_options=SSL_OPTIONS)),
+           "sink":_listen(SinkServer(received)),
+           "sink_ssl":_listen(SinkServer(received,ssl_options=SSL_OPTIONS))}
+    conn.send(ports)
+    ioloop.start()
+
+def run_proxy(conn,mode,engine,backend_ports,use_uvloop=False):
+    """
+    Process entry-point: run two proxies (to the echo server and to the sink server) in the given mode and engine
+    ("tornado","asyncio" or "splice") , and send their ports to the parent: {"echo":port,"sink":port}
+    """
+    import maproxy.iomanager
+    import maproxy.proxyserver
+    client_ssl,server_ssl=MODES[mode]
+    proxy_class=maproxy.proxyserver.ProxyServer
+    kwargs={"client_ssl_options":SSL_OPTIONS if client_ssl else None,
+            "server_ssl_options":True if server_ssl else None}
+    if engine == "asyncio":
+        import maproxy.aioengine
+        if use_uvloop:
+            maproxy.aioengine.install_uvloop()
+        proxy_class=maproxy.aioengine.AioProxyServer
+    elif engine == "splice":
+        import maproxy.splicesession
+        kwargs["session_factory"]=maproxy.splicesession.SpliceSessionFactory()
+
+    iomanager=maproxy.iomanager.IOManager()
+    ports={}
+    for name in ("echo","sink"):
+        server=proxy_class("127.0.0.1",backend_ports[name+"_ssl" if server_ssl else name],**kwargs)
+        ports[name]=_listen(server)
+        iomanager.add(server)
+    conn.send(ports)
+    iomanager.start(thread=False)
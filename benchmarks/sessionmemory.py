@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Memory of idle sessions: the bytes per session of the different Session layouts (JSON).
+
+    python -m benchmarks.sessionmemory [--sessions 2000] [--output results.json]
+
+Each variant runs a TCP proxy (to the local echo server) in its own process, that traces its memory allocations
+(tracemalloc). The clients open "sessions" connections (and wait for an echo, so both sides of each session are
+connected) and the proxy reports the memory that was allocated since they started to connect:
+    - bytes_per_session         : everything (the session, its streams and sockets, the IOLoop's handlers,...)
+    - session_bytes_per_session : the allocations of maproxy's code (the session object, its buffers,...)
+The variants:
+    - dict   : a Session subclass with a __dict__ (the layout before the __slots__)
+    - slots  : Session (__slots__)
+    - pooled : Session (__slots__) and a SessionFactory with a pool
+Before the measurement, the clients open and close "sessions" connections (a warm-up), so the pooled variant
+reuses the sessions of the warm-up.
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import multiprocessing.sharedctypes
+import os
+import platform
+import socket
+import time
+import tracemalloc
+import tornado
+import tornado.ioloop
+import maproxy.proxyserver
+import maproxy.session
+import benchmarks.servers
+
+
+
+VARIANTS=("dict","slots","pooled")
+
+MAPROXY_DIR=os.path.dirname(os.path.abspath(maproxy.session.__file__))
+
+
+class DictSession(maproxy.session.Session):
+    """
+    Session with a __dict__ (a subclass without __slots__)
+    """
+
+
+class DictSessionFactory(maproxy.session.SessionFactory):
+    session_class=DictSession
+
+
+def _session_factory(variant,sessions):
+    if variant == "dict":
+        return DictSessionFactory()
+    if variant == "pooled":
+        return maproxy.session.SessionFactory(pool_size=sessions)
+    return maproxy.session.SessionFactory()
+
+
+def run_proxy(conn,variant,backend_port,sessions):
+    """
+    Process entry-point: run the proxy (to the echo server) , send its port to the parent, and answer the
+    parent's commands:
+        "count"   : the number of open sessions
+        "start"   : take the "before" snapshot
+        "measure" : take the "after" snapshot, and send the results
+    """
+    ioloop=tornado.ioloop.IOLoop()
+    ioloop.make_current()
+    factory=_session_factory(variant,sessions)
+    server=maproxy.proxyserver.ProxyServer("127.0.0.1",backend_port,session_factory=factory)
+    port=benchmarks.servers._listen(server)
+    tracemalloc.start()
+    snapshots={}
+
+    def on_command(fd,events):
+        command=conn.recv()
+        if command == "count":
+            conn.send(server.get_connections_count())
+            return
+        gc.collect()
+        snapshots[command]=tracemalloc.take_snapshot()
+        if command == "start":
+            conn.send(None)
+            return
+        stats=snapshots["measure"].compare_to(snapshots["start"],"filename")
+        total=sum(stat.size_diff for stat in stats)
+        session_total=sum(stat.size_diff for stat in stats
+                          if stat.traceback[0].filename.startswith(MAPROXY_DIR))
+        count=server.get_connections_count()
+        conn.send({"variant":variant,
+                   "sessions":count,
+                   "bytes_per_session":int(total/count) if count else None,
+                   "session_bytes_per_session":int(session_total/count) if count else None,
+                   "reused_sessions":factory.reused})
+
+    ioloop.add_handler(conn.fileno(),on_command,tornado.ioloop.IOLoop.READ)
+    conn.send(port)
+    ioloop.start()
+
+
+def _request(conn,command):
+    conn.send(command)
+    return conn.recv()
+
+def _open_sessions(port,sessions):
+    """
+    Open the connections (each one gets an echo , so both sides of its session are connected)
+    """
+    clients=[]
+    for i in range(sessions):
+        client=socket.create_connection(("127.0.0.1",port))
+        client.sendall(b"x")
+        client.recv(1)
+        clients.append(client)
+    return clients
+
+def _close_sessions(conn,clients):
+    for client in clients:
+        client.close()
+    deadline=time.time()+30
+    while _request(conn,"count") and time.time() < deadline:
+        time.sleep(0.05)
+    # Let the factory recycle the removed sessions (on the next IOLoop iteration)
+    time.sleep(0.1)
+
+
+def measure(context,variant,backend_port,sessions):
+    parent_conn,child_conn=context.Pipe()
+    process=context.Process(target=run_proxy,args=(child_conn,variant,backend_port,sessions))
+    process.daemon=True
+    process.start()
+    try:
+        if not parent_conn.poll(30):
+            raise RuntimeError("the proxy did not start")
+        port=parent_conn.recv()
+        # Warm-up
+        _close_sessions(parent_conn,_open_sessions(port,sessions))
+        _request(parent_conn,"start")
+        clients=_open_sessions(port,sessions)
+        try:
+            time.sleep(0.2)
+            return _request(parent_conn,"measure")
+        finally:
+            _close_sessions(parent_conn,clients)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="maproxy: memory per idle session")
+    parser.add_argument("--sessions",type=int,default=2000,help="number of idle sessions")
+    parser.add_argument("--variants",default=",".join(VARIANTS),help="comma separated list of: %s" % ",".join(VARIANTS))
+    parser.add_argument("--output",default=None,help="write the JSON to this file (default: stdout)")
+    args=parser.parse_args(argv)
+    variants=args.variants.split(",")
+    for variant in variants:
+        if variant not in VARIANTS:
+            parser.error("unknown variant: %s" % variant)
+
+    context=multiprocessing.get_context("spawn")
+    received=multiprocessing.sharedctypes.RawValue("q",0)
+    parent_conn,child_conn=context.Pipe()
+    backends=context.Process(target=benchmarks.servers.run_backends,args=(child_conn,received))
+    backends.daemon=True
+    backends.start()
+    try:
+        backend_port=parent_conn.recv()["echo"]
+        results=[measure(context,variant,backend_port,args.sessions) for variant in variants]
+    finally:
+        backends.terminate()
+        backends.join()
+    report=json.dumps({"benchmark":"maproxy-session-memory",
+                       "time":time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime()),
+                       "python":platform.python_version(),
+                       "tornado":tornado.version,
+                       "sessions":args.sessions,
+                       "results":results},indent=2,sort_keys=True)
+    if args.output:
+        with open(args.output,"w") as f:
+            f.write(report+"\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
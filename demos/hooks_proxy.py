@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+# hooks_proxy.py: Demonstrates the proxy's event hooks (maproxy.hooks) .
+#                 Instead of inheriting the Session class (see logging_proxy.py), we register callbacks for the
+#                 events that we need (new session, connected, data, closed) . The callbacks can be added and
+#                 removed at any time, and a proxy without callbacks doesn't pay for them.
+
+
+import string
+import tornado.ioloop
+import maproxy.proxyserver
+import maproxy.hooks
+
+
+def on_session_open(session):
+    print("#%-3d: New Connection on %s" % (session.session_id,session.c2p_address))
+
+def on_connect(session):
+    print("#%-3d: Server connected (%s)" % (session.session_id,session.backend))
+
+def on_data(session,direction,data):
+    # data is a memoryview (valid only during the call) . Print just the printable characters
+    arrow="C->S" if direction == maproxy.hooks.C2S else "C<-S"
+    text="".join(chr(c) for c in data.tobytes() if chr(c) in string.printable)
+    print("#%-3d:%s (%d bytes):\n%s" % (session.session_id,arrow,len(data),text))
+
+def on_close(session):
+    print("#%-3d: Closed" % (session.session_id))
+
+
+# HTTP->HTTP
+# On your computer, browse to "http://127.0.0.1:81/" and you'll get http://www.google.com
+server = maproxy.proxyserver.ProxyServer("www.google.com",80)
+server.hooks.add("on_session_open",on_session_open)
+server.hooks.add("on_connect",on_connect)
+server.hooks.add("on_data",on_data)
+server.hooks.add("on_close",on_close)
+server.listen(81)
+print("http://127.0.0.1:81 -> http://www.google.com")
+tornado.ioloop.IOLoop.instance().start()
@@ -3,6 +3,8 @@
 # logging_proxy.py: Demonstrates how to inherit the Session class so that we can easily get notifications of I/O events .
 #                   The idea - by overriding 6 simple function, we get all the I/O events we need in order to fully monitor
 #                   the connection (new connnection,got-data, close-connection)
+#                   NOTE: print() blocks the proxy (the IOLoop) until the terminal gets the data. To capture the
+#                         traffic of a busy proxy, see maproxy.capture (a background thread writes the files)
 
 
 import tornado.ioloop
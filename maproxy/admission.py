@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+import time
+import socket
+import struct
+import logging
+import collections
+import tornado.ioloop
+
+
+
+class AdmissionController(object):
+    """
+    Admission control of a ProxyServer's new connections (checked before the session connects to the server):
+    - max_sessions            : maximum number of concurrent sessions of the proxy
+    - max_sessions_per_client : maximum number of concurrent sessions per client IP
+    - rate , burst            : token-bucket per source prefix (the client IP's first prefix_length bits):
+                                "rate" new connections per second, up to "burst" at once
+    When a connection is over a limit, it is rejected (closed with a RST). With action="queue", a connection that
+    is only over max_sessions is queued instead: the queued connections are admitted (in order) as soon as the proxy
+    has room, or rejected after queue_timeout seconds. While connections are queued, the new connections are queued
+    behind them. The per-client and rate limits always reject (a client can't fill the queue of the others: its
+    queued connections count in its max_sessions_per_client) . The queued connections whose clients gave up (closed
+    the connection) are dropped on every check of the queue, and before they would be admitted
+    The checks of a new connection are O(1) (the SessionTable counts the sessions per client , and the buckets
+    are a bounded LRU of max_prefixes prefixes)
+    """
+    REASONS=("max_sessions","max_sessions_per_client","rate","queue_full","queue_timeout")
+
+    def __init__(self,max_sessions=None,max_sessions_per_client=None,rate=None,burst=None,
+                 prefix_length=24,prefix_length6=64,max_prefixes=65536,
+                 action="reject",max_queue=1024,queue_timeout=10,check_interval=0.1):
+        """
+        Input Parameters:
+            max_sessions            : maximum number of concurrent sessions (None: no limit)
+            max_sessions_per_client : maximum number of concurrent sessions per client IP (None: no limit)
+            rate                    : new connections per second per source prefix (None: no limit)
+            burst                   : the bucket's size (default: rate)
+            prefix_length           : the IPv4 source prefix (bits) of the rate limit (32: per IP)
+            prefix_length6          : the IPv6 source prefix (bits) of the rate limit
+            max_prefixes            : maximum number of buckets (the least recently used bucket is dropped)
+            action                  : "reject" (close the connection with a RST) or "queue"
+            max_queue               : maximum number of queued connections (the others are rejected)
+            queue_timeout           : reject the connections that are queued for more than queue_timeout seconds
+            check_interval          : how often (seconds) we check the queue (besides when a session is closed)
+        """
+        assert action in ("reject","queue") , "action must be reject or queue"
+        self.max_sessions=max_sessions
+        self.max_sessions_per_client=max_sessions_per_client
+        self.rate=rate
+        self.burst=burst if burst is not None else rate
+        self.prefix_length=prefix_length
+        self.prefix_length6=prefix_length6
+        self.max_prefixes=max_prefixes
+        self.action=action
+        self.max_queue=max_queue
+        self.queue_timeout=queue_timeout
+        self.check_interval=check_interval
+        self.proxy=None
+        self.rejected=dict((reason,0) for reason in AdmissionController.REASONS)
+        self.queued=0
+        self.abandoned=0                            # Queued connections that the clients closed
+        self._buckets=collections.OrderedDict()    # prefix->[tokens,time]
+        self._queue=collections.deque()             # (stream,address,time)
+        self._queued_by_client={}                   # client's host->number of queued connections
+        self._timeout=None
+        self._process_callback_pending=False
+
+    def attach(self,proxy):
+        """
+        Called by the ProxyServer (every proxy needs its own AdmissionController)
+        """
+        assert self.proxy is None , "The AdmissionController is already attached to a proxy"
+        self.proxy=proxy
+
+    def stop(self):
+        """
+        Stop the queue's timer and close the queued connections
+        """
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout=None
+        while self._queue:
+            stream,address,queued_time=self._dequeue()
+            self._reject(stream,"queue_timeout")
+
+    def queue_length(self):
+        return len(self._queue)
+
+    ###############
+    ## Admission ##
+    ###############
+    def admit(self,stream,address):
+        """
+        Called by the ProxyServer for every new connection. Returns True if the session can start now.
+        Otherwise the connection is rejected or queued (the proxy's start_session is called when it's admitted)
+        """
+        if self._queue and not self._is_full():
+            # A session was closed , the queued connections go first
+            self._process_queue()
+        host=address[0] if isinstance(address,tuple) else address
+        reason=self._check_client(host)
+        if reason is None:
+            if not self._queue and not self._is_full():
+                return True
+            if self.action == "queue":
+                if len(self._queue) < self.max_queue:
+                    self._queue.append((stream,address,time.time()))
+                    self._queued_by_client[host]=self._queued_by_client.get(host,0)+1
+                    self.queued+=1
+                    self.proxy.metrics.sessions_queued+=1
+                    self._schedule()
+                    return False
+                reason="queue_full"
+            else:
+                reason="max_sessions"
+        self._reject(stream,reason)
+        return False
+
+    def _is_full(self):
+        return self.max_sessions is not None and len(self.proxy.sessions) >= self.max_sessions
+
+    def _check_client(self,host):
+        """
+        The reason that the client can't open a session (None if it can , as far as its own limits go)
+        """
+        if self.max_sessions_per_client is not None:
+            count=self.proxy.sessions.count_by_client(host)
+            if count+self._queued_by_client.get(host,0) >= self.max_sessions_per_client:
+                # Its queued connections may be gone (e.g. it reconnects after giving up)
+                self._drop_closed()
+                if count+self._queued_by_client.get(host,0) >= self.max_sessions_per_client:
+                    return "max_sessions_per_client"
+        if self.rate is not None and not self._take_token(host):
+            return "rate"
+        return None
+
+    def _reject(self,stream,reason):
+        self.rejected[reason]+=1
+        self.proxy.metrics.sessions_rejected+=1
+        reset_stream(stream)
+
+    ##################
+    ## Token-Bucket ##
+    ##################
+    def _take_token(self,host):
+        key=self.prefix(host)
+        now=time.time()
+        buckets=self._buckets
+        bucket=buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_prefixes:
+                buckets.popitem(last=False)
+            bucket=buckets[key]=[self.burst,now]
+        else:
+            buckets.move_to_end(key)
+            bucket[0]=min(self.burst,bucket[0]+(now-bucket[1])*self.rate)
+            bucket[1]=now
+        if bucket[0] < 1:
+            return False
+        bucket[0]-=1
+        return True
+
+    def prefix(self,host):
+        """
+        The source prefix of the client's host (the host itself if it's not an IP address)
+        """
+        try:
+            if ":" in host:
+                high,low=struct.unpack("!QQ",socket.inet_pton(socket.AF_INET6,host))
+                return (6,((high << 64) | low) >> (128-self.prefix_length6))
+            return (4,struct.unpack("!I",socket.inet_aton(host))[0] >> (32-self.prefix_length))
+        except (TypeError,ValueError,OSError,socket.error):
+            return host
+
+    ###########
+    ## Queue ##
+    ###########
+    def session_closed(self):
+        """
+        Called by the ProxyServer when a session is removed: maybe a queued connection can start
+        (on the next IOLoop iteration, not in the middle of the closed session's callbacks)
+        """
+        if self._queue and not self._process_callback_pending:
+            self._process_callback_pending=True
+            tornado.ioloop.IOLoop.current().add_callback(self._process_queue)
+
+    def _schedule(self):
+        if self._timeout is None:
+            self._timeout=tornado.ioloop.IOLoop.current().add_timeout(time.time()+self.check_interval,
+                                                                       self._on_timer)
+
+    def _on_timer(self):
+        self._timeout=None
+        self._drop_closed()
+        self._process_queue()
+
+    def _drop_closed(self):
+        """
+        Remove the queued connections that the clients closed
+        """
+        queue=self._queue
+        for i in range(len(queue)):
+            entry=queue.popleft()
+            if peer_closed(entry[0]):
+                self._abandon(entry)
+            else:
+                queue.append(entry)
+
+    def _abandon(self,entry):
+        stream,address,queued_time=entry
+        self._queue_removed(address)
+        self.abandoned+=1
+        stream.close()
+
+    def _process_queue(self):
+        """
+        Admit the queued connections (in order) while the proxy has room, and reject the ones that waited too long
+        (the per-client and rate limits were checked when they were queued)
+        """
+        self._process_callback_pending=False
+        queue=self._queue
+        deadline=time.time()-self.queue_timeout
+        while queue:
+            if queue[0][2] >= deadline and self._is_full():
+                break
+            stream,address,queued_time=self._dequeue()
+            if peer_closed(stream):
+                self.abandoned+=1
+                stream.close()
+                continue
+            if queued_time < deadline:
+                self._reject(stream,"queue_timeout")
+                continue
+            try:
+                self.proxy.start_session(stream,address)
+            except Exception:
+                logging.exception("maproxy: could not start a queued session")
+        if queue:
+            self._schedule()
+
+    def _dequeue(self):
+        stream,address,queued_time=self._queue.popleft()
+        self._queue_removed(address)
+        return stream,address,queued_time
+
+    def _queue_removed(self,address):
+        host=address[0] if isinstance(address,tuple) else address
+        count=self._queued_by_client[host]-1
+        if count:
+            self._queued_by_client[host]=count
+        else:
+            del self._queued_by_client[host]
+
+
+def peer_closed(stream):
+    """
+    Whether the client of a stream that we don't read from (e.g. a queued connection) closed (or reset) the
+    connection: the stream is closed , or its socket is readable with no data (peek , nothing is consumed)
+    """
+    if stream.closed():
+        return True
+    try:
+        sock=getattr(stream,"socket",None)
+        if sock is None:
+            sock=stream.transport.get_extra_info("socket")
+        fd=sock.fileno()
+    except (AttributeError,OSError,socket.error):
+        return False
+    if fd < 0:
+        return True
+    # A plain socket object on the same fd (an SSL socket doesn't peek , and we want the TCP state anyway)
+    peek=socket.socket(fileno=fd)
+    try:
+        return peek.recv(1,socket.MSG_PEEK|getattr(socket,"MSG_DONTWAIT",0)) == b""
+    except (BlockingIOError,InterruptedError):
+        return False
+    except (OSError,socket.error):
+        return True
+    finally:
+        peek.detach()
+
+
+def reset_on_close(stream):
+    """
+    Make the stream (Tornado's IOStream , the asyncio engine's AioStream or a socket) send a RST when it's closed
+    (SO_LINGER with a zero timeout) . A tunnel's stream (maproxy.tunnel.TunnelStream) sends a RESET frame
+    """
+    if hasattr(stream,"set_reset_on_close"):
+        stream.set_reset_on_close()
+        return
+    try:
+        sock=stream if isinstance(stream,socket.socket) else getattr(stream,"socket",None)
+        if sock is None:
+            sock=stream.transport.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_LINGER,struct.pack("ii",1,0))
+    except (AttributeError,OSError,socket.error):
+        pass
+
+
+def reset_stream(stream):
+    """
+    Close the stream (Tornado's IOStream , the asyncio engine's AioStream or a TunnelStream) with a RST
+    """
+    reset_on_close(stream)
+    stream.close()
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+"""
+asyncio session engine.
+
+The default engine (maproxy.proxyserver.ProxyServer + maproxy.session.Session) uses Tornado's IOStream: every
+read and every write is an IOStream operation with its own callback. This engine uses asyncio's
+Protocol/Transport directly: the data that the transport reads is passed to the session, and the writes are
+buffered by the transport (back-pressure is signaled by the transport's pause_writing/resume_writing).
+
+The interface is the same: AioProxyServer is a ProxyServer (same parameters, same IOManager), and AioSession
+is a Session with the same hooks (on_c2p_done_read, on_p2s_done_read, on_p2s_done_connect, on_c2p_close,
+on_p2s_close, ...). Since Tornado 5, Tornado's IOLoop runs on an asyncio event-loop, so both engines (and the
+health-checks, the timer-wheel, ...) can run on the same IOLoop.
+
+To use uvloop, call install_uvloop() before the IOManager is created.
+
+Requires Python 3 and Tornado 5 (or later).
+"""
+
+import asyncio
+import collections
+import functools
+import tornado.ioloop
+import tornado.netutil
+import maproxy.proxyserver
+import maproxy.session
+import maproxy.healthcheck
+import maproxy.connector
+import maproxy.hooks
+
+
+
+def install_uvloop():
+    """
+    Use uvloop's event-loop (if uvloop is installed) . Must be called before the IOManager (the IOLoop) is created.
+    Returns True if uvloop is used
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    # The policy does not create event-loops on demand (Tornado's IOLoop.current() needs one in this thread)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    return True
+
+
+class AioStream(asyncio.Protocol):
+    """
+    A connection (asyncio Protocol) with the small subset of the IOStream interface that the Session uses:
+    start_reading(callback), write(data), close(), set_close_callback(callback) and the "error" attribute.
+    - Data that is received before start_reading() is called is buffered (and the reading is paused)
+    - close() closes the connection immediately (the queued data is dropped), like IOStream.close().
+      close_gracefully() closes it after all the queued data was sent
+    - The write-buffer callback is called when the transport's write-buffer crosses its limits
+      (see set_write_buffer_limits)
+    """
+    def __init__(self,on_connection_made=None):
+        self.transport=None
+        self.error=None                     # The exception that closed the connection (if any)
+        self._on_connection_made=on_connection_made
+        self._read_callback=None
+        self._read_buffer=[]
+        self._close_callback=None
+        self._write_buffer_callback=None
+        self._closed=False
+
+    ##################
+    ## Protocol API ##
+    ##################
+    def connection_made(self,transport):
+        self.transport=transport
+        if self._on_connection_made is not None:
+            self._on_connection_made(self)
+
+    def data_received(self,data):
+        if self._read_callback is None:
+            self._read_buffer.append(data)
+            self.pause_reading()
+            return
+        self._read_callback(data)
+
+    def eof_received(self):
+        # Close the transport (we don't support half-closed connections)
+        return False
+
+    def connection_lost(self,exc):
+        self.error=exc
+        self._closed=True
+        if self._close_callback is not None:
+            self._run_close_callback()
+
+    def pause_writing(self):
+        if self._write_buffer_callback is not None:
+            self._write_buffer_callback()
+
+    def resume_writing(self):
+        if self._write_buffer_callback is not None:
+            self._write_buffer_callback()
+
+    ################
+    ## Stream API ##
+    ################
+    def closed(self):
+        return self._closed
+
+    def start_reading(self,callback):
+        """
+        Pass the received data to callback(data) . The data that was buffered (if any) is passed immediately
+        """
+        self._read_callback=callback
+        while self._read_buffer and self._read_callback is not None:
+            callback(self._read_buffer.pop(0))
+        self.resume_reading()
+
+    def pause_reading(self):
+        if not self._closed and not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        if not self._closed and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def write(self,data):
+        if not self._closed and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def get_write_buffer_size(self):
+        return self.transport.get_write_buffer_size() if self.transport is not None else 0
+
+    def set_write_buffer_limits(self,high,low):
+        self.transport.set_write_buffer_limits(high,low)
+
+    def set_write_buffer_callback(self,callback):
+        self._write_buffer_callback=callback
+
+    def set_close_callback(self,callback):
+        """
+        Call callback() when the connection is closed (immediately, if it's already closed)
+        """
+        self._close_callback=callback
+        if callback is not None and self._closed:
+            tornado.ioloop.IOLoop.current().add_callback(self._run_close_callback)
+
+    def _run_close_callback(self):
+        callback,self._close_callback=self._close_callback,None
+        if callback is not None:
+            callback()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.abort()
+
+    def close_gracefully(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AioConnector(object):
+    """
+    Connects a new Proxy->Server AioStream to a backend (same interface as maproxy.connector.Connector) .
+    The backend's hostname is resolved by the proxy's resolver, and the addresses are tried one after the other
+    (alternating the address families) until one of them is connected.
+    The callback gets the connected stream, or None if all the attempts failed (or the timeout expired).
+    """
+    def __init__(self,proxy,backend,callback,timeout=None):
+        self.proxy=proxy
+        self.backend=backend
+        self.callback=callback
+        self.timeout=timeout
+        self._loop=tornado.ioloop.IOLoop.current().asyncio_loop
+        self._timeout_handle=None
+        self._addresses=collections.deque()
+        self._future=None
+        self._done=False
+
+    def start(self):
+        if self.timeout is not None:
+            self._timeout_handle=self._loop.call_later(self.timeout,self._on_timeout)
+        self.proxy.resolver.resolve(self.backend.host,self.backend.port,self._on_resolved)
+
+    def close(self):
+        """
+        Cancel the connect (the callback will not be called)
+        """
+        self._done=True
+        self._cancel()
+
+    def _on_resolved(self,addresses):
+        if self._done:
+            return
+        self._addresses.extend(maproxy.connector.Connector.interleave(addresses))
+        self._connect_next()
+
+    def _connect_next(self):
+        if not self._addresses:
+            self._finish(None)
+            return
+        family,address=self._addresses.popleft()
+        stream=AioStream()
+        ssl_context=self.proxy.server_ssl_context
+        coro=self._loop.create_connection(lambda: stream,address[0],address[1],ssl=ssl_context,
+                                          server_hostname=self.backend.host if ssl_context is not None else None)
+        self._future=asyncio.ensure_future(coro,loop=self._loop)
+        self._future.add_done_callback(functools.partial(self._on_connect,stream))
+
+    def _on_connect(self,stream,future):
+        if future is self._future:
+            self._future=None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            if not self._done:
+                self._connect_next()
+            return
+        if self._done:
+            # Cancelled after the connection was made
+            stream.close()
+            return
+        self._finish(stream)
+
+    def _on_timeout(self):
+        self._timeout_handle=None
+        self._cancel()
+        self._finish(None)
+
+    def _cancel(self):
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle=None
+        if self._future is not None:
+            self._future.cancel()
+            self._future=None
+
+    def _finish(self,stream):
+        if self._done:
+            return
+        self._done=True
+        self._cancel()
+        self.callback(stream)
+
+
+class AioSession(maproxy.session.Session):
+    """
+    Session of the asyncio engine (created by AioSessionFactory, for an AioProxyServer).
+    The streams (c2p_stream, p2s_stream) are AioStream objects. The Session's logic (queueing the data while
+    connecting, the close semantics, retries, timeouts, ...) is inherited, only the I/O is different:
+    - The transport reads the data and passes it to on_c2p_done_read/on_p2s_done_read (no read operations)
+    - The data is written to the transport, which buffers it (no write operations, so on_c2p_done_write and
+      on_p2s_done_write are not called)
+    - Back-pressure: when the transport's write-buffer is above the proxy's high_watermark, we pause the reading
+      from the other side, and resume it when the write-buffer drops to the low_watermark
+    """
+    __slots__=()
+
+    ###################
+    ## Stream (init) ##
+    ###################
+    def _init_c2p_stream(self):
+        self._init_stream(self.c2p_stream,self.on_c2p_close,self._s2c_queue_changed)
+
+    def _init_stream(self,stream,close_callback,write_buffer_callback):
+        # NOTE: asyncio's TCP transports already disable the Nagle algorithm
+        stream.set_close_callback(close_callback)
+        if self.proxy.high_watermark is not None:
+            stream.set_write_buffer_limits(self.proxy.high_watermark,self.proxy.low_watermark)
+            stream.set_write_buffer_callback(write_buffer_callback)
+
+    def _on_p2s_connected(self,stream):
+        if stream is None:
+            super(AioSession,self)._on_p2s_connected(stream)
+            return
+        self.p2s_connector=None
+        self.p2s_stream=stream
+        self._observe_connect(stream)
+        self._init_stream(stream,self.on_p2s_close,self._c2s_queue_changed)
+        self.on_p2s_done_connect()
+
+    ##########
+    ## Read ##
+    ##########
+    def c2p_start_read(self):
+        self.c2p_reading=True
+        self.c2p_stream.start_reading(self._on_c2p_read_chunk)
+
+    def p2s_start_read(self):
+        self.p2s_reading=True
+        self.p2s_stream.start_reading(self._on_p2s_read_chunk)
+
+    def _on_c2p_read_chunk(self,data):
+        self.c2s_bytes+=len(data)
+        self.c2s_chunks+=1
+        if self.timeout_timer is not None:
+            self.last_activity=self.proxy.timer_wheel.now
+        self.on_c2p_done_read(data)
+        hooks=self.proxy.hooks.on_data
+        if hooks:
+            maproxy.hooks.run(hooks,self,maproxy.hooks.C2S,memoryview(data))
+        shaper=self.proxy.shaper
+        if shaper is not None and shaper.consume(self,maproxy.hooks.C2S,len(data)):
+            self.c2p_read_throttled=True
+            self.c2p_stream.pause_reading()
+
+    def _on_p2s_read_chunk(self,data):
+        self.s2c_bytes+=len(data)
+        self.s2c_chunks+=1
+        if self.s2c_chunks == 1:
+            self._observe_first_byte()
+        if self.timeout_timer is not None:
+            self.last_activity=self.proxy.timer_wheel.now
+        self.on_p2s_done_read(data)
+        hooks=self.proxy.hooks.on_data
+        if hooks:
+            maproxy.hooks.run(hooks,self,maproxy.hooks.S2C,memoryview(data))
+        shaper=self.proxy.shaper
+        if shaper is not None and shaper.consume(self,maproxy.hooks.S2C,len(data)):
+            self.p2s_read_throttled=True
+            self.p2s_stream.pause_reading()
+
+    ###################
+    ## Back-Pressure ##
+    ###################
+    # Number of bytes that are queued in each direction (in our queue, and in the transport's write-buffer)
+    c2s_queued_bytes=property(lambda self: self.c2s_queued_data.nbytes +
+                                           (self.p2s_stream.get_write_buffer_size() if self.p2s_stream is not None else 0))
+    s2c_queued_bytes=property(lambda self: self.s2c_queued_data.nbytes + self.c2p_stream.get_write_buffer_size())
+
+    def _c2s_queue_changed(self):
+        if self.proxy.high_watermark is None:
+            return
+        if not self.c2p_read_paused:
+            if self.c2s_queued_bytes > self.proxy.high_watermark:
+                self.c2p_read_paused=True
+                self.c2p_stream.pause_reading()
+        elif self.c2s_queued_bytes <= self.proxy.low_watermark:
+            self.c2p_read_paused=False
+            if not self.c2p_read_throttled:
+                self.c2p_stream.resume_reading()
+
+    def _s2c_queue_changed(self):
+        if self.proxy.high_watermark is None:
+            return
+        if not self.p2s_read_paused:
+            if self.s2c_queued_bytes > self.proxy.high_watermark:
+                self.p2s_read_paused=True
+                if self.p2s_stream is not None:
+                    self.p2s_stream.pause_reading()
+        elif self.s2c_queued_bytes <= self.proxy.low_watermark:
+            self.p2s_read_paused=False
+            if self.p2s_stream is not None and not self.p2s_read_throttled:
+                self.p2s_stream.resume_reading()
+
+    def resume_shaped_read(self,direction):
+        if direction == maproxy.hooks.C2S:
+            self.c2p_read_throttled=False
+            if not self.c2p_read_paused:
+                self.c2p_stream.resume_reading()
+        else:
+            self.p2s_read_throttled=False
+            if not self.p2s_read_paused and self.p2s_stream is not None:
+                self.p2s_stream.resume_reading()
+
+    ###########
+    ## Write ##
+    ###########
+    # The transport buffers the data, so the data (and the queued data, if any) is written immediately
+    def _c2p_io_write(self,data):
+        while True:
+            if data is None:
+                # None means (gracefully) close-socket: the transport closes it after it sends the buffered data
+                self.c2p_state=maproxy.session.Session.State.CLOSED
+                self.c2p_stream.close_gracefully()
+                return
+            self.c2p_stream.write(data)
+            if not self.s2c_queued_data:
+                return
+            data=self.s2c_queued_data.pop_batch(self.proxy.write_batch_size)
+            self._s2c_queue_changed()
+
+    def _p2s_io_write(self,data):
+        while True:
+            if data is None:
+                self.p2s_state=maproxy.session.Session.State.CLOSED
+                self.p2s_stream.close_gracefully()
+                return
+            self.p2s_stream.write(data)
+            if not self.c2s_queued_data:
+                return
+            data=self._p2s_dequeue_data()
+
+    ###########
+    ## Close ##
+    ###########
+    # The transport delivers all the received data before the connection is closed, so (unlike the
+    # IOStream engine) there are no leftovers to read when the connection is closed
+    def on_c2p_close(self):
+        self.c2p_state=maproxy.session.Session.State.CLOSED
+        self.c2p_read_paused=False
+        self._on_c2p_closed()
+
+    def on_p2s_close(self):
+        if self.p2s_state==maproxy.session.Session.State.CONNECTED and \
+           maproxy.healthcheck.is_connection_reset(self.p2s_stream):
+            self.backend.resets+=1
+            self._report_backend_failure()
+        self.p2s_state=maproxy.session.Session.State.CLOSED
+        self.p2s_read_paused=False
+        self._on_p2s_closed()
+
+
+class AioSessionFactory(maproxy.session.SessionFactory):
+    """
+    Session-factory that creates AioSession objects
+    """
+    session_class=AioSession
+
+
+class AioProxyServer(maproxy.proxyserver.ProxyServer):
+    """
+    TCP Proxy Server (asyncio engine).
+    Same parameters as ProxyServer (the default session_factory is AioSessionFactory, and connection_pool is
+    not supported). Add it to the IOManager (or call listen/bind/start/stop) like any other ProxyServer.
+    """
+    def __init__(self,*args,**kwargs):
+        kwargs.setdefault("session_factory",AioSessionFactory())
+        super(AioProxyServer,self).__init__(*args,**kwargs)
+        assert self.connection_pool is None , "connection_pool is not supported by the asyncio engine"
+        self.client_ssl_context=None
+        if self.client_ssl_options is not None:
+            self.client_ssl_context=tornado.netutil.ssl_options_to_context(self.client_ssl_options)
+
+    def add_sockets(self,sockets):
+        """
+        Start accepting connections (with asyncio servers, on the current IOLoop's asyncio event-loop)
+        """
+        loop=tornado.ioloop.IOLoop.current().asyncio_loop
+        for sock in sockets:
+            server=asyncio.ensure_future(loop.create_server(self._new_c2p_stream,sock=sock,ssl=self.client_ssl_context,
+                                                            backlog=128),loop=loop)
+            # TCPServer.stop() calls the handler (and closes the socket)
+            self._sockets[sock.fileno()]=sock
+            self._handlers[sock.fileno()]=functools.partial(AioProxyServer._close_server,server)
+        if self.health_checker is not None:
+            self.health_checker.start()
+
+    @staticmethod
+    def _close_server(server):
+        if not server.done():
+            server.cancel()
+        elif not server.cancelled() and server.exception() is None:
+            server.result().close()
+
+    def _new_c2p_stream(self):
+        return AioStream(on_connection_made=self._on_c2p_connection_made)
+
+    def _on_c2p_connection_made(self,stream):
+        self.handle_stream(stream,stream.transport.get_extra_info("peername"))
+
+    def handle_stream(self,stream,address):
+        if self.admission is not None and not self.admission.admit(stream,address):
+            return
+        self.start_session(stream,address)
+
+    def connect(self,backend,callback):
+        connector=AioConnector(self,backend,callback,self.connect_timeout)
+        connector.start()
+        return connector
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import time
+
+
+
+class Backend(object):
+    """
+    A proxied (target) server.
+    The ProxyServer may have several backends, and it uses its Balancer to select a backend for each session.
+    Each backend keeps its own counters .
+    """
+    def __init__(self,host,port,weight=1):
+        """
+        Input Parameters:
+            host        : the backend's address (IP or hostname)
+            port        : the backend's port
+            weight      : relative weight for the load-balancing (positive integer)
+        """
+        assert weight > 0 , "weight must be positive"
+        self.host=host
+        self.port=port
+        self.weight=weight
+
+        # Counters
+        self.active_sessions=0      # Number of live sessions that are connected (or connecting) to this backend
+        self.total_sessions=0       # Number of sessions that were ever assigned to this backend
+        self.connect_failures=0     # Number of sessions that failed to connect to this backend
+        self.resets=0               # Number of sessions that were reset by this backend
+
+        # Health (see maproxy.healthcheck.HealthChecker)
+        self.consecutive_failures=0
+        self.ejected_until=0        # The backend is ejected (not selected by the balancer) until this time
+        self.ejections=0            # Number of consecutive ejections (for the back-off)
+        self.total_ejections=0
+
+        # TLS-session cache (maproxy.sslsession.SSLSessionCache) , if the proxy connects to the backend with SSL
+        self.ssl_session_cache=None
+
+    def __repr__(self):
+        return "Backend(%r,%r,weight=%d)" % (self.host,self.port,self.weight)
+
+    def is_ejected(self):
+        return self.ejected_until > time.time()
+
+    def address(self):
+        return (self.host,self.port)
+
+    @staticmethod
+    def create(spec):
+        """
+        Create a Backend from a "backend specification", which is one of:
+            - Backend instance (returned as is)
+            - (host,port) tuple
+            - (host,port,weight) tuple
+        """
+        if isinstance(spec,Backend):
+            return spec
+        return Backend(*spec)
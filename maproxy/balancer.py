@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import bisect
+import hashlib
+
+
+
+class Balancer(object):
+    """
+    Base class of the load-balancers.
+    A load-balancer selects a backend (maproxy.backend.Backend) for each new session.
+    In order to create your own balancer, simply inherit this class and implement select()
+    """
+    def select(self,backends,session):
+        """
+        Select a backend for the session
+        Input Parameters:
+            backends    : list of the candidate Backend objects (never empty)
+            session     : the new Session (c2p_address is already set)
+        """
+        raise NotImplementedError()
+
+
+class RoundRobinBalancer(Balancer):
+    """
+    Weighted round-robin ("smooth" weighted round-robin, so heavy backends are not selected in bursts)
+    """
+    def __init__(self):
+        self._current_weights={}        # backend->current weight
+
+    def select(self,backends,session):
+        if len(backends)==1:
+            return backends[0]
+        total=0
+        selected=None
+        selected_weight=None
+        for backend in backends:
+            weight=self._current_weights.get(backend,0)+backend.weight
+            self._current_weights[backend]=weight
+            total+=backend.weight
+            if selected is None or weight > selected_weight:
+                selected,selected_weight=backend,weight
+        self._current_weights[selected]-=total
+        return selected
+
+
+class LeastSessionsBalancer(Balancer):
+    """
+    Select the backend with the least active sessions (relative to its weight)
+    """
+    def select(self,backends,session):
+        return min(backends,key=lambda backend: float(backend.active_sessions)/backend.weight)
+
+
+class ConsistentHashBalancer(Balancer):
+    """
+    Consistent hashing on the client's IP address (c2p_address) , so a client keeps
+    getting the same backend (stickiness), and only a small part of the clients move when a backend
+    is added or removed.
+    The ring is built once for all the proxy's backends: when some of them are not candidates (unhealthy , or
+    excluded by a retry) we walk the ring clockwise to the next candidate , so the clients of the other backends
+    don't move (and the ring is not rebuilt on the hot path)
+    """
+    def __init__(self,replicas=100):
+        """
+        Input Parameters:
+            replicas    : number of points on the hash-ring per backend (multiplied by the backend's weight)
+        """
+        self.replicas=replicas
+        self._ring_backends=None        # The backends that the ring was built for (tuple)
+        self._ring_keys=[]
+        self._ring_values=[]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16],16)
+
+    def _build_ring(self,backends):
+        ring=[]
+        for backend in backends:
+            for i in range(self.replicas*backend.weight):
+                ring.append((self._hash("%s:%s-%d" % (backend.host,backend.port,i)),backend))
+        ring.sort(key=lambda item: item[0])
+        self._ring_keys=[key for key,backend in ring]
+        self._ring_values=[backend for key,backend in ring]
+        self._ring_backends=backends
+
+    def select(self,backends,session):
+        if len(backends)==1:
+            return backends[0]
+        all_backends=tuple(session.proxy.backends)
+        if self._ring_backends != all_backends:
+            self._build_ring(all_backends)
+        values=self._ring_values
+        key=self._hash(str(session.c2p_address[0]))
+        index=bisect.bisect(self._ring_keys,key)
+        for i in range(len(values)):
+            backend=values[(index+i) % len(values)]
+            if backend in backends:
+                return backend
+        # The candidates are not the proxy's backends
+        return backends[key % len(backends)]
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+import os
+import time
+import json
+import base64
+import random
+import socket
+import struct
+import logging
+import threading
+import collections
+import maproxy.hooks
+
+
+
+class Capture(object):
+    """
+    Captures the proxies' traffic to pcap or JSONL files, without blocking the IOLoop.
+    - attach() registers the capture's hooks (see maproxy.hooks) on a proxy: the data of each session is copied
+      into a bounded in-memory ring , and a background thread writes the ring to the files
+    - Sampling: only sample_rate of the sessions are captured (decided when the session is opened)
+    - Each session captures up to max_session_bytes (both directions) , the rest is counted as "truncated"
+    - When the ring is full (the writer can't keep up), the data is dropped and counted , the proxy never waits
+      for the writer
+    - The files are rotated when they reach max_file_size bytes (capture-000001.pcap, capture-000002.pcap,...)
+      and only the last max_files files are kept
+    Formats:
+    - pcap : every session is a TCP connection between the client and the proxy's address (synthesized SYN
+             handshake , data segments and FINs , raw IPv4/IPv6 packets). The TCP checksums are not calculated.
+             Dropped/truncated data leaves a gap in the TCP sequence numbers
+    - jsonl: a JSON object per line: {"event":"open"|"data"|"close" , "time" , "session" , ...} , the data is base64
+    SpliceSession's data never gets to Python, so it is not captured (only the open/close events)
+    """
+    OPEN,DATA,CLOSE=range(3)
+
+    def __init__(self,path,format=None,sample_rate=1.0,max_session_bytes=None,max_buffer_bytes=16*1024*1024,
+                 max_file_size=100*1024*1024,max_files=None,flush_interval=0.2):
+        """
+        Input Parameters:
+            path                : base path of the files (e.g. "/var/tmp/proxy.pcap" -> /var/tmp/proxy-000001.pcap,...)
+            format              : "pcap" or "jsonl" (default: "jsonl" if path ends with .jsonl/.json , otherwise "pcap")
+            sample_rate         : the fraction of the sessions to capture (0..1)
+            max_session_bytes   : capture up to this number of bytes per session (None: no limit)
+            max_buffer_bytes    : the size of the ring (bytes of data that wait for the writer)
+            max_file_size       : rotate the file when it reaches this number of bytes (None: never)
+            max_files           : number of files to keep (None: keep all)
+            flush_interval      : how often (seconds) the writer drains the ring
+        """
+        if format is None:
+            format="jsonl" if os.path.splitext(path)[1].lower() in (".jsonl",".json") else "pcap"
+        assert format in FORMATS , "Unknown format: %s" % format
+        self.path=path
+        self.format=format
+        self.sample_rate=sample_rate
+        self.max_session_bytes=max_session_bytes
+        self.max_buffer_bytes=max_buffer_bytes
+        self.max_file_size=max_file_size
+        self.max_files=max_files
+        self.flush_interval=flush_interval
+
+        # IOLoop side
+        self._sessions={}               # session->[key,remaining bytes,c2s offset,s2c offset] (captured sessions)
+        self._next_key=1
+        self._proxies=[]
+        # The ring: records (kind,time,key,direction/addresses,offset,data) , appended by the IOLoop and
+        # popped by the writer (deque's append/popleft are thread-safe)
+        self._ring=collections.deque()
+        self._ring_bytes=0
+        self._ring_lock=threading.Lock()
+        # Counters
+        self.captured_sessions=0
+        self.captured_bytes=0
+        self.truncated_bytes=0
+        self.dropped_records=0
+        self.dropped_bytes=0
+        self.written_records=0
+        self.write_errors=0
+        self.files=0
+
+        # Writer side
+        self._thread=None
+        self._stop_event=threading.Event()
+        self._file=None
+        self._file_size=0
+        self._file_paths=collections.deque()
+
+    #############
+    ## Control ##
+    #############
+    def attach(self,proxy):
+        """
+        Start capturing the proxy's sessions (the new ones) . Starts the writer thread
+        """
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread=threading.Thread(target=self._run,name="maproxy-capture")
+            self._thread.daemon=True
+            self._thread.start()
+        proxy.hooks.add("on_session_open",self.on_session_open)
+        proxy.hooks.add("on_data",self.on_data)
+        proxy.hooks.add("on_close",self.on_close)
+        self._proxies.append(proxy)
+
+    def detach(self,proxy):
+        """
+        Stop capturing the proxy's sessions
+        """
+        proxy.hooks.remove("on_session_open",self.on_session_open)
+        proxy.hooks.remove("on_data",self.on_data)
+        proxy.hooks.remove("on_close",self.on_close)
+        self._proxies.remove(proxy)
+        for session in [session for session in self._sessions if session.proxy is proxy]:
+            self.on_close(session)
+
+    def close(self):
+        """
+        Detach from all the proxies, write what's left in the ring and stop the writer thread
+        """
+        for proxy in list(self._proxies):
+            self.detach(proxy)
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread=None
+
+    def stats(self):
+        return {"captured_sessions":self.captured_sessions,
+                "captured_bytes":self.captured_bytes,
+                "truncated_bytes":self.truncated_bytes,
+                "dropped_records":self.dropped_records,
+                "dropped_bytes":self.dropped_bytes,
+                "buffered_bytes":self._ring_bytes,
+                "written_records":self.written_records,
+                "write_errors":self.write_errors,
+                "files":self.files}
+
+    ####################
+    ## Hooks (IOLoop) ##
+    ####################
+    def on_session_open(self,session):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        key=self._next_key
+        self._next_key+=1
+        self._sessions[session]=[key,self.max_session_bytes,0,0]
+        self.captured_sessions+=1
+        addresses=(_address(session.c2p_address),_address(_sockname(session.c2p_stream)))
+        self._ring.append((Capture.OPEN,time.time(),key,addresses,0,None))
+
+    def on_data(self,session,direction,data):
+        state=self._sessions.get(session)
+        if state is None:
+            return
+        index=2 if direction == maproxy.hooks.C2S else 3
+        offset=state[index]
+        size=len(data)
+        state[index]+=size
+        remaining=state[1]
+        if remaining is not None:
+            if size > remaining:
+                self.truncated_bytes+=size-remaining
+                size=remaining
+                if not size:
+                    return
+            state[1]=remaining-size
+        with self._ring_lock:
+            if self._ring_bytes+size > self.max_buffer_bytes:
+                self.dropped_records+=1
+                self.dropped_bytes+=size
+                return
+            self._ring_bytes+=size
+        self.captured_bytes+=size
+        self._ring.append((Capture.DATA,time.time(),state[0],direction,offset,bytes(data[:size])))
+
+    def on_close(self,session):
+        state=self._sessions.pop(session,None)
+        if state is None:
+            return
+        self._ring.append((Capture.CLOSE,time.time(),state[0],None,0,None))
+
+    #####################
+    ## Writer (thread) ##
+    #####################
+    def _run(self):
+        encoder=FORMATS[self.format]()
+        while True:
+            stopping=self._stop_event.wait(self.flush_interval)
+            self._drain(encoder)
+            if stopping:
+                break
+        if self._file is not None:
+            self._file.close()
+            self._file=None
+
+    def _drain(self,encoder):
+        ring=self._ring
+        while ring:
+            record=ring.popleft()
+            if record[0] == Capture.DATA:
+                with self._ring_lock:
+                    self._ring_bytes-=len(record[5])
+            try:
+                data=encoder.encode(record)
+                if data:
+                    self._write(encoder,data)
+                self.written_records+=1
+            except (IOError,OSError):
+                self.write_errors+=1
+                logging.exception("maproxy: capture write failed")
+        if self._file is not None:
+            try:
+                self._file.flush()
+            except (IOError,OSError):
+                self.write_errors+=1
+
+    def _write(self,encoder,data):
+        if self._file is None or (self.max_file_size is not None and self._file_size >= self.max_file_size):
+            self._rotate(encoder)
+        self._file.write(data)
+        self._file_size+=len(data)
+
+    def _rotate(self,encoder):
+        if self._file is not None:
+            self._file.close()
+            self._file=None
+        base,ext=os.path.splitext(self.path)
+        self.files+=1
+        path="%s-%06d%s" % (base,self.files,ext)
+        self._file=open(path,"wb")
+        self._file_paths.append(path)
+        header=encoder.header()
+        self._file.write(header)
+        self._file_size=len(header)
+        while self.max_files is not None and len(self._file_paths) > self.max_files:
+            try:
+                os.remove(self._file_paths.popleft())
+            except OSError:
+                pass
+
+
+def _sockname(stream):
+    """
+    The local address of the stream's socket (Tornado's IOStream or the asyncio engine's AioStream) , or None
+    """
+    try:
+        sock=getattr(stream,"socket",None)
+        if sock is not None:
+            return sock.getsockname()
+        return stream.transport.get_extra_info("sockname")
+    except (AttributeError,OSError):
+        return None
+
+def _address(address):
+    """
+    (host,port) of a socket address (None if it's not an IP address)
+    """
+    if isinstance(address,tuple) and len(address) >= 2:
+        return (address[0],address[1])
+    return None
+
+
+##################
+## File formats ##
+##################
+class JsonlFormat(object):
+    """
+    A JSON object per line
+    """
+    def header(self):
+        return b""
+
+    def encode(self,record):
+        kind,timestamp,key,info,offset,data=record
+        if kind == Capture.OPEN:
+            obj={"event":"open","time":timestamp,"session":key,
+                 "client":"%s:%s" % info[0] if info[0] else None,"server":"%s:%s" % info[1] if info[1] else None}
+        elif kind == Capture.DATA:
+            obj={"event":"data","time":timestamp,"session":key,"direction":info,"offset":offset,"size":len(data),
+                 "data":base64.b64encode(data).decode("ascii")}
+        else:
+            obj={"event":"close","time":timestamp,"session":key}
+        return (json.dumps(obj,sort_keys=True)+"\n").encode("utf-8")
+
+
+class PcapFormat(object):
+    """
+    pcap (LINKTYPE_RAW: IPv4/IPv6 packets) with synthesized TCP segments
+    """
+    LINKTYPE_RAW=101
+    MAX_SEGMENT=65000
+    SYN,FIN,PSH,ACK=0x02,0x01,0x08,0x10
+
+    def __init__(self):
+        self._sessions={}   # key->[family,client(ip-bytes,port),server(ip-bytes,port),c2s isn,s2c isn,c2s next,s2c next]
+
+    def header(self):
+        return struct.pack("<IHHiIII",0xa1b2c3d4,2,4,0,0,65535,PcapFormat.LINKTYPE_RAW)
+
+    def encode(self,record):
+        kind,timestamp,key,info,offset,data=record
+        if kind == Capture.OPEN:
+            return self._open(timestamp,key,info)
+        state=self._sessions.get(key)
+        if state is None:
+            return b""
+        family,client,server,c2s_isn,s2c_isn=state[:5]
+        if kind == Capture.CLOSE:
+            del self._sessions[key]
+            c2s_seq,s2c_seq=c2s_isn+1+state[5],s2c_isn+1+state[6]
+            return self._packet(timestamp,family,client,server,c2s_seq,s2c_seq,PcapFormat.FIN|PcapFormat.ACK)+ \
+                   self._packet(timestamp,family,server,client,s2c_seq,c2s_seq+1,PcapFormat.FIN|PcapFormat.ACK)+ \
+                   self._packet(timestamp,family,client,server,c2s_seq+1,s2c_seq+1,PcapFormat.ACK)
+        packets=[]
+        if info == maproxy.hooks.C2S:
+            src,dst,isn,ack,index=client,server,c2s_isn,s2c_isn+1+state[6],5
+        else:
+            src,dst,isn,ack,index=server,client,s2c_isn,c2s_isn+1+state[5],6
+        for start in range(0,len(data),PcapFormat.MAX_SEGMENT):
+            segment=data[start:start+PcapFormat.MAX_SEGMENT]
+            packets.append(self._packet(timestamp,family,src,dst,isn+1+offset+start,ack,
+                                        PcapFormat.PSH|PcapFormat.ACK,segment))
+        state[index]=max(state[index],offset+len(data))
+        return b"".join(packets)
+
+    def _open(self,timestamp,key,addresses):
+        client,server=addresses
+        host=(client or server or ("0.0.0.0",0))[0]
+        family=socket.AF_INET6 if ":" in host else socket.AF_INET
+        any_address="::" if family == socket.AF_INET6 else "0.0.0.0"
+        endpoints=[]
+        for address in (client,server):
+            try:
+                endpoints.append((socket.inet_pton(family,address[0]),address[1]))
+            except (TypeError,OSError,ValueError):
+                endpoints.append((socket.inet_pton(family,any_address),0))
+        client,server=endpoints
+        c2s_isn,s2c_isn=random.getrandbits(32),random.getrandbits(32)
+        self._sessions[key]=[family,client,server,c2s_isn,s2c_isn,0,0]
+        return self._packet(timestamp,family,client,server,c2s_isn,0,PcapFormat.SYN)+ \
+               self._packet(timestamp,family,server,client,s2c_isn,c2s_isn+1,PcapFormat.SYN|PcapFormat.ACK)+ \
+               self._packet(timestamp,family,client,server,c2s_isn+1,s2c_isn+1,PcapFormat.ACK)
+
+    @staticmethod
+    def _packet(timestamp,family,src,dst,seq,ack,flags,payload=b""):
+        tcp=struct.pack("!HHIIBBHHH",src[1],dst[1],seq & 0xffffffff,ack & 0xffffffff,5 << 4,flags,65535,0,0)
+        if family == socket.AF_INET6:
+            ip=struct.pack("!IHBB",6 << 28,len(tcp)+len(payload),socket.IPPROTO_TCP,64)+src[0]+dst[0]
+        else:
+            ip=struct.pack("!BBHHHBBH4s4s",0x45,0,20+len(tcp)+len(payload),0,0x4000,64,socket.IPPROTO_TCP,0,
+                           src[0],dst[0])
+            ip=ip[:10]+struct.pack("!H",PcapFormat._checksum(ip))+ip[12:]
+        size=len(ip)+len(tcp)+len(payload)
+        seconds=int(timestamp)
+        return struct.pack("<IIII",seconds,int((timestamp-seconds)*1000000),size,size)+ip+tcp+payload
+
+    @staticmethod
+    def _checksum(header):
+        total=sum(struct.unpack("!%dH" % (len(header)//2),header))
+        while total >> 16:
+            total=(total & 0xffff)+(total >> 16)
+        return ~total & 0xffff
+
+
+FORMATS={"pcap":PcapFormat,"jsonl":JsonlFormat}
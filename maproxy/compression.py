@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+
+import zlib
+import logging
+import functools
+import tornado.ioloop
+import maproxy.session
+import maproxy.outputbuffer
+
+try:
+    from compression import zstd    # Python 3.14+
+except ImportError:
+    try:
+        import pyzstd as zstd
+    except ImportError:
+        zstd=None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4=None
+
+
+
+# The compressed link of a CompressedSession (see CompressedSessionFactory)
+CLIENT="client"     # The client is a maproxy that compresses its data (the far side of the link)
+SERVER="server"     # The server is a maproxy that decompresses our data (the near side of the link)
+
+
+class CompressionError(Exception):
+    pass
+
+
+class Codec(object):
+    """
+    A streaming codec. The compressed stream starts with the codec's id (one byte) , so only the compressing side
+    chooses the codec (the decompressing side follows)
+        compressor(level) : an object with compress(data) , that returns all the compressed data of the chunk
+                            (flushed at the chunk's end , so the other side can decompress it right away)
+        decompressor()    : an object with decompress(data,max_length) , that returns up to max_length bytes ,
+                            and needs_input: False if it holds input that it didn't decompress yet (then
+                            decompress(b"",max_length) returns more) . Like bz2/lzma's decompressors
+    """
+    def __init__(self,name,codec_id,compressor,decompressor):
+        self.name=name
+        self.codec_id=codec_id
+        self.compressor=compressor
+        self.decompressor=decompressor
+
+
+class ZlibCompressor(object):
+    __slots__=("_compressobj",)
+
+    def __init__(self,level=None):
+        self._compressobj=zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION)
+
+    def compress(self,data):
+        # A sync-flush ends the chunk on a byte boundary (the dictionary is kept for the next chunks)
+        return self._compressobj.compress(data)+self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ZlibDecompressor(object):
+    __slots__=("_decompressobj","_tail","_full")
+
+    def __init__(self):
+        self._decompressobj=zlib.decompressobj()
+        self._tail=b""          # The input that is left (zlib's unconsumed_tail)
+        self._full=False        # The last call returned max_length bytes (zlib may have more)
+
+    @property
+    def needs_input(self):
+        return not self._tail and not self._full
+
+    def decompress(self,data,max_length):
+        if self._tail:
+            data=self._tail+data
+        output=self._decompressobj.decompress(data,max_length)
+        self._tail=self._decompressobj.unconsumed_tail
+        self._full=len(output) >= max_length
+        return output
+
+
+class ZstdCompressor(object):
+    __slots__=("_compressor",)
+
+    def __init__(self,level=None):
+        self._compressor=zstd.ZstdCompressor(level if level is not None else 3)
+
+    def compress(self,data):
+        return self._compressor.compress(data,zstd.ZstdCompressor.FLUSH_BLOCK)
+
+
+class Lz4Compressor(object):
+    """
+    LZ4 frames can't be flushed in the middle: every chunk is a frame
+    """
+    __slots__=("_level",)
+
+    def __init__(self,level=None):
+        self._level=level if level is not None else 0
+
+    def compress(self,data):
+        return lz4.frame.compress(data,compression_level=self._level)
+
+
+class Lz4Decompressor(object):
+    __slots__=("_decompressor",)
+
+    def __init__(self):
+        self._decompressor=lz4.frame.LZ4FrameDecompressor()
+
+    @property
+    def needs_input(self):
+        decompressor=self._decompressor
+        return not decompressor.unused_data if decompressor.eof else decompressor.needs_input
+
+    def decompress(self,data,max_length):
+        output=b""
+        while True:
+            if self._decompressor.eof:
+                # The next chunk's frame (unused_data is None when the frame ended with the input)
+                data=(self._decompressor.unused_data or b"")+data
+                self._decompressor=lz4.frame.LZ4FrameDecompressor()
+            output+=self._decompressor.decompress(data,max_length-len(output))
+            data=b""
+            if len(output) >= max_length or not self._decompressor.eof or not self._decompressor.unused_data:
+                return output
+
+
+# name->Codec , of the installed codecs
+CODECS={}
+_CODECS_BY_ID={}
+
+def register(codec):
+    CODECS[codec.name]=codec
+    _CODECS_BY_ID[codec.codec_id]=codec
+
+register(Codec("zlib",1,ZlibCompressor,ZlibDecompressor))
+if zstd is not None:
+    register(Codec("zstd",2,ZstdCompressor,zstd.ZstdDecompressor))
+if lz4 is not None:
+    register(Codec("lz4",3,Lz4Compressor,Lz4Decompressor))
+
+
+class CompressionStage(object):
+    """
+    One direction of a CompressedSession: compresses (or decompresses) the chunks that were read , in order , and
+    writes the output to the other side.
+    - A batch of at least "offload_size" bytes is processed on the factory's executor (the chunks that are read in
+      the meantime are processed together in the next batch) , the smaller ones (interactive traffic) right away
+    - The decompression returns up to max_output bytes at a time , and stops while the other side's queue is above
+      the proxy's high-watermark (the input is kept , resume() continues) , so a small input that decompresses to
+      a huge output never fills the memory
+    raw_bytes/coded_bytes count the data before/after the compression (ratio() is raw/coded)
+    """
+    __slots__=("session","compressing","codec","coder","prefix","write","close","queue","queue_changed",
+               "executor","offload_size","max_output","raw_bytes","coded_bytes","pending","pending_bytes","busy",
+               "running","waiting","close_pending")
+
+    def __init__(self,session,compressing,write,close,queue,queue_changed):
+        """
+        Input Parameters:
+            session         : the CompressedSession
+            compressing     : True to compress , False to decompress
+            write           : write(data) to the other side (session.p2s_start_write or c2p_start_write)
+            close           : close(gracefully) the other side (session.p2s_start_close or c2p_start_close)
+            queue           : the other side's queue (session.c2s_queued_data or s2c_queued_data)
+            queue_changed   : called when pending_bytes changes (the session's back-pressure)
+        """
+        factory=session.proxy.session_factory
+        self.session=session
+        self.compressing=compressing
+        self.write=write
+        self.close=close
+        self.queue=queue
+        self.queue_changed=queue_changed
+        self.executor=factory.executor
+        self.offload_size=factory.offload_size
+        self.max_output=factory.max_output
+        if compressing:
+            self.codec=CODECS[factory.codec]
+            self.coder=self.codec.compressor(factory.level)
+            self.prefix=bytes((self.codec.codec_id,))
+        else:
+            self.codec=self.coder=self.prefix=None    # The codec's id is the stream's first byte
+        self.raw_bytes=0
+        self.coded_bytes=0
+        self.pending=[]             # Chunks that were not processed yet
+        self.pending_bytes=0        # Bytes of the pending chunks and of the running job
+        self.busy=False             # A job is running on the executor
+        self.running=False          # run() is running (a write may call resume())
+        self.waiting=False          # run() stopped since the other side's queue is full
+        self.close_pending=False    # Close the other side (gracefully) when all the data was processed
+
+    def ratio(self):
+        return float(self.raw_bytes)/self.coded_bytes if self.coded_bytes else None
+
+    def detach(self):
+        """
+        The session was removed: drop the pending data (and the running job's output)
+        """
+        self.session=self.write=self.close=self.queue_changed=None
+        self.pending=[]
+
+    def has_data(self):
+        """
+        Data that was not written to the other side yet (pending , on the executor or held by the decompressor)
+        """
+        return self.busy or bool(self.pending) or self._coder_has_input()
+
+    def _coder_has_input(self):
+        return not self.compressing and self.coder is not None and not self.coder.needs_input
+
+    def _is_full(self):
+        high_watermark=self.session.proxy.high_watermark
+        return high_watermark is not None and self.queue.nbytes > high_watermark
+
+    def feed(self,data):
+        """
+        A chunk was read
+        """
+        self.pending.append(data)
+        self.pending_bytes+=len(data)
+        self.run(True)
+
+    def resume(self):
+        """
+        The other side's queue has changed: continue if we stopped since it was full
+        """
+        if self.waiting and not self._is_full():
+            self.waiting=False
+            self.run()
+
+    def run(self,changed=False):
+        """
+        Process the pending data , until the other side's queue is full (or a batch goes to the executor).
+        Then close the other side if it's pending
+        """
+        if self.running or self.busy or self.session is None:
+            return
+        self.running=True
+        while self.pending or self._coder_has_input():
+            if self._is_full():
+                self.waiting=True
+                break
+            if self._coder_has_input():
+                data=b""    # The decompressor's input first
+            else:
+                data=self.pending[0] if len(self.pending) == 1 else b"".join(self.pending)
+                self.pending=[]
+                if self.executor is not None and len(data) >= self.offload_size:
+                    self.busy=True
+                    tornado.ioloop.IOLoop.current().add_future(self.executor.submit(self.process,data),
+                                                               functools.partial(self._on_done,data))
+                    break
+            try:
+                output=self.process(data)
+            except Exception as e:
+                self.running=False
+                self._error(e)
+                return
+            self.pending_bytes-=len(data)
+            changed=True
+            self._output(data,output)
+            if self.session is None:
+                return  # The write removed the session
+        self.running=False
+        if self.close_pending and not self.has_data():
+            self.close_pending=False
+            self.close(True)
+        elif changed:
+            self.queue_changed()
+
+    def process(self,data):
+        """
+        Compress (or decompress , up to max_output bytes) a chunk (on the IOLoop , or on the executor)
+        """
+        if self.compressing:
+            output=self.coder.compress(data)
+            if self.prefix is not None:
+                output=self.prefix+output
+                self.prefix=None
+            return output
+        if self.coder is None:
+            self.codec=_CODECS_BY_ID.get(data[0])
+            if self.codec is None:
+                raise CompressionError("Unknown codec id %d (is the other side a compressing maproxy?)" % data[0])
+            self.coder=self.codec.decompressor()
+            data=data[1:]
+        return self.coder.decompress(data,self.max_output)
+
+    def _on_done(self,data,future):
+        self.busy=False
+        if self.session is None:
+            return
+        try:
+            output=future.result()
+        except Exception as e:
+            self._error(e)
+            return
+        self.pending_bytes-=len(data)
+        self._output(data,output)
+        if self.session is None:
+            return
+        self.run(True)
+
+    def _output(self,data,output):
+        if self.compressing:
+            self.raw_bytes+=len(data)
+            self.coded_bytes+=len(output)
+        else:
+            self.raw_bytes+=len(output)
+            self.coded_bytes+=len(data)
+        if output:
+            self.write(output)
+
+    def _error(self,error):
+        logging.warning("maproxy: session %s: %s failed (%s) , closing the session",self.session.session_id,
+                        "compression" if self.compressing else "decompression",error)
+        self.session.abort()
+
+
+class CompressedSession(maproxy.session.Session):
+    """
+    A session of a maproxy-to-maproxy link that is compressed (e.g. tcp2ssl on one side , ssl2tcp on the other):
+    the near side (link=SERVER) compresses the client's data and decompresses the server's data , and the far side
+    (link=CLIENT) does the opposite. Each direction is a CompressionStage , that flushes the codec at the end of
+    every chunk (the interactive traffic is not delayed).
+    The compression ratio of a session: session.c2s_stage.ratio() , s2c_stage.ratio() , compression_ratio (both
+    directions) , e.g. in the hooks' on_close. The factory sums the closed sessions' bytes.
+    The chunks that were not processed yet count in c2s_queued_bytes/s2c_queued_bytes (the watermarks apply),
+    and a graceful close waits for them.
+    NOTE: the Tornado engine only (the splice session never sees the data)
+    """
+    __slots__=("c2s_stage","s2c_stage")
+
+    def new_connection(self,stream,address,proxy):
+        compress_c2s=proxy.session_factory.link == SERVER
+        self.proxy=proxy
+        if getattr(self,"c2s_queued_data",None) is None:
+            # The stages watch the queues (Session.new_connection keeps them)
+            self.c2s_queued_data=maproxy.outputbuffer.OutputBuffer()
+            self.s2c_queued_data=maproxy.outputbuffer.OutputBuffer()
+        self.c2s_stage=CompressionStage(self,compress_c2s,self.p2s_start_write,self.p2s_start_close,
+                                        self.c2s_queued_data,self._c2s_queue_changed)
+        self.s2c_stage=CompressionStage(self,not compress_c2s,self.c2p_start_write,self.c2p_start_close,
+                                        self.s2c_queued_data,self._s2c_queue_changed)
+        super(CompressedSession,self).new_connection(stream,address,proxy)
+
+    def reset(self):
+        super(CompressedSession,self).reset()
+        self.c2s_stage=self.s2c_stage=None
+
+    @property
+    def compression_ratio(self):
+        raw=self.c2s_stage.raw_bytes+self.s2c_stage.raw_bytes
+        coded=self.c2s_stage.coded_bytes+self.s2c_stage.coded_bytes
+        return float(raw)/coded if coded else None
+
+    # The chunks that were not processed yet are queued as well
+    c2s_queued_bytes=property(lambda self: self.c2s_queued_data.nbytes+self.c2s_stage.pending_bytes)
+    s2c_queued_bytes=property(lambda self: self.s2c_queued_data.nbytes+self.s2c_stage.pending_bytes)
+
+    def on_c2p_done_read(self,data):
+        assert(self.c2p_reading)
+        self.c2s_stage.feed(data)
+
+    def on_p2s_done_read(self,data):
+        assert(self.p2s_reading)
+        self.s2c_stage.feed(data)
+
+    def _c2s_queue_changed(self):
+        super(CompressedSession,self)._c2s_queue_changed()
+        self.c2s_stage.resume()
+
+    def _s2c_queue_changed(self):
+        super(CompressedSession,self)._s2c_queue_changed()
+        self.s2c_stage.resume()
+
+    def c2p_start_close(self,gracefully=True):
+        if gracefully and self.s2c_stage.has_data():
+            # Close after the data that was not processed yet (see CompressionStage.run)
+            self.s2c_stage.close_pending=True
+            return
+        super(CompressedSession,self).c2p_start_close(gracefully)
+
+    def p2s_start_close(self,gracefully=True):
+        if gracefully and self.c2s_stage.has_data():
+            self.c2s_stage.close_pending=True
+            return
+        super(CompressedSession,self).p2s_start_close(gracefully)
+
+    def remove_session(self):
+        super(CompressedSession,self).remove_session()
+        if self.c2s_stage.session is None:
+            return  # Already removed
+        factory=self.proxy.session_factory
+        for stage in (self.c2s_stage,self.s2c_stage):
+            factory.raw_bytes+=stage.raw_bytes
+            factory.coded_bytes+=stage.coded_bytes
+            stage.detach()
+        logging.debug("maproxy: session %s compression ratio: c2s %s , s2c %s",self.session_id,
+                      self.c2s_stage.ratio(),self.s2c_stage.ratio())
+
+
+class CompressedSessionFactory(maproxy.session.SessionFactory):
+    """
+    Creates CompressedSession objects:
+        near side: ProxyServer(far_host,far_port,server_ssl_options=True,
+                               session_factory=CompressedSessionFactory(link=SERVER))
+        far side:  ProxyServer(target_host,target_port,client_ssl_options=ssl_certs,
+                               session_factory=CompressedSessionFactory(link=CLIENT))
+    """
+    session_class=CompressedSession
+
+    def __init__(self,link=SERVER,codec="zlib",level=None,executor=None,offload_size=16384,max_output=65536,
+                 pool_size=0):
+        """
+        Input Parameters:
+            link            : which side is the other maproxy: SERVER (we compress the client's data) or CLIENT
+                              (we compress the server's data)
+            codec           : the codec that we compress with (see CODECS: "zlib" , "zstd" with Python 3.14+ or
+                              the pyzstd package , and "lz4" if the lz4 package is installed)
+            level           : the codec's compression level (None: the codec's default)
+            executor        : a concurrent.futures.Executor (e.g. ThreadPoolExecutor) for the chunks of at least
+                              offload_size bytes (None: everything is processed on the IOLoop)
+            offload_size    : see executor
+            max_output      : the decompressed bytes per step (see CompressionStage)
+            pool_size       : see SessionFactory
+        """
+        super(CompressedSessionFactory,self).__init__(pool_size)
+        assert link in (CLIENT,SERVER) , "Unknown link: %s" % link
+        if codec not in CODECS:
+            raise CompressionError("Unknown (or not installed) codec: %s" % codec)
+        self.link=link
+        self.codec=codec
+        self.level=level
+        self.executor=executor
+        self.offload_size=offload_size
+        self.max_output=max_output
+        # The bytes (before/after the compression) of the closed sessions
+        self.raw_bytes=0
+        self.coded_bytes=0
+
+    def ratio(self):
+        return float(self.raw_bytes)/self.coded_bytes if self.coded_bytes else None
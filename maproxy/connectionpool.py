@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import time
+import select
+import collections
+import functools
+import tornado.ioloop
+
+
+
+class ConnectionPool(object):
+    """
+    Pool of "warm" Proxy->Server connections.
+    For each backend of the ProxyServer we keep up to "size" idle streams that are already connected
+    (and if the proxy connects with SSL - already handshaken) .
+    A new session takes a stream from the pool (instead of connecting), so the connect (and SSL handshake)
+    latency is not part of the session's setup. The pool refills itself in the background.
+    Sessions can also return idle connections to the pool (put) , e.g. the HTTP keep-alive connections of
+    maproxy.httpsession.HttpSession . The returned connections are reused first (up to max_idle per backend) .
+    Use size=0 for a pool of returned connections only (no pre-connected connections)
+    """
+    def __init__(self,size=4,retry_delay=1,max_idle=None):
+        """
+        Input Parameters:
+            size            : number of idle connections to keep per backend
+            retry_delay     : how long (seconds) to wait before we reconnect after a failed connect
+            max_idle        : maximum number of idle connections per backend, including the returned
+                              connections (default: max(size,16))
+        """
+        self.size=size
+        self.retry_delay=retry_delay
+        self.max_idle=max_idle if max_idle is not None else max(size,16)
+        self.proxy=None
+        self._idle={}               # backend -> deque of idle (connected) streams
+        self._connecting={}         # backend -> number of streams that are currently connecting
+        self._retry_handles={}      # backend -> pending retry timeout
+        self._returned=set()        # the idle streams that were returned by sessions (see put)
+        self._ioloop=None
+
+        # Counters
+        self.hits=0                 # Number of sessions that got a connection from the pool
+        self.misses=0               # Number of sessions that had to connect by themselves
+        self.returned=0             # Number of connections that were returned to the pool (see put)
+
+    def attach(self,proxy):
+        """
+        Called by the ProxyServer (every proxy needs its own ConnectionPool)
+        """
+        assert self.proxy is None , "The ConnectionPool is already attached to a proxy"
+        self.proxy=proxy
+
+    def start(self):
+        """
+        Start filling the pool (on the current IOLoop)
+        """
+        if self._ioloop is not None:
+            return
+        self._ioloop=tornado.ioloop.IOLoop.current()
+        for backend in self.proxy.backends:
+            self.fill(backend)
+
+    def stop(self):
+        """
+        Close all the idle connections, and stop refilling
+        """
+        if self._ioloop is None:
+            return
+        for handle in self._retry_handles.values():
+            self._ioloop.remove_timeout(handle)
+        self._retry_handles.clear()
+        self._ioloop=None
+        for streams in self._idle.values():
+            while streams:
+                stream=streams.popleft()
+                stream.set_close_callback(None)
+                stream.close()
+        self._returned.clear()
+
+    def get_idle_count(self,backend):
+        return len(self._idle.get(backend,()))
+
+    def get(self,backend):
+        """
+        Get a connected stream to the backend (or None if the pool is empty).
+        The caller owns the returned stream. We refill the pool in the background
+        """
+        streams=self._idle.get(backend)
+        stream=None
+        while streams:
+            stream=streams.popleft()
+            returned=stream in self._returned
+            self._returned.discard(stream)
+            if not stream.closed() and (not returned or ConnectionPool._is_idle(stream)):
+                break
+            stream.set_close_callback(None)
+            stream.close()
+            stream=None
+        if stream is None:
+            self.misses+=1
+        else:
+            self.hits+=1
+            stream.set_close_callback(None)
+        if self._ioloop is not None:
+            self._ioloop.add_callback(self.fill,backend)
+        return stream
+
+    def put(self,backend,stream):
+        """
+        Return a connected stream to the pool (the stream must be idle: no pending read or write, and nothing
+        that the server sent is left unread) . The stream is closed if the pool is stopped or full.
+        Returns True if the stream was kept
+        """
+        streams=self._idle.setdefault(backend,collections.deque())
+        if self._ioloop is None or stream.closed() or len(streams) >= self.max_idle:
+            stream.set_close_callback(None)
+            stream.close()
+            return False
+        self.returned+=1
+        self._returned.add(stream)
+        stream.set_close_callback(functools.partial(self._on_idle_close,backend,stream))
+        # The returned streams are reused first (the server is less likely to close them soon)
+        streams.appendleft(stream)
+        return True
+
+    @staticmethod
+    def _is_idle(stream):
+        """
+        A returned stream should not be readable: if it is, the server closed it (or sent something unexpected).
+        NOTE: we don't check the pre-connected streams (a server may send a banner , or TLS session tickets)
+        """
+        try:
+            if hasattr(select,"poll"):
+                poll=select.poll()
+                poll.register(stream.socket.fileno(),select.POLLIN)
+                return not poll.poll(0)
+            return not select.select([stream.socket],[],[],0)[0]
+        except (AttributeError,ValueError,OSError,select.error):
+            return False
+
+    def fill(self,backend):
+        """
+        Connect new streams to the backend, until we have "size" (idle + connecting) streams
+        """
+        if self._ioloop is None or backend in self._retry_handles:
+            return
+        streams=self._idle.setdefault(backend,collections.deque())
+        while len(streams) + self._connecting.get(backend,0) < self.size:
+            self._connect(backend)
+
+    def _connect(self,backend):
+        self._connecting[backend]=self._connecting.get(backend,0)+1
+        self.proxy.connect(backend,functools.partial(self._on_connected,backend))
+
+    def _on_connected(self,backend,stream):
+        if stream is None:
+            self._on_connect_failed(backend)
+            return
+        self._connecting[backend]-=1
+        if self.proxy.health_checker is not None:
+            self.proxy.health_checker.report_success(backend)
+        if self._ioloop is None:
+            # The pool was stopped while we were connecting
+            stream.set_close_callback(None)
+            stream.close()
+            return
+        # If the server closes the idle connection, simply drop it from the pool
+        stream.set_close_callback(functools.partial(self._on_idle_close,backend,stream))
+        self._idle[backend].append(stream)
+
+    def _on_connect_failed(self,backend):
+        self._connecting[backend]-=1
+        if self.proxy.health_checker is not None:
+            self.proxy.health_checker.report_failure(backend)
+        if self._ioloop is not None and backend not in self._retry_handles:
+            # Don't reconnect immediately (we don't want to flood a dead server)
+            self._retry_handles[backend]=self._ioloop.add_timeout(time.time()+self.retry_delay,
+                                                                  functools.partial(self._retry,backend))
+
+    def _retry(self,backend):
+        del self._retry_handles[backend]
+        self.fill(backend)
+
+    def _on_idle_close(self,backend,stream):
+        self._returned.discard(stream)
+        try:
+            self._idle[backend].remove(stream)
+        except ValueError:
+            pass
+        self.fill(backend)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import time
+import socket
+import collections
+import functools
+import tornado.ioloop
+import tornado.iostream
+
+
+
+class Connector(object):
+    """
+    Connects a new Proxy->Server stream to a backend:
+    - Resolve the backend's hostname (using the proxy's resolver, which is asynchronous and cached)
+    - Connect to the resolved addresses "happy-eyeballs" style (RFC 8305): the addresses are ordered by
+      alternating the address families (e.g. IPv6,IPv4,IPv6,...) and we start a new connection attempt every
+      ATTEMPT_DELAY seconds (or immediately when an attempt fails), until one of the attempts succeeds.
+      The first stream that is connected wins, all the other attempts are closed.
+    The callback gets the connected stream, or None if all the attempts failed (or the timeout expired).
+    """
+    # Delay (seconds) between the connection attempts
+    ATTEMPT_DELAY=0.25
+
+    def __init__(self,proxy,backend,callback,timeout=None):
+        self.proxy=proxy
+        self.backend=backend
+        self.callback=callback
+        self.timeout=timeout
+        self._timeout_handle=None
+        self._ioloop=tornado.ioloop.IOLoop.current()
+        self._addresses=collections.deque()     # addresses that we did not try yet
+        self._attempts=set()                    # streams that are currently connecting
+        self._timer=None
+        self._done=False
+
+    def start(self):
+        if self.timeout is not None:
+            self._timeout_handle=self._ioloop.add_timeout(time.time()+self.timeout,self._on_timeout)
+        self.proxy.resolver.resolve(self.backend.host,self.backend.port,self._on_resolved)
+
+    def close(self):
+        """
+        Cancel the connect (the callback will not be called)
+        """
+        self._done=True
+        self._cancel_attempts()
+
+    @staticmethod
+    def interleave(addresses):
+        """
+        Order the addresses by alternating the address families , starting with the first address' family
+        """
+        families=collections.OrderedDict()
+        for family,address in addresses:
+            families.setdefault(family,collections.deque()).append((family,address))
+        result=[]
+        while families:
+            for family in list(families):
+                queue=families[family]
+                result.append(queue.popleft())
+                if not queue:
+                    del families[family]
+        return result
+
+    def _on_resolved(self,addresses):
+        if self._done:
+            return
+        if not addresses:
+            self._finish(None)
+            return
+        self._addresses.extend(Connector.interleave(addresses))
+        self._next_attempt()
+
+    def _next_attempt(self):
+        self._timer=None
+        if self._done or not self._addresses:
+            return
+        family,address=self._addresses.popleft()
+        try:
+            stream=self.proxy.create_server_stream(self.backend,family)
+        except socket.error:
+            # e.g. IPv6 is not supported on this host. Try the next address
+            if self._addresses:
+                self._next_attempt()
+            elif not self._attempts:
+                self._finish(None)
+            return
+        self._attempts.add(stream)
+        stream.set_close_callback(functools.partial(self._on_attempt_failed,stream))
+        try:
+            stream.connect(address,functools.partial(self._on_attempt_connected,stream))
+        except tornado.iostream.StreamClosedError:
+            pass    # _on_attempt_failed will be called
+        if self._addresses:
+            self._timer=self._ioloop.add_timeout(time.time()+Connector.ATTEMPT_DELAY,self._next_attempt)
+
+    def _on_attempt_connected(self,stream):
+        if self._done:
+            return
+        self._attempts.discard(stream)
+        stream.set_close_callback(None)
+        self._finish(stream)
+
+    def _on_attempt_failed(self,stream):
+        self._attempts.discard(stream)
+        if self._done:
+            return
+        if self._addresses:
+            # Don't wait for the delay, try the next address now
+            if self._timer is not None:
+                self._ioloop.remove_timeout(self._timer)
+            self._next_attempt()
+        elif not self._attempts:
+            self._finish(None)
+
+    def _on_timeout(self):
+        self._timeout_handle=None
+        if not self._done:
+            self._finish(None)
+
+    def _cancel_attempts(self):
+        if self._timeout_handle is not None:
+            self._ioloop.remove_timeout(self._timeout_handle)
+            self._timeout_handle=None
+        if self._timer is not None:
+            self._ioloop.remove_timeout(self._timer)
+            self._timer=None
+        for stream in self._attempts:
+            stream.set_close_callback(None)
+            stream.close()
+        self._attempts.clear()
+
+    def _finish(self,stream):
+        self._done=True
+        self._cancel_attempts()
+        self.callback(stream)
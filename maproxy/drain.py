@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import time
+import concurrent.futures
+import tornado.ioloop
+import maproxy.hooks
+
+
+
+# The phases of a drain (in order)
+STOP_ACCEPTING="stop_accepting"         # The servers don't accept new connections
+CLOSE_IDLE="close_idle"                 # The idle sessions are closed (gracefully)
+CLOSE_HALF_CLOSED="close_half_closed"   # The half-closed sessions are closed (gracefully) as well
+FORCE="force"                           # The deadline passed: the remaining sessions are closed with a RST
+DONE="done"                             # No more sessions
+PHASES=(STOP_ACCEPTING,CLOSE_IDLE,CLOSE_HALF_CLOSED,FORCE,DONE)
+
+
+class Drain(object):
+    """
+    The graceful stop of servers (see IOManager.stop) . Once the servers stopped listening (start() is called
+    after that), the drain goes through the phases:
+        STOP_ACCEPTING    : the sessions are left alone, and we note how many bytes each one transferred
+        CLOSE_IDLE        : every idle_time seconds, the sessions that didn't transfer anything since the last
+                            check (and have nothing queued) are closed gracefully
+        CLOSE_HALF_CLOSED : from the second check on, the half-closed sessions (one side already closed) are
+                            closed as well (the data that is queued to the open side is sent first)
+        FORCE             : the deadline ("timeout" seconds after the start) passed: the remaining sessions are
+                            closed with a RST (never , if timeout is None)
+        DONE              : all the servers are empty (or FORCE closed the rest)
+    The drain doesn't poll the connections count: every server's SessionTable tells us when it becomes empty.
+    Progress:
+    - add_callback(callback): callback(drain) is called (on the IOLoop) when a phase starts
+    - future(phase): a concurrent.futures.Future that is resolved (with the drain) when the phase starts, or when
+      the drain is done without it. Any thread can wait on it (drain.done is the future of DONE)
+    - drain.phase , remaining() and the counters closed_idle , closed_half_closed , forced
+    """
+    def __init__(self,servers,timeout=None,idle_time=1.0,callback=None):
+        """
+        Input Parameters:
+            servers     : the servers (ProxyServer) that we drain
+            timeout     : seconds until we close the remaining sessions with a RST (None: wait forever)
+            idle_time   : how often (seconds) we look for idle and half-closed sessions
+            callback    : callback(drain) on every phase (see add_callback)
+        """
+        self.servers=[server for server in servers if hasattr(server,"sessions")]
+        self.timeout=timeout
+        self.idle_time=idle_time
+        self.phase=None
+        self.start_time=None
+        self.closed_idle=0
+        self.closed_half_closed=0
+        self.forced=0
+        self._callbacks=(callback,) if callback is not None else ()
+        self._futures=dict((phase,concurrent.futures.Future()) for phase in PHASES)
+        self.done=self._futures[DONE]
+        self._pending=0
+        self._transferred={}        # session->bytes (both directions) at the last check
+        self._closing=set()         # the sessions that we already closed gracefully
+        self._check_timeout=None
+        self._deadline_timeout=None
+
+    def add_callback(self,callback):
+        """
+        callback(drain) is called (on the IOLoop) when a phase starts
+        """
+        self._callbacks+=(callback,)
+
+    def future(self,phase=DONE):
+        return self._futures[phase]
+
+    def remaining(self):
+        """
+        The number of sessions that are still open
+        """
+        return sum(len(server.sessions) for server in self.servers)
+
+    ###########
+    ## Start ##
+    ###########
+    def start(self):
+        """
+        Start draining (on the IOLoop , after the servers stopped listening)
+        """
+        self.start_time=time.time()
+        self._set_phase(STOP_ACCEPTING)
+        for server in self.servers:
+            if len(server.sessions):
+                self._pending+=1
+                server.sessions.when_empty(self._on_server_empty)
+        if not self._pending:
+            self._finish()
+            return
+        self._transferred=self._sample()
+        ioloop=tornado.ioloop.IOLoop.current()
+        if self.timeout is not None:
+            self._deadline_timeout=ioloop.add_timeout(self.start_time+self.timeout,self._on_deadline)
+        self._check_timeout=ioloop.add_timeout(self.start_time+self.idle_time,self._on_check)
+
+    def _set_phase(self,phase):
+        self.phase=phase
+        if self._callbacks:
+            maproxy.hooks.run(self._callbacks,self)
+        future=self._futures[phase]
+        if not future.done():
+            future.set_result(self)
+
+    def _sessions(self):
+        for server in self.servers:
+            for session in server.sessions:
+                yield session
+
+    def _sample(self):
+        return dict((session,session.c2s_bytes+session.s2c_bytes) for session in self._sessions())
+
+    ############
+    ## Checks ##
+    ############
+    @staticmethod
+    def _is_quiet(session):
+        """
+        Nothing is being written , and nothing is queued
+        """
+        return not (session.c2p_writing or session.p2s_writing or session.c2s_queued_data or session.s2c_queued_data)
+
+    def _on_check(self):
+        self._check_timeout=None
+        if self.phase == STOP_ACCEPTING:
+            self._set_phase(CLOSE_IDLE)
+        elif self.phase == CLOSE_IDLE:
+            self._set_phase(CLOSE_HALF_CLOSED)
+        close_half_closed=self.phase != CLOSE_IDLE
+        transferred=self._transferred
+        for session in self._sessions():
+            if session in self._closing:
+                continue
+            if close_half_closed and session.half_closed_time is not None:
+                self.closed_half_closed+=1
+            elif transferred.get(session) == session.c2s_bytes+session.s2c_bytes and Drain._is_quiet(session):
+                self.closed_idle+=1
+            else:
+                continue
+            self._closing.add(session)
+            session.c2p_start_close(gracefully=True)
+            session.p2s_start_close(gracefully=True)
+        if not self._pending:
+            return  # The last sessions were closed right away
+        self._transferred=self._sample()
+        self._check_timeout=tornado.ioloop.IOLoop.current().add_timeout(time.time()+self.idle_time,self._on_check)
+
+    def _on_deadline(self):
+        self._deadline_timeout=None
+        self._set_phase(FORCE)
+        for session in self._sessions():
+            self.forced+=1
+            session.abort()
+
+    #########
+    ## End ##
+    #########
+    def _on_server_empty(self):
+        self._pending-=1
+        if not self._pending:
+            # Not in the middle of the last session's close
+            tornado.ioloop.IOLoop.current().add_callback(self._finish)
+
+    def _finish(self):
+        ioloop=tornado.ioloop.IOLoop.current()
+        for timeout in (self._check_timeout,self._deadline_timeout):
+            if timeout is not None:
+                ioloop.remove_timeout(timeout)
+        self._check_timeout=self._deadline_timeout=None
+        self._transferred={}
+        self._closing=set()
+        self._set_phase(DONE)
+        # The phases that we skipped
+        for future in self._futures.values():
+            if not future.done():
+                future.set_result(self)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import os
+import time
+import json
+import array
+import errno
+import socket
+import struct
+import logging
+import threading
+import concurrent.futures
+
+
+
+# Maximum number of listening sockets that we pass in one handoff
+MAX_FDS=256
+
+
+class HandoffError(Exception):
+    pass
+
+
+def send_listeners(conn,listeners):
+    """
+    Send listening sockets over a connected Unix socket (SCM_RIGHTS) , with a JSON header that describes them.
+        listeners   : [(server_index,sock),...]
+    """
+    assert len(listeners) <= MAX_FDS , "Too many listeners (%d)" % len(listeners)
+    header=json.dumps({"pid":os.getpid(),
+                       "listeners":[[index,sock.family,sock.getsockname()] for index,sock in listeners]}).encode()
+    fds=array.array("i",[sock.fileno() for index,sock in listeners])
+    conn.sendmsg([struct.pack("!I",len(header))+header],[(socket.SOL_SOCKET,socket.SCM_RIGHTS,fds)])
+
+
+def receive_listeners(conn):
+    """
+    Receive the listening sockets that send_listeners sent. Returns (header,[(server_index,sock),...])
+    """
+    data,ancdata,flags,address=conn.recvmsg(65536,socket.CMSG_LEN(MAX_FDS*array.array("i").itemsize))
+    fds=array.array("i")
+    for level,type,cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data)-(len(cmsg_data)%fds.itemsize)])
+    sockets=[socket.socket(fileno=fd) for fd in fds]
+    try:
+        if flags & getattr(socket,"MSG_CTRUNC",0):
+            raise HandoffError("The listening sockets were truncated")
+        while len(data) < 4:
+            data+=_recv(conn)
+        size=struct.unpack("!I",data[:4])[0]
+        while len(data) < 4+size:
+            data+=_recv(conn)
+        header=json.loads(data[4:4+size].decode())
+        if len(header["listeners"]) != len(sockets):
+            raise HandoffError("Expected %d listening sockets, got %d" % (len(header["listeners"]),len(sockets)))
+    except:
+        for sock in sockets:
+            sock.close()
+        raise
+    return header,[(listener[0],sock) for listener,sock in zip(header["listeners"],sockets)]
+
+
+def _recv(conn):
+    data=conn.recv(65536)
+    if not data:
+        raise HandoffError("The connection was closed")
+    return data
+
+
+class HandoffServer(object):
+    """
+    The old process's side of a zero-downtime restart (see IOManager.serve_handoff):
+    listens on a Unix socket, and when the new process connects (IOManager.adopt_listeners) it sends the
+    listening sockets of all the IOManager's servers (SCM_RIGHTS) . Once the new process confirms that it adopted
+    them, the IOManager stops accepting and drains its sessions (IOManager.stop with "gracefully").
+    The kernel keeps the listening sockets open while the new process holds them, so the connections that arrive
+    during the restart wait in the accept queue instead of being refused.
+    If the new process does not confirm (it crashed , or timed out), we keep serving and wait for another attempt.
+    The exchange runs on its own thread (the IOLoop is not blocked) . Progress:
+    - handed_off: a concurrent.futures.Future that is resolved (with the maproxy.drain.Drain , or None in the
+      multi-process mode) when the new process has the sockets and the drain started
+    """
+    def __init__(self,iomanager,path,gracefully=True,idle_time=1.0,callback=None,timeout=10):
+        """
+        Input Parameters:
+            iomanager   : the IOManager
+            path        : the Unix socket's path (its directory should be accessible only to the proxy's user)
+            gracefully  : how to stop after the handoff (same as IOManager.stop's gracefully)
+            idle_time   : see IOManager.stop
+            callback    : see IOManager.stop (callback(drain) on every phase of the drain)
+            timeout     : seconds that we wait for the new process to confirm
+        """
+        self.iomanager=iomanager
+        self.path=path
+        self.gracefully=gracefully
+        self.idle_time=idle_time
+        self.callback=callback
+        self.timeout=timeout
+        self.handed_off=concurrent.futures.Future()
+        self._closed=False
+        self._listener=None
+        self._thread=None
+
+    def start(self):
+        self._listen()
+        self._thread=threading.Thread(target=self._run,name="maproxy-handoff")
+        self._thread.daemon=True
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop waiting for a new process (can be called from any thread)
+        """
+        self._closed=True
+        self._unlisten()
+
+    def _listen(self):
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        listener=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path,0o600)
+        listener.listen(1)
+        listener.settimeout(0.5)    # So we notice close()
+        self._listener=listener
+
+    def _unlisten(self):
+        listener,self._listener=self._listener,None
+        if listener is None:
+            return
+        listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self._closed:
+            listener=self._listener
+            if listener is None:
+                # A handoff failed, wait for another attempt
+                try:
+                    self._listen()
+                except (OSError,socket.error):
+                    logging.exception("maproxy: could not listen on %s",self.path)
+                    return
+                continue
+            try:
+                conn,address=listener.accept()
+            except socket.timeout:
+                continue
+            except (OSError,socket.error):
+                if not self._closed:
+                    logging.exception("maproxy: the handoff listener failed")
+                return
+            # One handoff at a time: the path is released, so the new process can serve the next handoff
+            self._unlisten()
+            try:
+                if self._handoff(conn):
+                    return
+            except Exception:
+                logging.exception("maproxy: the listeners handoff failed")
+            finally:
+                conn.close()
+
+    def _handoff(self,conn):
+        """
+        Send the listening sockets, and stop (gracefully) once the new process confirms. Returns True if it did
+        """
+        conn.settimeout(self.timeout)
+        listeners=[]
+        for index,server in enumerate(self.iomanager._servers.values()):
+            for sock in list(server._sockets.values())+list(server._pending_sockets):
+                listeners.append((index,sock))
+        if not listeners:
+            # Nothing to pass (e.g. the workers bind their own sockets): stopping would refuse the connections
+            raise HandoffError("No listening sockets to hand off")
+        send_listeners(conn,listeners)
+        reply=b""
+        while not reply.endswith(b"\n"):
+            data=conn.recv(1024)
+            if not data:
+                break
+            reply+=data
+        if reply.strip() != b"OK":
+            logging.warning("maproxy: the new process did not adopt the listeners (%r), we keep serving",reply)
+            return False
+        logging.info("maproxy: %d listening sockets were handed off, draining",len(listeners))
+        if self.iomanager._workers is not None:
+            # Multi-process mode: the parent has no IOLoop running , stop() only signals the workers
+            self.iomanager.stop(gracefully=self.gracefully)
+            self.handed_off.set_result(None)
+        else:
+            def stop():
+                drain=self.iomanager.stop(gracefully=self.gracefully,idle_time=self.idle_time,
+                                          callback=self.callback)
+                self.handed_off.set_result(drain)
+            self.iomanager.ioloop().add_callback(stop)
+        self._closed=True
+        return True
+
+
+def adopt_listeners(iomanager,path,timeout=10,retry=0):
+    """
+    The new process's side of a zero-downtime restart (see IOManager.adopt_listeners): connect to the old
+    process's HandoffServer , receive its listening sockets and give each server (by its index in the IOManager)
+    its sockets. Returns the number of adopted sockets
+        retry   : seconds to keep trying to connect (e.g. the old process is still starting its HandoffServer)
+    """
+    deadline=time.time()+retry
+    while True:
+        conn=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        conn.settimeout(timeout)
+        try:
+            conn.connect(path)
+            break
+        except (OSError,socket.error):
+            conn.close()
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.1)
+    try:
+        header,listeners=receive_listeners(conn)
+        servers=list(iomanager._servers.values())
+        adopted=0
+        for index,sock in listeners:
+            if index >= len(servers):
+                logging.warning("maproxy: no server #%d for the listening socket %s , closing it",index,
+                                sock.getsockname())
+                sock.close()
+                continue
+            sock.setblocking(False)
+            # Same as TCPServer.bind(): start() adds the pending sockets to the IOLoop
+            servers[index]._pending_sockets.append(sock)
+            adopted+=1
+        conn.sendall(b"OK\n")
+    finally:
+        conn.close()
+    logging.info("maproxy: adopted %d listening sockets from process %s",adopted,header.get("pid"))
+    return adopted
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import time
+import errno
+import logging
+import tornado.ioloop
+
+
+
+class HealthChecker(object):
+    """
+    Health-checking of the ProxyServer's backends.
+    - Passive checks: the sessions report every failed connect (and every connection-reset) to the checker
+    - Active checks (optional): every "interval" seconds we probe each backend with a TCP connect (or a full
+      SSL handshake, if the proxy connects to the servers with SSL)
+    When a backend has "failures_threshold" consecutive failures, it is ejected: the balancer will not select it.
+    The backend is re-admitted after a back-off time (eject_time , doubled for each consecutive ejection, up to
+    max_eject_time), or as soon as an active probe succeeds .
+    """
+    def __init__(self,failures_threshold=3,eject_time=10,max_eject_time=300,
+                 interval=None,timeout=3):
+        """
+        Input Parameters:
+            failures_threshold  : number of consecutive failures that ejects the backend
+            eject_time          : first ejection period (seconds)
+            max_eject_time      : maximum ejection period (seconds)
+            interval            : active checks interval (seconds). None means passive checks only
+            timeout             : active checks (connect/handshake) timeout (seconds)
+        """
+        self.failures_threshold=failures_threshold
+        self.eject_time=eject_time
+        self.max_eject_time=max_eject_time
+        self.interval=interval
+        self.timeout=timeout
+        self.proxy=None
+        self._periodic_callback=None
+
+    def attach(self,proxy):
+        """
+        Called by the ProxyServer (every proxy needs its own HealthChecker)
+        """
+        assert self.proxy is None , "The HealthChecker is already attached to a proxy"
+        self.proxy=proxy
+
+    def start(self):
+        """
+        Start the active checks (if configured) on the current IOLoop
+        """
+        if self.interval is None or self._periodic_callback is not None:
+            return
+        self._periodic_callback=tornado.ioloop.PeriodicCallback(self.check_all,self.interval*1000)
+        self._periodic_callback.start()
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback=None
+
+    def available_backends(self,backends):
+        """
+        Return the backends that are not ejected
+        """
+        now=time.time()
+        return [backend for backend in backends if backend.ejected_until <= now]
+
+    #####################
+    ## Failure/Success ##
+    #####################
+    def report_failure(self,backend):
+        """
+        The backend failed (failed connect, connection-reset, or a failed probe)
+        """
+        backend.consecutive_failures+=1
+        if backend.consecutive_failures < self.failures_threshold:
+            return
+        now=time.time()
+        if backend.ejected_until > now:
+            return  # Already ejected
+        eject_time=min(self.eject_time * 2**backend.ejections , self.max_eject_time)
+        backend.ejections+=1
+        backend.total_ejections+=1
+        backend.ejected_until=now+eject_time
+        # When it's re-admitted, a single failure ejects the backend again (for a longer period)
+        backend.consecutive_failures=self.failures_threshold-1
+        logging.warning("Backend %s:%s ejected for %d seconds",backend.host,backend.port,eject_time)
+
+    def report_success(self,backend):
+        """
+        We have successfully connected to the backend
+        """
+        if backend.ejected_until:
+            logging.warning("Backend %s:%s re-admitted",backend.host,backend.port)
+        backend.consecutive_failures=0
+        backend.ejections=0
+        backend.ejected_until=0
+
+    ###################
+    ## Active Checks ##
+    ###################
+    def check_all(self):
+        for backend in self.proxy.backends:
+            self.check(backend)
+
+    def check(self,backend):
+        """
+        Probe the backend: connect (and perform SSL handshake if the proxy connects to the servers with SSL)
+        """
+        ioloop=tornado.ioloop.IOLoop.current()
+
+        def done(stream):
+            ioloop.remove_timeout(timeout_handle)
+            if stream is not None:
+                stream.close()
+                self.report_success(backend)
+            else:
+                self.report_failure(backend)
+
+        def timeout():
+            connector.close()
+            self.report_failure(backend)
+
+        timeout_handle=ioloop.add_timeout(time.time()+self.timeout,timeout)
+        connector=self.proxy.connect(backend,done)
+
+
+def is_connection_reset(stream):
+    """
+    Whether the stream was closed because of a connection-reset
+    """
+    return getattr(stream.error,"errno",None) == errno.ECONNRESET
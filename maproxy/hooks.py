@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import logging
+
+
+
+# The direction of the data (see on_data)
+C2S="c2s"       # From the client to the server
+S2C="s2c"       # From the server to the client
+
+
+class Hooks(object):
+    """
+    The event hooks of a ProxyServer (proxy.hooks) . Register a callback for an event, and the sessions call it:
+        on_session_open(session)           : a client connected (session.session_id and c2p_address are set)
+        on_connect(session)                 : the session is connected to its backend (session.backend)
+        on_connect_failure(session,backend) : the session could not connect to the backend (it may retry)
+        on_data(session,direction,data)     : data was read from the client (direction is C2S) or from the
+                                              server (S2C). data is a memoryview , valid only during the call
+                                              (copy it with bytes(data) to keep it). The data was already passed
+                                              to the other side. Not called by SpliceSession (the data never gets
+                                              to Python)
+        on_close(session)                   : the session was removed (both sides are closed)
+    The callbacks of each event are kept in a tuple (e.g. hooks.on_data) , so an event without callbacks costs
+    one attribute lookup , and the callbacks can be added/removed at any time (even from a callback).
+    An exception in a callback is logged, and does not affect the session
+    """
+    EVENTS=("on_session_open","on_connect","on_connect_failure","on_data","on_close")
+
+    def __init__(self):
+        for event in Hooks.EVENTS:
+            setattr(self,event,())
+
+    def add(self,event,callback):
+        """
+        Register callback for the event . Returns the callback
+        """
+        assert event in Hooks.EVENTS , "Unknown event: %s" % event
+        setattr(self,event,getattr(self,event)+(callback,))
+        return callback
+
+    def remove(self,event,callback):
+        """
+        Unregister callback (does nothing if it's not registered)
+        """
+        assert event in Hooks.EVENTS , "Unknown event: %s" % event
+        setattr(self,event,tuple(hook for hook in getattr(self,event) if hook != callback))
+
+    def clear(self,event=None):
+        """
+        Unregister all the callbacks of the event (or of all the events)
+        """
+        for name in (event,) if event is not None else Hooks.EVENTS:
+            setattr(self,name,())
+
+
+def run(hooks,*args):
+    """
+    Call the hooks (a tuple of callbacks) with args. The caller checks first that there are hooks, so an
+    event without hooks doesn't even build the arguments
+    """
+    for hook in hooks:
+        try:
+            hook(*args)
+        except Exception:
+            logging.exception("maproxy: hook %r failed" % (hook,))
+
+
+class EventLogger(object):
+    """
+    Logs the sessions' events (replaces the Session.LoggerOptions flags). attach() it to a proxy to start
+    logging, and detach() it to stop (at any time)
+    """
+    def __init__(self,data=False,max_data=64,logger=None,level=logging.DEBUG):
+        """
+        Input Parameters:
+            data        : log the data events as well (the size, and the first max_data bytes)
+            max_data    : the number of bytes of each data event that we log
+            logger      : logging.Logger (default: the "maproxy.session" logger)
+            level       : the logging level
+        """
+        self.data=data
+        self.max_data=max_data
+        self.logger=logger if logger is not None else logging.getLogger("maproxy.session")
+        self.level=level
+
+    def _events(self):
+        events=[("on_session_open",self.on_session_open),("on_connect",self.on_connect),
+                ("on_connect_failure",self.on_connect_failure),("on_close",self.on_close)]
+        if self.data:
+            events.append(("on_data",self.on_data))
+        return events
+
+    def attach(self,proxy):
+        for event,callback in self._events():
+            proxy.hooks.add(event,callback)
+
+    def detach(self,proxy):
+        for event,callback in self._events():
+            proxy.hooks.remove(event,callback)
+
+    def on_session_open(self,session):
+        self.logger.log(self.level,"%s: New session from %s",session.session_id,session.c2p_address)
+
+    def on_connect(self,session):
+        self.logger.log(self.level,"%s: Connected to %s",session.session_id,session.backend)
+
+    def on_connect_failure(self,session,backend):
+        self.logger.log(self.level,"%s: Could not connect to %s",session.session_id,backend)
+
+    def on_data(self,session,direction,data):
+        self.logger.log(self.level,"%s: %s %d bytes: %r",session.session_id,direction,len(data),
+                        bytes(data[:self.max_data]))
+
+    def on_close(self,session):
+        self.logger.log(self.level,"%s: Session closed (%d bytes from the client, %d bytes from the server)",
+                        session.session_id,session.c2s_bytes,session.s2c_bytes)
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+import maproxy.session
+
+
+
+class HttpError(Exception):
+    pass
+
+
+class HttpParser(object):
+    """
+    Incremental HTTP/1.x message framing: we don't parse the whole message, we only need to know where each message
+    ends (the head , and the body's Content-Length or chunked encoding) and whether the connection can be kept alive.
+    feed() is called with every chunk that was read, and returns the offset where the current message ends.
+    The data is never copied, except for the message's head (and the chunk-size lines)
+    """
+    HEAD,BODY,CHUNK_SIZE,CHUNK_DATA,CHUNK_END,TRAILERS,UNTIL_CLOSE,DONE=range(8)
+
+    # Maximum size of a message's head (and of a chunk-size/trailer line)
+    MAX_HEAD_SIZE=65536
+
+    __slots__=("is_request","state","started","head","line","remaining","method","status","keep_alive","upgrade")
+
+    def __init__(self,is_request):
+        """
+        Input Parameters:
+            is_request  : True for the requests (client->server) , False for the responses
+        """
+        self.is_request=is_request
+        self.method=None
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new message (a response parser keeps the method of its request , see HttpSession)
+        """
+        self.state=HttpParser.HEAD
+        self.started=False      # Did we get the first byte of the message
+        self.head=bytearray()
+        self.line=bytearray()
+        self.remaining=0        # Bytes left in the body (or in the chunk)
+        self.status=None
+        self.keep_alive=True
+        self.upgrade=False
+        if self.is_request:
+            self.method=None
+
+    def interim(self):
+        """
+        The (complete) response is an interim response (1xx , except 101): the final response follows
+        """
+        return self.status is not None and 100 <= self.status < 200 and self.status != 101
+
+    def feed(self,data,pos=0):
+        """
+        Parse data[pos:] . Returns the offset where the current message ends (len(data) if it doesn't end in this
+        data) . Raises HttpError if the data is not a valid HTTP/1.x message
+        """
+        end=len(data)
+        while pos < end:
+            state=self.state
+            if state == HttpParser.HEAD:
+                if not self.started:
+                    # Skip the empty lines before a message (RFC 9112, 2.2)
+                    while pos < end and data[pos] in b"\r\n":
+                        pos+=1
+                    if pos == end:
+                        break
+                    self.started=True
+                pos=self._feed_head(data,pos)
+            elif state == HttpParser.BODY or state == HttpParser.CHUNK_DATA:
+                n=min(self.remaining,end-pos)
+                self.remaining-=n
+                pos+=n
+                if not self.remaining:
+                    self.state=HttpParser.DONE if state == HttpParser.BODY else HttpParser.CHUNK_END
+            elif state == HttpParser.UNTIL_CLOSE:
+                pos=end
+            elif state == HttpParser.DONE:
+                break
+            else:
+                pos,line=self._feed_line(data,pos)
+                if line is not None:
+                    self._on_line(line)
+        return pos
+
+    ##########
+    ## Head ##
+    ##########
+    def _feed_head(self,data,pos):
+        head=self.head
+        start=max(0,len(head)-3)
+        head+=data[pos:]
+        index=head.find(b"\r\n\r\n",start)
+        if index < 0:
+            if len(head) > HttpParser.MAX_HEAD_SIZE:
+                raise HttpError("The message's head is too long")
+            return len(data)
+        head_end=index+4
+        # The rest of the data (after the head) is not part of the head
+        pos=len(data)-(len(head)-head_end)
+        self.head=bytearray()
+        self._parse_head(bytes(head[:head_end-4]))
+        return pos
+
+    def _parse_head(self,head):
+        lines=head.split(b"\r\n")
+        start_line=lines[0].split(b" ",2)
+        if len(start_line) < 2:
+            raise HttpError("Invalid start-line: %r" % lines[0][:100])
+        if self.is_request:
+            if len(start_line) != 3:
+                raise HttpError("Invalid request-line: %r" % lines[0][:100])
+            self.method,version=start_line[0],start_line[2]
+        else:
+            version=start_line[0]
+            try:
+                self.status=int(start_line[1])
+            except ValueError:
+                raise HttpError("Invalid status-line: %r" % lines[0][:100])
+        if version not in (b"HTTP/1.1",b"HTTP/1.0"):
+            raise HttpError("Unsupported version: %r" % version[:20])
+
+        content_length=None
+        transfer_encoding=None
+        connection=set()
+        for line in lines[1:]:
+            name,sep,value=line.partition(b":")
+            if not sep:
+                raise HttpError("Invalid header: %r" % line[:100])
+            name=name.strip().lower()
+            value=value.strip()
+            if name == b"content-length":
+                if content_length is not None and content_length != value:
+                    raise HttpError("Conflicting Content-Length headers")
+                content_length=value
+            elif name == b"transfer-encoding":
+                transfer_encoding=value.lower() if transfer_encoding is None else transfer_encoding+b","+value.lower()
+            elif name == b"connection":
+                connection.update(token.strip() for token in value.lower().split(b","))
+
+        if version == b"HTTP/1.1":
+            self.keep_alive=b"close" not in connection
+        else:
+            self.keep_alive=b"keep-alive" in connection
+        self.upgrade=b"upgrade" in connection
+
+        # The body
+        if not self.is_request and (self.method == b"HEAD" or self.interim() or self.status in (204,304)):
+            self.state=HttpParser.DONE
+        elif not self.is_request and (self.status == 101 or (self.method == b"CONNECT" and 200 <= self.status < 300)):
+            # The connection becomes a tunnel
+            self.keep_alive=False
+            self.state=HttpParser.UNTIL_CLOSE
+        elif transfer_encoding is not None:
+            if transfer_encoding.rsplit(b",",1)[-1].strip() == b"chunked":
+                self.state=HttpParser.CHUNK_SIZE
+            elif self.is_request:
+                raise HttpError("A request's Transfer-Encoding must end with chunked")
+            else:
+                self.state=HttpParser.UNTIL_CLOSE
+            if content_length is not None:
+                # Both headers: the Transfer-Encoding wins, and the connection must be closed (RFC 9112, 6.3)
+                self.keep_alive=False
+        elif content_length is not None:
+            if not content_length.isdigit():
+                raise HttpError("Invalid Content-Length: %r" % content_length[:20])
+            self.remaining=int(content_length)
+            self.state=HttpParser.BODY if self.remaining else HttpParser.DONE
+        elif self.is_request:
+            self.state=HttpParser.DONE
+        else:
+            self.state=HttpParser.UNTIL_CLOSE
+        if self.state == HttpParser.UNTIL_CLOSE:
+            self.keep_alive=False
+
+    #############
+    ## Chunked ##
+    #############
+    def _feed_line(self,data,pos):
+        """
+        Returns (the offset after the line , the line) , or (len(data),None) if the line is not complete
+        """
+        index=data.find(b"\n",pos)
+        if index < 0:
+            self.line+=data[pos:]
+            if len(self.line) > HttpParser.MAX_HEAD_SIZE:
+                raise HttpError("A chunk line is too long")
+            return len(data),None
+        line=bytes(self.line+data[pos:index]) if self.line else bytes(data[pos:index])
+        self.line=bytearray()
+        return index+1,line.rstrip(b"\r")
+
+    def _on_line(self,line):
+        state=self.state
+        if state == HttpParser.CHUNK_SIZE:
+            try:
+                size=int(line.split(b";",1)[0].strip(),16)
+            except ValueError:
+                raise HttpError("Invalid chunk-size: %r" % line[:20])
+            if size:
+                self.remaining=size
+                self.state=HttpParser.CHUNK_DATA
+            else:
+                self.state=HttpParser.TRAILERS
+        elif state == HttpParser.CHUNK_END:
+            if line:
+                raise HttpError("Missing CRLF after a chunk")
+            self.state=HttpParser.CHUNK_SIZE
+        elif state == HttpParser.TRAILERS:
+            if not line:
+                self.state=HttpParser.DONE
+
+
+class HttpSession(maproxy.session.Session):
+    """
+    HTTP/1.1 session (L7) with keep-alive connections to the servers.
+    The session follows the framing of the requests and the responses (Content-Length / chunked) , and once a
+    response is complete, it returns the Proxy->Server connection to the proxy's connection-pool
+    (maproxy.connectionpool.ConnectionPool , e.g. ConnectionPool(size=0) for the returned connections only) .
+    The client's next request takes a connection from the pool (of the backend that the balancer selects for that
+    request) , so many short client connections share a few warm server connections.
+    - The data is forwarded as it arrives (the messages are not buffered) . A pipelined request waits (we stop
+      reading from the client) until the previous response is complete
+    - The server connection is reused only when both the request and the response allow it (HTTP/1.1 or
+      keep-alive, no "Connection: close") and the response is complete when the request was fully sent
+    - Otherwise the session becomes a regular (L4) session for the rest of its life ("tunnel") , the same as for
+      upgrades (101) , CONNECT , responses without a length (until the server closes) and data that is not HTTP/1.x
+    - If the server closes its connection after a complete response, the client's connection goes on
+    - The hooks' on_connect is called for every server connection (pooled or new)
+    NOTE: the Tornado engine only (the connection-pool is not supported by the asyncio engine and the splice
+          session never sees the data) . A request that was sent on a pooled connection that the server closed
+          at the same time is not retried (the client gets the close)
+    """
+    __slots__=("http_request","http_response","http_tunnel","http_hold","http_pending","http_release",
+               "http_requests")
+
+    def new_connection(self,stream,address,proxy):
+        self.http_request=HttpParser(True)
+        self.http_response=HttpParser(False)
+        self.http_tunnel=False      # Forward the data as is (L4) from now on
+        self.http_hold=False        # Don't read from the client (a pipelined request waits for the response)
+        self.http_pending=None      # Data that we read from the client while http_hold (bytearray)
+        self.http_release=False     # The response is complete: release the server connection (see p2s_start_read)
+        self.http_requests=0        # Number of requests that were completed on this session
+        super(HttpSession,self).new_connection(stream,address,proxy)
+
+    def reset(self):
+        super(HttpSession,self).reset()
+        self.http_request=self.http_response=self.http_pending=None
+
+    def _p2s_connect(self):
+        if not self.http_request.started and not self.http_tunnel:
+            return  # We connect when the first request starts (see _http_connect)
+        super(HttpSession,self)._p2s_connect()
+
+    def _http_connect(self):
+        """
+        A request starts: make sure that we have a server connection (or that we're connecting)
+        """
+        if self.p2s_stream is not None or self.p2s_connector is not None or self.p2s_retry_timeout is not None:
+            return
+        if self.http_requests:
+            # Each request selects its backend
+            self.proxy.release_backend(self.backend)
+            self.backend=self.proxy.select_backend(self)
+            self.p2s_failed_backends=None
+        self._p2s_connect()
+
+    def _http_idle(self):
+        """
+        Between requests: no server connection , and nothing to send
+        """
+        return self.p2s_state == maproxy.session.Session.State.CONNECTING and self.p2s_stream is None and \
+               self.p2s_connector is None and self.p2s_retry_timeout is None and not self.c2s_queued_data
+
+    #################
+    ## Client Data ##
+    #################
+    def c2p_start_read(self):
+        if self.http_hold:
+            return
+        super(HttpSession,self).c2p_start_read()
+
+    def on_c2p_done_read(self,data):
+        if self.http_tunnel:
+            super(HttpSession,self).on_c2p_done_read(data)
+            return
+        assert(self.c2p_reading)
+        self._http_client_data(data)
+
+    def _http_client_data(self,data):
+        request=self.http_request
+        pos=0
+        while pos < len(data):
+            if request.state == HttpParser.DONE:
+                # A pipelined request: wait for the response
+                if self.http_pending is None:
+                    self.http_pending=bytearray()
+                self.http_pending+=data[pos:]
+                self.http_hold=True
+                return
+            try:
+                end=request.feed(data,pos)
+            except HttpError:
+                self._http_start_tunnel(data[pos:])
+                return
+            if request.started:
+                self._http_connect()
+                self.p2s_start_write(data if pos == 0 and end == len(data) else data[pos:end])
+            pos=end
+
+    #################
+    ## Server Data ##
+    #################
+    def on_p2s_done_read(self,data):
+        if self.http_tunnel:
+            super(HttpSession,self).on_p2s_done_read(data)
+            return
+        response=self.http_response
+        if not response.started:
+            response.method=self.http_request.method
+        try:
+            end=response.feed(data)
+            while response.state == HttpParser.DONE and response.interim() and end < len(data):
+                response.reset()
+                end=response.feed(data,end)
+        except HttpError:
+            end=None
+        super(HttpSession,self).on_p2s_done_read(data)
+        if end is None or response.state == HttpParser.UNTIL_CLOSE:
+            self._http_start_tunnel()
+        elif response.state == HttpParser.DONE:
+            if response.interim():
+                response.reset()
+            elif end == len(data) and response.keep_alive and self.http_request.keep_alive and \
+                 self.http_request.state == HttpParser.DONE and not self.p2s_writing and not self.c2s_queued_data:
+                # Release the server connection once this read is over (see p2s_start_read)
+                self.http_release=True
+            else:
+                self._http_start_tunnel()
+
+    def p2s_start_read(self):
+        if self.http_release:
+            self.http_release=False
+            self._http_release_server()
+            return
+        if self.p2s_stream is None:
+            return  # Between requests
+        super(HttpSession,self).p2s_start_read()
+
+    def _http_release_server(self):
+        """
+        The response is complete: return the server connection to the pool , and go on with the next request
+        """
+        stream=self.p2s_stream
+        stream.set_close_callback(None)
+        if self.p2s_state == maproxy.session.Session.State.CONNECTED and self.proxy.connection_pool is not None:
+            self.proxy.connection_pool.put(self.backend,stream)
+        else:
+            stream.close()
+        self.p2s_stream=None
+        self.p2s_state=maproxy.session.Session.State.CONNECTING
+        self.p2s_read_paused=False
+        self.p2s_read_throttled=False
+        self.http_requests+=1
+        self.http_request.reset()
+        self.http_response.reset()
+        self._http_resume_client()
+
+    def _on_p2s_closed(self):
+        if self.p2s_state == maproxy.session.Session.State.CONNECTING and self.p2s_stream is None:
+            return  # The server closed the connection after the response (it was already released)
+        super(HttpSession,self)._on_p2s_closed()
+
+    ############
+    ## Tunnel ##
+    ############
+    def _http_start_tunnel(self,data=None):
+        """
+        Forward the data as is (L4) for the rest of the session
+        """
+        self.http_tunnel=True
+        self.http_release=False
+        if data:
+            self._http_connect()
+            self.p2s_start_write(data)
+        self._http_resume_client()
+
+    def _http_resume_client(self):
+        """
+        Go on reading from the client (and process the data that waited)
+        """
+        self.http_hold=False
+        pending,self.http_pending=self.http_pending,None
+        if pending:
+            if self.http_tunnel:
+                self._http_connect()
+                self.p2s_start_write(bytes(pending))
+            else:
+                self._http_client_data(bytes(pending))
+        if not self.http_hold and not self.c2p_reading and not self.c2p_read_paused and not self.c2p_read_throttled \
+           and self.c2p_state == maproxy.session.Session.State.CONNECTED:
+            self.c2p_start_read()
+
+    ###########
+    ## Close ##
+    ###########
+    def p2s_start_close(self,gracefully=True):
+        if gracefully and self._http_idle():
+            # No server connection (between requests) , nothing to flush
+            gracefully=False
+        super(HttpSession,self).p2s_start_close(gracefully)
+
+
+class HttpSessionFactory(maproxy.session.SessionFactory):
+    """
+    Creates HttpSession objects (see HttpSession) . Use it with a connection-pool:
+        ProxyServer(...,session_factory=HttpSessionFactory(),connection_pool=ConnectionPool(size=0))
+    """
+    session_class=HttpSession
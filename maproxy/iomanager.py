@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
 import tornado.tcpserver
+import tornado.ioloop
 import threading
 import time
 import os
-import functools
+import maproxy.workers
+import maproxy.metrics
+import maproxy.drain
+import maproxy.handoff
 
 
     
@@ -23,6 +27,17 @@ class IOManager(object):
         self._servers={}     # id->server
         self._ioloop=tornado.ioloop.IOLoop.instance();
         
+        # Multi-process mode: the WorkerPool (in the parent process) , and the worker-id (in a worker process)
+        self._workers=None
+        self.worker_id=None
+
+        # Metrics endpoint (see enable_metrics)
+        self._metrics_address=None
+        self._metrics_server=None
+        
+        # Zero-downtime restart (see serve_handoff)
+        self._handoff=None
+
         # Some "status flags" - so external entities will be able to be notified...
         self._running=threading.Event()
         self._stopping=threading.Event()
@@ -38,6 +53,9 @@ class IOManager(object):
         return len(self._servers)
 
     def get_connections_count(self):
+        if self._workers is not None:
+            # Parent process: the sum of all the workers' connections
+            return self._workers.get_connections_count()
         n=0
         for id,server in self._servers.items():
             assert isinstance(server , tornado.tcpserver.TCPServer)
@@ -50,6 +68,53 @@ class IOManager(object):
     def ioloop(self):
         return self._ioloop
 
+    def enable_metrics(self,port,address="127.0.0.1"):
+        """
+        Serve the servers' metrics (Prometheus text format, see maproxy.metrics) over HTTP on address:port .
+        The endpoint is started by start() . In the multi-process mode each worker serves its own metrics
+        on port+worker_id
+        """
+        self._metrics_address=(port,address)
+
+    def get_metrics(self):
+        """
+        The servers' metrics in the Prometheus text format
+        """
+        return maproxy.metrics.render(self)
+
+    def serve_handoff(self,path,gracefully=True,idle_time=1.0,callback=None,timeout=10):
+        """
+        Zero-downtime restart (the old process): wait (on a Unix socket) for a new process that calls
+        adopt_listeners(path) , hand it the servers' listening sockets (SCM_RIGHTS) , and then stop gracefully
+        (stop accepting , and drain the sessions, see stop()) . The connections that arrive during the restart
+        wait in the listening sockets' accept-queue, so none is refused.
+            path        : the Unix socket's path
+            gracefully  : how to stop after the handoff (same as stop's gracefully, True: wait forever)
+            idle_time   : see stop()
+            callback    : see stop()
+            timeout     : seconds that we wait for the new process to confirm (otherwise we keep serving)
+        Returns the maproxy.handoff.HandoffServer (its handed_off future is resolved with the Drain)
+        NOTE: only the servers' sockets are passed (not the metrics endpoint) . Not supported by the workers mode
+              with reuse_port (this process has no listening sockets to pass)
+        """
+        assert self._handoff is None , "Already serving a handoff"
+        assert self._workers is None or not self._workers.reuse_port , \
+               "The listeners handoff requires the shared sockets (not reuse_port)"
+        self._handoff=maproxy.handoff.HandoffServer(self,path,gracefully,idle_time,callback,timeout)
+        self._handoff.start()
+        return self._handoff
+
+    def adopt_listeners(self,path,timeout=10,retry=0):
+        """
+        Zero-downtime restart (the new process): receive the listening sockets of the old process (that called
+        serve_handoff(path)) instead of binding them. Call it after adding the servers (in the same order as the
+        old process did) and before start() . The servers that got no socket should be bound as usual.
+            retry   : seconds to keep trying to connect to the old process
+        Returns the number of adopted sockets . Raises an exception if the handoff failed (then the old process
+        keeps serving)
+        """
+        return maproxy.handoff.adopt_listeners(self,path,timeout,retry)
+
     #def add(self,server :   tornado.tcpserver.TCPServer ):
     def add(self,server ):
         """
@@ -67,13 +132,35 @@ class IOManager(object):
         
     
     #def start(self,thread:bool=True ):
-    def start(self,thread=True ):
+    def start(self,thread=True,workers=None,reuse_port=False ):
         """
         Start to listen on all servers, and start the IOLoop
+            thread      : run the IOLoop (or the workers' supervisor) in a new thread
+            workers     : None (default) - run the servers in this process.
+                          N - fork N worker processes, each one runs all the servers on its own IOLoop
+                              (0 means one worker per CPU). The servers must be bound with bind() , not listen()
+            reuse_port  : (workers mode) each worker binds its own listening sockets using SO_REUSEPORT
+                          instead of sharing the sockets that were bound in this process
         """
+        if workers is not None:
+            assert self.worker_id is None and self._workers is None , "Already started"
+            assert not (reuse_port and self._handoff is not None) , \
+                   "The listeners handoff requires the shared sockets (not reuse_port)"
+            self._workers=maproxy.workers.WorkerPool(self,workers,reuse_port)
+            self._stopped.clear()
+            self._running.set()
+            # NOTE: the next call never returns in the worker processes
+            self._workers.start(thread)
+            return
+
         for id,server in self._servers.items():
             assert isinstance(server , tornado.tcpserver.TCPServer)
             server .start()
+
+        if self._metrics_address is not None and self._metrics_server is None:
+            port,address=self._metrics_address
+            self._metrics_server=maproxy.metrics.MetricsServer(self)
+            self._metrics_server.listen(port+(self.worker_id or 0),address)
         
         if os.name=="nt":
             # On Windows, add a simple callback (freq:1sec) to display current number of connections
@@ -112,31 +199,82 @@ class IOManager(object):
             self._ioloop_thread.start()
     
     
-    def stop(self,gracefully=False,wait=False):
+    def _start_worker(self,worker_id,publish,publish_interval):
+        """
+        Called in a new worker process (see maproxy.workers.WorkerPool) . Run all the servers in this process.
+            publish             : a function that publishes the connections-count of this worker
+            publish_interval    : how often (seconds) to call publish
+        """
+        self._workers=None
+        self.worker_id=worker_id
+
+        # The IOLoop that we inherited from the parent process can't be used (shared epoll/kqueue) , create a new one
+        tornado.ioloop.IOLoop.clear_current()
+        tornado.ioloop.IOLoop.clear_instance()
+        self._ioloop=tornado.ioloop.IOLoop()
+        self._ioloop.make_current()
+
+        tornado.ioloop.PeriodicCallback(publish,publish_interval*1000).start()
+        self.start(thread=False)
+
+    def _on_workers_stopped(self):
+        """
+        Called (in the parent process) when all the workers exited
+        """
+        self._running.clear()
+        self._stopping.clear()
+        self._stopped.set()
+
+    def stop(self,gracefully=False,wait=False,idle_time=1.0,callback=None):
         """
         Stop the servers. By default, this function stops the server immediately (not-gracefully) , 
         all current connections will be terminated. You can set this behavior using the "gracefully" parametr.
             gracefully = True: wait forever
             gracefully = False: don't wait at all . terminate
-            gracefull = timeout (integer/float) : how much time (seconds) to wait...
+            gracefull = timeout (integer/float) : how much time (seconds) to wait... then the remaining
+                        connections are terminated with a RST
         NOTE: This is a nonblocking stop. it means that it will START the stop procedure but will not wait
               In fact, I don't think that it's possible to have a blocking stop in this layer/level
               (since we assume that this will be a callback from within  ab IOLoop-callback..)
 
              wait : if the ioloop was started as another thread, you can "wait" for the stop operation
-        
-    TODO (feature): terminate with RST (linger) , ...
+
+        A graceful stop drains the servers in phases (see maproxy.drain.Drain): stop accepting, close the idle
+        sessions (no data for idle_time seconds), close the half-closed sessions, and after the timeout close the
+        rest with a RST . The IOLoop is stopped as soon as the last session is removed (no polling).
+            idle_time   : how often (seconds) the drain looks for idle/half-closed sessions
+            callback    : callback(drain) is called (on the IOLoop) on every phase of the drain
+        Returns the Drain (None if not gracefully, or in the multi-process mode) . Other threads can wait on its
+        futures , e.g. drain.done.result(timeout) or drain.future(maproxy.drain.FORCE)
         """
+        if self._workers is not None:
+            # Parent process: stop all the workers (they'll stop gracefully if requested)
+            self._stopping.set()
+            self._workers.stop(gracefully,wait)
+            return None
+
+        drain=None
+        if gracefully:
+            drain=maproxy.drain.Drain(self._servers.values(),None if gracefully is True else gracefully,
+                                      idle_time,callback)
+
         if self._ioloop_thread and self._ioloop_thread.ident != threading.get_ident():
             # If called from another thread - run this procedure from the ioloop...
-            self._ioloop.add_callback ( g_IOManager.stop , gracefully=gracefully)
+            self._ioloop.add_callback(self._stop,drain)
             if wait:
                 self._ioloop_thread.join()
-            return
+            return drain
         assert wait is False , "You cannot run stop(wait=True) while not starting with start(thread=True)"
+        self._stop(drain)
+        return drain
 
-        
+    def _stop(self,drain):
+        """
+        The stop procedure (on the IOLoop) . drain is None for a not-graceful stop
+        """
         self._stopping.set()
+        if self._handoff is not None:
+            self._handoff.close()
 
         def stop_procedure():
             self._ioloop.stop()
@@ -144,35 +282,21 @@ class IOManager(object):
             self._stopping.clear()
             self._stopped.set()
 
-        def stop_if_no_connections(deadline):
-            current_time=time.time()
-            if self.get_connections_count() == 0 or (deadline and deadline-current_time<=0):
-                # No more connections , or deadline has been reached/exceeded
-                stop_procedure()
-                return
-            
-            # We either need to wait 1-second (untless next-check), or less
-            wait_time=current_time+1 if deadline is None else min( current_time+1,deadline)
-            self._ioloop.add_timeout( wait_time , functools.partial(stop_if_no_connections ,deadline) )
-            
-
-
-
         # First, stop listening...
         for id,server in self._servers.items():
             assert isinstance(server , tornado.tcpserver.TCPServer)
             server.stop()
-        if not gracefully or self.get_connections_count()==0:
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+            self._metrics_server=None
+        if drain is None:
             stop_procedure()
             return
-        
-        if gracefully is True:
-            gracefully_timeout=None # Wait forever...
-        else:
-            assert( isinstance(gracefully,int) or isinstance(gracefully,float)  )
-            gracefully_timeout=time.time()+gracefully
-
-        self._ioloop.add_callback(stop_if_no_connections , gracefully_timeout)
-                
 
+        def on_drain_phase(drain):
+            # Stop the IOLoop when the drain is done (the last session was removed, or the rest were reset)
+            if drain.phase == maproxy.drain.DONE:
+                stop_procedure()
 
+        drain.add_callback(on_drain_phase)
+        drain.start()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import bisect
+import time
+import tornado.tcpserver
+import tornado.iostream
+
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets (Prometheus style: each bucket counts the values that are <= its upper bound)
+    observe() is O(log(buckets)) and does not allocate
+    """
+    # Default buckets (seconds) for latencies
+    LATENCY_BUCKETS=(0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)
+    # Default buckets (seconds) for session durations
+    DURATION_BUCKETS=(0.01,0.1,0.5,1,5,10,30,60,300,600,1800,3600)
+
+    def __init__(self,buckets=LATENCY_BUCKETS):
+        self.buckets=tuple(sorted(buckets))
+        self.counts=[0]*(len(self.buckets)+1)     # The last one is the "+Inf" bucket
+        self.count=0
+        self.sum=0.0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)]+=1
+        self.count+=1
+        self.sum+=value
+
+    def cumulative_counts(self):
+        """
+        [(upper-bound,count),...] , the last upper-bound is float("inf")
+        """
+        result=[]
+        total=0
+        for bound,count in zip(self.buckets+(float("inf"),),self.counts):
+            total+=count
+            result.append((bound,total))
+        return result
+
+
+class ProxyMetrics(object):
+    """
+    Metrics of a ProxyServer.
+    The sessions count their bytes/chunks (see Session.c2s_bytes,s2c_bytes,c2s_chunks,s2c_chunks) , so the
+    hot path only increments the session's own counters. The proxy's totals are the counters of the sessions
+    that were closed, plus the counters of the open sessions (summed when the metrics are collected).
+    """
+    def __init__(self,name=None):
+        """
+        Input Parameters:
+            name    : the "proxy" label in the Prometheus output (default: the listening address)
+        """
+        self.name=name
+        self.sessions_opened=0
+        self.sessions_closed=0
+        self.connect_failures=0
+        self.sessions_rejected=0                # Connections that were rejected by the admission control
+        self.sessions_queued=0                  # Connections that were queued by the admission control
+        # Totals of the closed sessions
+        self.c2s_bytes=0
+        self.s2c_bytes=0
+        self.c2s_chunks=0
+        self.s2c_chunks=0
+        # Histograms (seconds)
+        self.connect_time=Histogram()           # Proxy->Server connect (resolve , connect , SSL handshake, retries)
+        self.ssl_handshake_time=Histogram()     # Proxy->Server SSL handshake
+        self.time_to_first_byte=Histogram()     # From the client's connection to the first byte from the server
+        self.session_duration=Histogram(Histogram.DURATION_BUCKETS)
+
+    def session_closed(self,session):
+        """
+        Called when the session is removed: add its counters to the totals
+        """
+        self.sessions_closed+=1
+        self.c2s_bytes+=session.c2s_bytes
+        self.s2c_bytes+=session.s2c_bytes
+        self.c2s_chunks+=session.c2s_chunks
+        self.s2c_chunks+=session.s2c_chunks
+        self.session_duration.observe(time.time()-session.start_time)
+
+    def totals(self,sessions):
+        """
+        (c2s_bytes,s2c_bytes,c2s_chunks,s2c_chunks) of the closed sessions and the open sessions
+        """
+        c2s_bytes,s2c_bytes,c2s_chunks,s2c_chunks=self.c2s_bytes,self.s2c_bytes,self.c2s_chunks,self.s2c_chunks
+        for session in sessions:
+            c2s_bytes+=session.c2s_bytes
+            s2c_bytes+=session.s2c_bytes
+            c2s_chunks+=session.c2s_chunks
+            s2c_chunks+=session.s2c_chunks
+        return c2s_bytes,s2c_bytes,c2s_chunks,s2c_chunks
+
+
+def _escape(value):
+    return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+def _proxy_name(server):
+    if server.metrics.name is not None:
+        return server.metrics.name
+    for sock in list(server._sockets.values())+list(getattr(server,"_pending_sockets",[])):
+        try:
+            sockname=sock.getsockname()
+        except OSError:
+            continue
+        return "%s:%d" % (sockname[0],sockname[1])
+    return str(id(server))
+
+def render(iomanager):
+    """
+    The metrics of all the IOManager's servers , in the Prometheus text format
+    """
+    counters=(("maproxy_sessions_opened_total","Sessions that were opened",lambda s,t: s.metrics.sessions_opened),
+              ("maproxy_sessions_closed_total","Sessions that were closed",lambda s,t: s.metrics.sessions_closed),
+              ("maproxy_connect_failures_total","Failed Proxy->Server connects",lambda s,t: s.metrics.connect_failures),
+              ("maproxy_sessions_rejected_total","Connections that were rejected by the admission control",
+               lambda s,t: s.metrics.sessions_rejected),
+              ("maproxy_sessions_queued_total","Connections that were queued by the admission control",
+               lambda s,t: s.metrics.sessions_queued),
+              ("maproxy_client_to_server_bytes_total","Bytes from the clients to the servers",lambda s,t: t[0]),
+              ("maproxy_server_to_client_bytes_total","Bytes from the servers to the clients",lambda s,t: t[1]),
+              ("maproxy_client_to_server_chunks_total","Chunks read from the clients",lambda s,t: t[2]),
+              ("maproxy_server_to_client_chunks_total","Chunks read from the servers",lambda s,t: t[3]))
+    gauges=(("maproxy_sessions","Open sessions",lambda s,t: s.get_connections_count()),)
+    histograms=(("maproxy_connect_seconds","Proxy->Server connect time",lambda s: s.metrics.connect_time),
+                ("maproxy_ssl_handshake_seconds","Proxy->Server SSL handshake time",lambda s: s.metrics.ssl_handshake_time),
+                ("maproxy_time_to_first_byte_seconds","Time from the client's connection to the first byte from the server",
+                 lambda s: s.metrics.time_to_first_byte),
+                ("maproxy_session_duration_seconds","Session duration",lambda s: s.metrics.session_duration))
+
+    servers=[server for server in iomanager._servers.values() if getattr(server,"metrics",None) is not None]
+    labels=['proxy="%s"' % _escape(_proxy_name(server)) for server in servers]
+    totals=[server.metrics.totals(server.sessions) for server in servers]
+    lines=[]
+    for metric_type,metrics in (("counter",counters),("gauge",gauges)):
+        for name,description,value in metrics:
+            lines.append("# HELP %s %s" % (name,description))
+            lines.append("# TYPE %s %s" % (name,metric_type))
+            for server,label,total in zip(servers,labels,totals):
+                lines.append("%s{%s} %d" % (name,label,value(server,total)))
+    for name,description,value in histograms:
+        lines.append("# HELP %s %s" % (name,description))
+        lines.append("# TYPE %s histogram" % name)
+        for server,label in zip(servers,labels):
+            histogram=value(server)
+            for bound,count in histogram.cumulative_counts():
+                le="+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name,label,le,count))
+            lines.append("%s_sum{%s} %r" % (name,label,histogram.sum))
+            lines.append("%s_count{%s} %d" % (name,label,histogram.count))
+    return "\n".join(lines)+"\n"
+
+
+class MetricsServer(tornado.tcpserver.TCPServer):
+    """
+    Minimal HTTP server that returns the IOManager's metrics (Prometheus text format) for any GET request.
+    Started by IOManager.start() (see IOManager.enable_metrics)
+    """
+    # Maximum size of the request's header
+    MAX_HEADER_SIZE=16384
+
+    def __init__(self,iomanager):
+        super(MetricsServer,self).__init__()
+        self.iomanager=iomanager
+
+    def handle_stream(self,stream,address):
+        stream.read_until(b"\r\n\r\n",lambda data: self._on_request(stream,data),max_bytes=MetricsServer.MAX_HEADER_SIZE)
+
+    def _on_request(self,stream,data):
+        method=data.split(b" ",1)[0]
+        if method in (b"GET",b"HEAD"):
+            body=render(self.iomanager).encode("utf-8")
+            status=b"200 OK"
+            content_type=b"text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body=b"Method Not Allowed\n"
+            status=b"405 Method Not Allowed"
+            content_type=b"text/plain"
+        header=b"HTTP/1.1 "+status+b"\r\nContent-Type: "+content_type+ \
+               b"\r\nContent-Length: "+str(len(body)).encode("ascii")+b"\r\nConnection: close\r\n\r\n"
+        try:
+            stream.write(header+(body if method != b"HEAD" else b""),callback=stream.close)
+        except tornado.iostream.StreamClosedError:
+            pass
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import collections
+
+
+
+class OutputBuffer(object):
+    """
+    Queue of data chunks that are waiting to be written to a stream.
+    - append(data) adds a chunk to the queue. "None" is the "close request" marker: the stream should
+      be closed once all the data that was queued before it is written.
+    - pop_batch(max_bytes) merges the queued chunks into one write (up to max_bytes), so the Session
+      performs one write (and gets one write-callback) per batch instead of one per chunk.
+      When all the data was popped and a close was requested, pop_batch returns None .
+    - The deque is allocated on the first append (most buffers of an idle session are never used)
+    """
+    __slots__=("_chunks","nbytes","close_requested")
+
+    def __init__(self):
+        self._chunks=None
+        self.nbytes=0                   # Number of queued bytes
+        self.close_requested=False      # Whether the "None" marker was queued
+
+    def __len__(self):
+        """
+        Number of pending items (chunks + the close marker)
+        """
+        return (len(self._chunks) if self._chunks else 0) + (1 if self.close_requested else 0)
+
+    def __bool__(self):
+        return bool(self._chunks) or self.close_requested
+    __nonzero__=__bool__    # Python 2
+
+    def append(self,data):
+        """
+        Queue data (or the None "close marker")
+        Data that is queued after the close marker is ignored, since the stream will be closed by then
+        """
+        if self.close_requested:
+            return
+        if data is None:
+            self.close_requested=True
+            return
+        if self._chunks is None:
+            self._chunks=collections.deque()
+        self._chunks.append(data)
+        self.nbytes+=len(data)
+
+    def pop_batch(self,max_bytes):
+        """
+        Remove and return the next batch to write: as many queued chunks as possible (but at least one)
+        merged together, up to max_bytes .
+        Returns None if there's no more data and a close was requested
+        """
+        chunks=self._chunks
+        if not chunks:
+            assert self.close_requested , "Empty buffer"
+            self.close_requested=False
+            return None
+        data=chunks.popleft()
+        size=len(data)
+        if chunks and size + len(chunks[0]) <= max_bytes:
+            # Merge the following chunks as well (single copy, using join)
+            batch=[data]
+            while chunks and size + len(chunks[0]) <= max_bytes:
+                data=chunks.popleft()
+                size+=len(data)
+                batch.append(data)
+            data=b"".join(batch)
+        self.nbytes-=size
+        return data
+
+    def clear(self):
+        """
+        Drop all queued data (and the close marker)
+        """
+        if self._chunks is not None:
+            self._chunks.clear()
+        self.nbytes=0
+        self.close_requested=False
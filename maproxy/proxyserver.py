@@ -1,7 +1,23 @@
 #!/usr/bin/env python
 import tornado
 import tornado.tcpserver
+import tornado.iostream
+import tornado.netutil
+import socket
 import maproxy.session
+import maproxy.backend
+import maproxy.balancer
+import maproxy.healthcheck
+import maproxy.connectionpool
+import maproxy.sslsession
+import maproxy.resolver
+import maproxy.connector
+import maproxy.timerwheel
+import maproxy.metrics
+import maproxy.sessiontable
+import maproxy.hooks
+import maproxy.admission
+import maproxy.shaping
 
 
 
@@ -12,15 +28,22 @@ class ProxyServer(tornado.tcpserver.TCPServer):
 
     """
     def __init__(self,
-                 target_server,target_port,
+                 target_server,target_port=None,
                  client_ssl_options=None,server_ssl_options=None,
                  session_factory=maproxy.session.SessionFactory(),
+                 high_watermark=None,low_watermark=None,
+                 write_batch_size=65536,
+                 balancer=None,health_checker=None,connection_pool=None,resolver=None,
+                 connect_timeout=None,connect_retries=0,retry_backoff=0.1,
+                 idle_timeout=None,half_close_timeout=None,max_lifetime=None,
+                 metrics=None,hooks=None,admission=None,shaper=None,
                  *args,**kwargs):
         """
         ProxyServer initializer function (constructor) .
         Input Parameters:
-            target_server           : the proxied-server IP
-            target_port             : the proxied-server port
+            target_server           : the proxied-server IP , or a list of backends (proxied-servers). each backend is
+                                      a maproxy.backend.Backend , a (host,port) tuple or a (host,port,weight) tuple
+            target_port             : the proxied-server port (None if target_server is a list of backends)
             client_ssl_options      : Configure this proxy as SSL terminator  (decrypt all data).
                                       Standard Tornado's SSL options dictionary
                                       (e.g.: keyfile and certfile to specify Server-Certificate)
@@ -29,6 +52,40 @@ class ProxyServer(tornado.tcpserver.TCPServer):
                                       2. False/None: disalbe SSL
                                       3. Standard Tornado's SSL options dictionary
                                          (e.g.: keyfile and certfile to specify Client-Certificate)
+            session_factory         : SessionFactory instance that creates the Session objects
+            high_watermark          : Maximum number of bytes to queue (per direction) for a session. When
+                                      exceeded, we stop reading from the sending side until the queue drops
+                                      to low_watermark. None (default) means no limit
+            low_watermark           : Resume reading when the queue drops to this number of bytes.
+                                      Default is high_watermark/2
+            write_batch_size        : Queued chunks are merged into a single write of up to this number of bytes
+            balancer                : maproxy.balancer.Balancer instance that selects a backend for each session
+                                      (default: maproxy.balancer.RoundRobinBalancer)
+            health_checker          : maproxy.healthcheck.HealthChecker instance. Ejects failing backends
+                                      (default: None, no health-checks)
+            connection_pool         : maproxy.connectionpool.ConnectionPool instance. Keeps connections to the
+                                      backends ready for new sessions (default: None, connect for each session)
+            resolver                : maproxy.resolver.CachingResolver instance that resolves the backends' hostnames
+                                      (default: a new CachingResolver)
+            connect_timeout         : Proxy->Server connect timeout (seconds, including the hostname resolution and
+                                      the SSL handshake). None means no timeout
+            connect_retries         : how many times a session retries to connect after a failed connect. If there
+                                      are several backends, the session fails-over to another backend
+            retry_backoff           : delay (seconds) before a session retries to connect to a backend that already
+                                      failed. Doubled for each retry, with a random jitter
+            idle_timeout            : close (not gracefully) sessions that did not transfer data for this number of
+                                      seconds. None means no timeout
+            half_close_timeout      : close (not gracefully) sessions that are half-closed (one side was closed,
+                                      the other side is still open) for this number of seconds
+            max_lifetime            : close (not gracefully) sessions that are open for this number of seconds
+            metrics                 : maproxy.metrics.ProxyMetrics instance (default: a new ProxyMetrics)
+            hooks                   : maproxy.hooks.Hooks instance , the sessions' event callbacks
+                                      (default: a new Hooks , register callbacks with proxy.hooks.add)
+            admission               : maproxy.admission.AdmissionController instance. Limits the concurrent
+                                      sessions (per proxy and per client) and the connection rate
+                                      (default: None, accept every connection)
+            shaper                  : maproxy.shaping.BandwidthShaper instance. Limits the bandwidth of the sessions
+                                      (per session, per client and for the whole proxy) . Default: None, no limits
             args,kwargs             : will be passed directly to the Tornado engine
         """
         assert(session_factory , issubclass(session_factory.__class__,maproxy.session.SessionFactory))
@@ -37,8 +94,34 @@ class ProxyServer(tornado.tcpserver.TCPServer):
         
         # First, get the server's address and port . 
         # This is the proxied server that we'll connect to
-        self.target_server=target_server
-        self.target_port=target_port
+        # (or the list of proxied servers, in this case the balancer selects a server for each session)
+        if isinstance(target_server,(list,tuple)):
+            assert target_port is None , "target_port must be None when target_server is a list of backends"
+            self.backends=[maproxy.backend.Backend.create(spec) for spec in target_server]
+            assert self.backends , "No backends"
+            self.target_server=self.target_port=None
+        else:
+            self.backends=[maproxy.backend.Backend(target_server,target_port)]
+            self.target_server=target_server
+            self.target_port=target_port
+        self.balancer=balancer if balancer is not None else maproxy.balancer.RoundRobinBalancer()
+        self.health_checker=health_checker
+        if self.health_checker is not None:
+            self.health_checker.attach(self)
+        self.resolver=resolver if resolver is not None else maproxy.resolver.CachingResolver()
+        self.connect_timeout=connect_timeout
+        self.connect_retries=connect_retries
+        self.retry_backoff=retry_backoff
+        # Session timeouts. All the sessions' timeouts are managed by one timer-wheel
+        self.idle_timeout=idle_timeout
+        self.half_close_timeout=half_close_timeout
+        self.max_lifetime=max_lifetime
+        self.timer_wheel=None
+        if idle_timeout or half_close_timeout or max_lifetime:
+            self.timer_wheel=maproxy.timerwheel.TimerWheel()
+        self.connection_pool=connection_pool
+        if self.connection_pool is not None:
+            self.connection_pool.attach(self)
         
         # Now, remember the SSL potions
         # client_ssl_options : use it if you want an SSL listener (if you want that the proxy will have an SSL listener)
@@ -56,8 +139,42 @@ class ProxyServer(tornado.tcpserver.TCPServer):
         if self.client_ssl_options is False:
             self.client_ssl_options=None
 
-        # Session-List
-        self.SessionsList=[]
+        # Build the (Proxy->Server) SSL context once, and keep a TLS-session cache per backend
+        # so the connections to the backends can resume their TLS sessions
+        self.server_ssl_context=None
+        if self.server_ssl_options is not None:
+            self.server_ssl_context=tornado.netutil.ssl_options_to_context(self.server_ssl_options)
+            for backend in self.backends:
+                backend.ssl_session_cache=maproxy.sslsession.SSLSessionCache()
+
+        # Back-pressure watermarks (per session, per direction)
+        if high_watermark is not None:
+            if low_watermark is None:
+                low_watermark=high_watermark//2
+            assert 0 <= low_watermark <= high_watermark , "low_watermark must be between 0 and high_watermark"
+        self.high_watermark=high_watermark
+        self.low_watermark=low_watermark
+        self.write_batch_size=write_batch_size
+
+        # Counters and histograms (see maproxy.metrics)
+        self.metrics=metrics if metrics is not None else maproxy.metrics.ProxyMetrics()
+
+        # Event callbacks (see maproxy.hooks)
+        self.hooks=hooks if hooks is not None else maproxy.hooks.Hooks()
+
+        # Admission control (see maproxy.admission)
+        self.admission=admission
+        if self.admission is not None:
+            self.admission.attach(self)
+
+        # Bandwidth shaping (see maproxy.shaping)
+        self.shaper=shaper
+        if self.shaper is not None:
+            self.shaper.attach(self)
+
+        # The sessions (see maproxy.sessiontable.SessionTable) . SessionsList is the old name
+        self.sessions=maproxy.sessiontable.SessionTable()
+        self.SessionsList=self.sessions
         
         # call Tornado's Engine . pass args/kwargs directly
         super(ProxyServer,self).__init__(ssl_options=self.client_ssl_options,*args,**kwargs)
@@ -65,23 +182,133 @@ class ProxyServer(tornado.tcpserver.TCPServer):
     
         
         
+    def add_sockets(self,sockets):
+        """
+        Start accepting connections (called by listen() and start()) .
+        This is where we start the health-checks, so they will run on the same IOLoop
+        """
+        super(ProxyServer,self).add_sockets(sockets)
+        if self.health_checker is not None:
+            self.health_checker.start()
+        if self.connection_pool is not None:
+            self.connection_pool.start()
+
+    def stop(self):
+        super(ProxyServer,self).stop()
+        if self.health_checker is not None:
+            self.health_checker.stop()
+        if self.connection_pool is not None:
+            self.connection_pool.stop()
+        if self.admission is not None:
+            self.admission.stop()
+
+    def connect(self,backend,callback):
+        """
+        Connect a new Proxy->Server stream to the backend (resolve its hostname, and connect to its addresses).
+        callback(stream) is called with the connected stream , or with None if we could not connect.
+        Returns the maproxy.connector.Connector (call its close() to cancel the connect)
+        """
+        connector=maproxy.connector.Connector(self,backend,callback,self.connect_timeout)
+        connector.start()
+        return connector
+
+    def create_server_stream(self,backend,family=socket.AF_INET):
+        """
+        Create a (not connected) Proxy->Server stream to the backend
+        """
+        s = socket.socket(family, socket.SOCK_STREAM, 0)
+        if self.server_ssl_context is not None:
+            # if the "server_ssl_options" where specified, it means that when we connect, we need to wrap with SSL
+            # so we need to use the SSLIOStream stream
+            stream = maproxy.sslsession.ResumingSSLIOStream(s,ssl_options=self.server_ssl_context,
+                                                            session_cache=backend.ssl_session_cache)
+        else:
+            # use the standard IOStream stream
+            stream = tornado.iostream.IOStream(s)
+        # send data immediately to the server... (Disable Nagle TCP algorithm)
+        stream.set_nodelay(True)
+        return stream
+
     def handle_stream(self, stream, address):
         """
         The proxy will call this function for every new connection as a callback
         This is the Session starting point: we initiate a new session and add it to the sessions-list
         """
         assert isinstance(stream,tornado.iostream.IOStream)
+        if self.admission is not None and not self.admission.admit(stream,address):
+            return  # Rejected , or queued (the admission-controller will call start_session)
+        self.start_session(stream,address)
+
+    def start_session(self,stream,address):
+        """
+        Start the session of a new (admitted) connection
+        """
         #session=maproxy.session.Session(stream,address,self)
         session=self.session_factory.new()   # Use the factory to create new session
         session.new_connection(stream,address,self)
-        self.SessionsList.append(session)
+
+    def add_session(self,session):
+        """
+        Called by the session (new_connection) once the client's stream and address are set , before it
+        connects to the server
+        """
+        self.sessions.add(session)
+        self.metrics.sessions_opened+=1
+        hooks=self.hooks.on_session_open
+        if hooks:
+            maproxy.hooks.run(hooks,session)
+
+    def select_backend(self,session,exclude=()):
+        """
+        Select a backend for a new session (the session calls this function when it connects to the server)
+            exclude     : backends that we prefer not to select (e.g. the session already failed to connect to them)
+        """
+        backends=self.backends
+        if self.health_checker is not None:
+            # Skip the ejected backends (unless all of them are ejected, then we'd better try anyway)
+            backends=self.health_checker.available_backends(backends) or backends
+        if exclude:
+            backends=[backend for backend in backends if backend not in exclude] or backends
+        backend=self.balancer.select(backends,session)
+        self.sessions.update_backend(session,backend)
+        backend.active_sessions+=1
+        backend.total_sessions+=1
+        return backend
+
+    def release_backend(self,backend):
+        """
+        The session does not use the backend anymore (see select_backend)
+        """
+        backend.active_sessions-=1
 
     def remove_session(self,session):
         assert (  isinstance(session, maproxy.session.Session) )
         assert ( session.p2s_state==maproxy.session.Session.State.CLOSED )
         assert ( session.c2p_state ==maproxy.session.Session.State.CLOSED )
-        self.SessionsList.remove(session)
+        if session not in self.sessions:
+            return  # Already removed (a close-callback of a stream that was closed while the session was aborted)
+        self.sessions.remove(session)
+        self.metrics.session_closed(session)
+        self.release_backend(session.backend)
+        if self.shaper is not None:
+            self.shaper.session_closed(session)
+        hooks=self.hooks.on_close
+        if hooks:
+            maproxy.hooks.run(hooks,session)
         self.session_factory.delete(session)
+        if self.admission is not None:
+            self.admission.session_closed()
+
+    def get_ssl_session_stats(self):
+        """
+        TLS-session resumption counters (of the Proxy->Server connections): (hits,misses)
+        """
+        hits=misses=0
+        for backend in self.backends:
+            if backend.ssl_session_cache is not None:
+                hits+=backend.ssl_session_cache.hits
+                misses+=backend.ssl_session_cache.misses
+        return hits,misses
 
     def get_connections_count(self):
-        return len(self.SessionsList)
+        return len(self.sessions)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import time
+import socket
+import logging
+import functools
+import tornado
+import tornado.ioloop
+import tornado.netutil
+
+
+
+class CachingResolver(object):
+    """
+    Asynchronous (non-blocking) hostname resolution with a cache.
+    - The resolution itself is done by a Tornado Resolver (by default in a thread pool, so the IOLoop is never
+      blocked by a slow DNS)
+    - The results (all the A and AAAA records) are cached for "ttl" seconds.
+      NOTE: getaddrinfo() does not return the records' TTL, so the TTL is configurable
+    - When an entry is about to expire (less than "refresh" seconds), we return the cached entry and refresh
+      it in the background, so the sessions don't wait for the DNS.
+    - When the DNS fails, we keep using the (expired) cached entry
+    """
+    def __init__(self,ttl=60,refresh=10,resolver=None):
+        """
+        Input Parameters:
+            ttl         : how long (seconds) to cache a resolved hostname
+            refresh     : refresh (in the background) entries that expire within "refresh" seconds
+            resolver    : tornado.netutil.Resolver instance (default: non-blocking resolver)
+        """
+        self.ttl=ttl
+        self.refresh=refresh
+        if resolver is None:
+            if tornado.version_info >= (5,):
+                resolver=tornado.netutil.Resolver()
+            else:
+                # Tornado 4's default resolver is blocking
+                resolver=tornado.netutil.ThreadedResolver()
+        self.resolver=resolver
+        self._cache={}          # (host,port) -> (expiration-time , [(family,address),...])
+        self._pending={}        # (host,port) -> list of callbacks that wait for the resolution
+
+    def get(self,host,port):
+        """
+        Return the cached addresses of host:port (or None)
+        """
+        entry=self._cache.get((host,port))
+        return entry[1] if entry else None
+
+    def resolve(self,host,port,callback):
+        """
+        Resolve host:port , and call callback([(family,address),...]) . The list is empty if the resolution failed.
+        The callback may be called synchronously (IP address, or a cached hostname)
+        """
+        if tornado.netutil.is_valid_ip(host):
+            family=socket.AF_INET6 if ":" in host else socket.AF_INET
+            callback([(family,(host,port))])
+            return
+        key=(host,port)
+        entry=self._cache.get(key)
+        if entry is not None:
+            expiration,addresses=entry
+            remaining=expiration-time.time()
+            if remaining <= self.refresh and key not in self._pending:
+                # Refresh in the background
+                self._start_resolve(key)
+            if remaining > 0:
+                callback(addresses)
+                return
+            # Expired: wait for the refresh
+
+        callbacks=self._pending.get(key)
+        if callbacks is None:
+            self._start_resolve(key)
+            callbacks=self._pending[key]
+        callbacks.append(callback)
+
+    def _start_resolve(self,key):
+        self._pending[key]=[]
+        host,port=key
+        future=self.resolver.resolve(host,port,socket.AF_UNSPEC)
+        tornado.ioloop.IOLoop.current().add_future(future,functools.partial(self._on_resolved,key))
+
+    def _on_resolved(self,key,future):
+        callbacks=self._pending.pop(key,[])
+        try:
+            addresses=future.result()
+            self._cache[key]=(time.time()+self.ttl,addresses)
+        except Exception as e:
+            logging.warning("Failed to resolve %s: %s",key[0],e)
+            # Keep using the previous (expired) addresses, if we have them
+            entry=self._cache.get(key)
+            addresses=entry[1] if entry else []
+        for callback in callbacks:
+            callback(addresses)
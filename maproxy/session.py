@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
 import tornado
-import socket
+import tornado.ioloop
+import time
+import random
 import maproxy.proxyserver
+import maproxy.outputbuffer
+import maproxy.healthcheck
+import maproxy.hooks
+import maproxy.admission
 
 
 
@@ -24,38 +30,42 @@ class Session(object):
           if queued data is available (data that was sent from the c2p) we initiate a "start_write" immediately
         - on_XXX_done_write:
           When we're done "sending" data , we check if there's more data to send in the queue. 
-          if there is - we initiate another "start_write" with the queued data
+          if there is - we initiate another "start_write" with the queued data.
+          All the queued chunks are merged into one write (up to the proxy's "write_batch_size")
         - on_XXX_close:
           When one side closes the connection, we either initiate a "start_close" on the other side, or (if already closed) - remove the session
     - I/O routings:
         - XXX_start_read: simply start read from the socket (we assume and validate that only one read goes at a time)
         - XXX_start_write: if currently writing , add data to queue. if not writing - perform io_write...
-        
-    
+    - Back-pressure:
+        - If the ProxyServer has a "high_watermark", we stop reading from the producing socket when the
+          queue (to the other side) has more than "high_watermark" bytes, and resume reading when the
+          queue drops to "low_watermark" bytes. c2s_queued_bytes/s2c_queued_bytes are the queued bytes.
+    - Memory:
+        - The attributes are __slots__ (no per-session __dict__). A subclass that doesn't define __slots__
+          gets a __dict__ as usual, so it can add any attribute
+        - A session can be reused after it was removed (see reset() , and the SessionFactory's pool_size)
+    - Events: the session calls the proxy's hooks (see maproxy.hooks.Hooks) when it's opened, connected,
+      reads data and is closed. Subclasses can also override the on_XXX functions (see demos/logging_proxy.py)
 
 
     """
-    class LoggerOptions:
-        """
-        Logging options - which messages/notifications we would like to log...
-        The logging is for development&maintenance. In production set all to False
-        """
-        # Log charactaristics
-        LOG_SESSION_ID=True         # for each log, add the session-id
-        # Log different operations
-        LOG_NEW_SESSION_OP=False
-        LOG_READ_OP=False
-        LOG_WRITE_OP=False
-        LOG_CLOSE_OP=False
-        LOG_CONNECT_OP=False
-        LOG_REMOVE_SESSION=False
-        
     class State:
         """
         Each socket has a state.
         We will use the state to identify whether the connection is open or closed
         """
         CLOSED,CONNECTING,CONNECTED=range(3)
+
+    # All the attributes of a session (a subclass with new attributes adds its own __slots__)
+    __slots__=("proxy","session_id",
+               "c2p_reading","c2p_writing","p2s_reading","p2s_writing","c2p_read_paused","p2s_read_paused",
+               "c2p_read_throttled","p2s_read_throttled","shaper_state",
+               "start_time","last_activity","half_closed_time","timeout_timer",
+               "c2s_bytes","s2c_bytes","c2s_chunks","s2c_chunks",
+               "c2p_stream","c2p_address","c2p_state","c2s_queued_data","s2c_queued_data",
+               "backend","p2s_state","p2s_stream","p2s_connector","p2s_retry_timeout","p2s_failed_backends",
+               "p2s_connect_start")
     
     def __init__(self):
         pass
@@ -63,13 +73,6 @@ class Session(object):
     def new_connection(self,stream ,address,proxy):
             # First,validation
             assert isinstance(proxy,maproxy.proxyserver.ProxyServer) 
-            assert isinstance(stream,tornado.iostream.IOStream)
-            
-            # Logging
-            self.logger_nesting_level=0         # logger_nesting_level is the current "nesting level"
-            if Session.LoggerOptions.LOG_NEW_SESSION_OP:
-                self.log("New Session")
-
             
             # Remember our "parent" ProxyServer 
             self.proxy=proxy
@@ -85,111 +88,167 @@ class Session(object):
             self.p2s_writing=False  # whether we're writing to the server
             self.p2s_reading=False  # whether we're reading from the server
 
+            # Back-pressure flags: reading was paused since the other side's queue is above the high-watermark
+            self.c2p_read_paused=False
+            self.p2s_read_paused=False
+            # Bandwidth-shaping flags: reading was paused since the session is over its rate (see maproxy.shaping)
+            self.c2p_read_throttled=False
+            self.p2s_read_throttled=False
+            self.shaper_state=None
+
+            # Timeouts (see the ProxyServer's idle_timeout,half_close_timeout,max_lifetime)
+            self.start_time=time.time()
+            self.last_activity=self.start_time      # Last time we read data from the client or the server
+            self.half_closed_time=None              # When one side was closed (while the other side is open)
+            self.timeout_timer=None
+            if self.proxy.timer_wheel is not None:
+                self._schedule_timeout()
+
+            # Counters (bytes and chunks that were read from the client (c2s) and from the server (s2c))
+            self.c2s_bytes=0
+            self.s2c_bytes=0
+            self.c2s_chunks=0
+            self.s2c_chunks=0
+
             # Init the Client->Proxy stream
             self.c2p_stream=stream
             self.c2p_address=address
             # Client->Proxy  is connected
             self.c2p_state=Session.State.CONNECTED
+            self.backend=None
+            self.proxy.add_session(self)
             
             # Here we will put incoming data while we're still waiting for the target-server's connection
-            self.c2s_queued_data=[] # Data that was read from the Client, and needs to be sent to the  Server
-            self.s2c_queued_data=[] # Data that was read from the Server , and needs to be sent to the  client
-
-            # send data immediately to the client ... (Disable Nagle TCP algorithm)
-            self.c2p_stream.set_nodelay(True)
-            # Let us now when the client disconnects (callback on_c2p_close)
-            self.c2p_stream.set_close_callback( self.on_c2p_close)
+            # (or while the previous write is in progress)
+            # A reused session (see reset) already has its (empty) buffers
+            if getattr(self,"c2s_queued_data",None) is None:
+                self.c2s_queued_data=maproxy.outputbuffer.OutputBuffer() # Data that was read from the Client, and needs to be sent to the  Server
+                self.s2c_queued_data=maproxy.outputbuffer.OutputBuffer() # Data that was read from the Server , and needs to be sent to the  client
 
-            # Create the Proxy->Server socket and stream
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            
-            if self.proxy.server_ssl_options is not None:
-                # if the "server_ssl_options" where specified, it means that when we connect, we need to wrap with SSL
-                # so we need to use the SSLIOStream stream
-                self.p2s_stream = tornado.iostream.SSLIOStream(s,ssl_options=self.proxy.server_ssl_options)
-            else:
-                # use the standard IOStream stream
-                self.p2s_stream = tornado.iostream.IOStream(s)
-            # send data immediately to the server... (Disable Nagle TCP algorithm)
-            self.p2s_stream.set_nodelay(True)
-            
-            # Let us now when the server disconnects (callback on_p2s_close)
-            self.p2s_stream.set_close_callback(  self.on_p2s_close )
-            # P->S state is "connecting"
-            self.p2s_state=self.p2s_state=Session.State.CONNECTING
-            self.p2s_stream.connect(( proxy.target_server, proxy.target_port),  self.on_p2s_done_connect )
-            
+            self._init_c2p_stream()
+            self._p2s_start_connect()
 
             # We can actually start reading immediatelly from the C->P socket
             self.c2p_start_read()
-    
-    # Each member-function can call this method to log data (currently to screen)
-    def log(self,msg):
-        prefix=str(id(self))+":" if Session.LoggerOptions.LOG_SESSION_ID else ""
-        prefix+=self.logger_nesting_level*" "*4
-        logging.debug(prefix + msg)
-        
-        
 
-    #  Logging decorator (enter/exit)
-    def logger(enabled=True):
+    def _init_c2p_stream(self):
+        assert isinstance(self.c2p_stream,tornado.iostream.IOStream)
+        # send data immediately to the client ... (Disable Nagle TCP algorithm)
+        self.c2p_stream.set_nodelay(True)
+        # Let us now when the client disconnects (callback on_c2p_close)
+        self.c2p_stream.set_close_callback( self.on_c2p_close)
+
+    def _p2s_start_connect(self):
+        # The proxy may have several backends, let the proxy select one
+        self.backend=self.proxy.select_backend(self)
+
+        # P->S state is "connecting"
+        # Get a Proxy->Server stream that is already connected from the proxy's connection-pool (if any)
+        # or let the proxy connect a new Proxy->Server stream (p2s_stream is None until it's connected)
+        self.p2s_state=self.p2s_state=Session.State.CONNECTING
+        self.p2s_stream=None
+        self.p2s_connector=None
+        self.p2s_retry_timeout=None
+        self.p2s_failed_backends=None   # The backends that we failed to connect to (a list, created on the first failure)
+        self._p2s_connect()
+
+    def _p2s_connect(self):
         """
-        We use this decorator to wrap functions and log the input/ouput of each function
-        Since this decorator accepts a parameter, it must return an "inner" decorator....(Python stuff)
+        Get a Proxy->Server stream to self.backend (from the connection-pool, or connect a new one)
         """
-        def inner_decorator(func):
-            
-        
-            def log_wrapper(self,*args,**kwargs):
-
-                msg="%s (%s,%s)" % (func.__name__,args,kwargs)
-
-            
-                self.log(msg)
-                self.logger_nesting_level+=1
-                r=func(self,*args,**kwargs)
-                self.logger_nesting_level-=1
-                self.log("%s -> %s" % (msg,str(r)) )
-                return r
-            return log_wrapper if enabled else func
-            
-
-        return inner_decorator
-
-        
-        
+        self.p2s_connect_start=time.time()
+        pooled_stream=None
+        if self.proxy.connection_pool is not None:
+            pooled_stream=self.proxy.connection_pool.get(self.backend)
+        if pooled_stream is not None:
+            self._on_p2s_connected(pooled_stream)
+        else:
+            self.p2s_connector=self.proxy.connect(self.backend,self._on_p2s_connected)
+    
     ################
     ## Start Read ##
     ################
-    @logger(LoggerOptions.LOG_READ_OP)
     def c2p_start_read(self):
         """
-        Start read from client
+        Start read from client.
+        We read chunk by chunk (instead of read_until_close) so we can stop reading when the server is slow
         """
         assert( not self.c2p_reading)
         self.c2p_reading=True
         try:
-            self.c2p_stream.read_until_close(lambda x: None,self.on_c2p_done_read)
+            self.c2p_stream.read_bytes(self.c2p_stream.read_chunk_size,self._on_c2p_read_chunk,partial=True)
         except tornado.iostream.StreamClosedError:
             self.c2p_reading=False
 
-    @logger(LoggerOptions.LOG_READ_OP)
     def p2s_start_read(self):
         """
         Start read from server
+        We read chunk by chunk (instead of read_until_close) so we can stop reading when the client is slow
         """
         assert( not self.p2s_reading)
         self.p2s_reading=True
         try:
-            self.p2s_stream.read_until_close(lambda x:None,self.on_p2s_done_read)
+            self.p2s_stream.read_bytes(self.p2s_stream.read_chunk_size,self._on_p2s_read_chunk,partial=True)
         except tornado.iostream.StreamClosedError:    
             self.p2s_reading=False
+
+
+    def _on_c2p_read_chunk(self,data):
+        """
+        A chunk was read from the client. Pass it to on_c2p_done_read and read the next chunk
+        (unless the reading was paused, or the client has already closed the connection)
+        """
+        self.c2s_bytes+=len(data)
+        self.c2s_chunks+=1
+        if self.timeout_timer is not None:
+            self.last_activity=self.proxy.timer_wheel.now
+        self.on_c2p_done_read(data)
+        hooks=self.proxy.hooks.on_data
+        if hooks:
+            maproxy.hooks.run(hooks,self,maproxy.hooks.C2S,memoryview(data))
+        shaper=self.proxy.shaper
+        if shaper is not None and shaper.consume(self,maproxy.hooks.C2S,len(data)):
+            self.c2p_read_throttled=True
+        self.c2p_reading=False
+        if self.c2p_state==Session.State.CLOSED:
+            # The client closed the connection while we were reading its leftovers (see on_c2p_close)
+            self.c2p_start_read()
+            if not self.c2p_reading:
+                self._on_c2p_closed()
+        elif not self.c2p_read_paused and not self.c2p_read_throttled:
+            self.c2p_start_read()
+
+    def _on_p2s_read_chunk(self,data):
+        """
+        A chunk was read from the server. Pass it to on_p2s_done_read and read the next chunk
+        (unless the reading was paused, or the server has already closed the connection)
+        """
+        self.s2c_bytes+=len(data)
+        self.s2c_chunks+=1
+        if self.s2c_chunks == 1:
+            self._observe_first_byte()
+        if self.timeout_timer is not None:
+            self.last_activity=self.proxy.timer_wheel.now
+        self.on_p2s_done_read(data)
+        hooks=self.proxy.hooks.on_data
+        if hooks:
+            maproxy.hooks.run(hooks,self,maproxy.hooks.S2C,memoryview(data))
+        shaper=self.proxy.shaper
+        if shaper is not None and shaper.consume(self,maproxy.hooks.S2C,len(data)):
+            self.p2s_read_throttled=True
+        self.p2s_reading=False
+        if self.p2s_state==Session.State.CLOSED:
+            # The server closed the connection while we were reading its leftovers (see on_p2s_close)
+            self.p2s_start_read()
+            if not self.p2s_reading:
+                self._on_p2s_closed()
+        elif not self.p2s_read_paused and not self.p2s_read_throttled:
+            self.p2s_start_read()
     
     
     ##############################
     ## Read Completion Routines ##
     ##############################
-    @logger(LoggerOptions.LOG_READ_OP)
     def on_c2p_done_read(self,data):
         # # We got data from the client (C->P ) . Send data to the server
         assert(self.c2p_reading)
@@ -197,7 +256,6 @@ class Session(object):
         self.p2s_start_write(data)
         
         
-    @logger(LoggerOptions.LOG_READ_OP)
     def on_p2s_done_read(self,data):
         # got data from Server to Proxy . if the client is still connected - send the data to the client
         assert( self.p2s_reading)
@@ -205,10 +263,65 @@ class Session(object):
         self.c2p_start_write(data)
 
 
+    ###################
+    ## Back-Pressure ##
+    ###################
+    # Number of bytes that are queued in each direction
+    c2s_queued_bytes=property(lambda self: self.c2s_queued_data.nbytes)
+    s2c_queued_bytes=property(lambda self: self.s2c_queued_data.nbytes)
+
+    def _c2s_queue_changed(self):
+        """
+        The C->S queue (c2s_queued_data) has changed. Pause/Resume the reading from the client according
+        to the proxy's watermarks
+        """
+        if self.proxy.high_watermark is None:
+            return
+        if not self.c2p_read_paused:
+            if self.c2s_queued_bytes > self.proxy.high_watermark:
+                self.c2p_read_paused=True
+        elif self.c2s_queued_bytes <= self.proxy.low_watermark:
+            self.c2p_read_paused=False
+            if self.c2p_state==Session.State.CONNECTED and not self.c2p_reading and not self.c2p_read_throttled:
+                self.c2p_start_read()
+
+    def _s2c_queue_changed(self):
+        """
+        The S->C queue (s2c_queued_data) has changed. Pause/Resume the reading from the server according
+        to the proxy's watermarks
+        """
+        if self.proxy.high_watermark is None:
+            return
+        if not self.p2s_read_paused:
+            if self.s2c_queued_bytes > self.proxy.high_watermark:
+                self.p2s_read_paused=True
+        elif self.s2c_queued_bytes <= self.proxy.low_watermark:
+            self.p2s_read_paused=False
+            if self.p2s_state==Session.State.CONNECTED and not self.p2s_reading and not self.p2s_read_throttled:
+                self.p2s_start_read()
+
+
+    #######################
+    ## Bandwidth Shaping ##
+    #######################
+    def resume_shaped_read(self,direction):
+        """
+        Called by the proxy's BandwidthShaper (see maproxy.shaping) when the session may read again in the
+        direction (maproxy.hooks.C2S: from the client , S2C: from the server)
+        """
+        if direction == maproxy.hooks.C2S:
+            self.c2p_read_throttled=False
+            if self.c2p_state==Session.State.CONNECTED and not self.c2p_reading and not self.c2p_read_paused:
+                self.c2p_start_read()
+        else:
+            self.p2s_read_throttled=False
+            if self.p2s_state==Session.State.CONNECTED and not self.p2s_reading and not self.p2s_read_paused:
+                self.p2s_start_read()
+
+
     #####################
     ## Write to stream ##
     #####################
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def _c2p_io_write(self,data):
         if data is None:
             # None means (gracefully) close-socket  (a "close request" that was queued...)
@@ -224,7 +337,6 @@ class Session(object):
             except tornado.iostream.StreamClosedError:
                 # Cancel the write, we will get on_close instead...
                 self.c2p_writing=False
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def _p2s_io_write(self,data):
         if data is None:
             # None means (gracefully) close-socket  (a "close request" that was queued...)
@@ -246,7 +358,6 @@ class Session(object):
     #################
     ## Start Write ##
     #################
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def c2p_start_write(self,data):
         """
         Write to client.if there's a pending write-operation, add it to the S->C (s2c) queue
@@ -263,8 +374,8 @@ class Session(object):
         else:
             # Just add to the queue
             self.s2c_queued_data.append(data)
+            self._s2c_queue_changed()
     
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def p2s_start_write(self,data):
         """
         Write to the server.
@@ -274,7 +385,7 @@ class Session(object):
         
         # If still connecting to the server - queue the data...
         if self.p2s_state == Session.State.CONNECTING:  
-            self.c2s_queued_data.append(data)   # TODO: is it better here to append (to list) or concatenate data (to buffer) ?
+            self._p2s_queue_data(data)
             return
         # If not connected - do nothing
         if self.p2s_state == Session.State.CLOSED:  
@@ -286,13 +397,27 @@ class Session(object):
             self._p2s_io_write(data)
         else:
             # Just add to the queue
-            self.c2s_queued_data.append(data)
+            self._p2s_queue_data(data)
+
+    def _p2s_queue_data(self,data):
+        """
+        Add data to the C->S queue (the data will be written to the server later)
+        """
+        self.c2s_queued_data.append(data)
+        self._c2s_queue_changed()
+
+    def _p2s_dequeue_data(self):
+        """
+        Remove (and return) the next batch in the C->S queue
+        """
+        data=self.c2s_queued_data.pop_batch(self.proxy.write_batch_size)
+        self._c2s_queue_changed()
+        return data
 
     
     ##############################
     ## Write Competion Routines ##
     ##############################
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def on_c2p_done_write(self):
         """
         A start_write C->P  (write to client) is done .
@@ -300,14 +425,15 @@ class Session(object):
         """
         assert(self.c2p_writing)
         if self.s2c_queued_data:
-            # more data in the queue, write next item as well..
-            self._c2p_io_write( self.s2c_queued_data.pop(0))
+            # more data in the queue, write all of it (up to write_batch_size) as well..
+            data=self.s2c_queued_data.pop_batch(self.proxy.write_batch_size)
+            self._s2c_queue_changed()
+            self._c2p_io_write(data)
             return
         self.c2p_writing=False
         
     
         
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def on_p2s_done_write(self):
         """
         A start_write P->S  (write to server) is done .
@@ -315,8 +441,8 @@ class Session(object):
         """
         assert(self.p2s_writing)
         if self.c2s_queued_data:
-            # more data in the queue, write next item as well..
-            self._p2s_io_write( self.c2s_queued_data.pop(0))
+            # more data in the queue, write all of it (up to write_batch_size) as well..
+            self._p2s_io_write( self._p2s_dequeue_data() )
             return
         self.p2s_writing=False
         
@@ -325,7 +451,6 @@ class Session(object):
     ######################
     ## Close Connection ##
     ######################
-    @logger(LoggerOptions.LOG_CLOSE_OP)
     def c2p_start_close(self,gracefully=True):
         """
         Close c->p connection
@@ -343,13 +468,15 @@ class Session(object):
             return
 
         self.c2p_state = Session.State.CLOSED
-        self.s2c_queued_data=[]
+        self.s2c_queued_data.clear()
+        self._s2c_queue_changed()
+        # We handle the close here, so we don't need the close-callback
+        self.c2p_stream.set_close_callback(None)
         self.c2p_stream.close()
         if self.p2s_state == Session.State.CLOSED:
             self.remove_session()
             
             
-    @logger(LoggerOptions.LOG_CLOSE_OP)
     def p2s_start_close(self,gracefully=True):
         """
         Close p->s connection
@@ -367,13 +494,29 @@ class Session(object):
             return
 
         self.p2s_state = Session.State.CLOSED
-        self.c2s_queued_data=[]
-        self.p2s_stream.close()
+        self.c2s_queued_data.clear()
+        self._c2s_queue_changed()
+        if self.p2s_stream is not None:
+            # We handle the close here, so we don't need the close-callback
+            self.p2s_stream.set_close_callback(None)
+            self.p2s_stream.close()
+        else:
+            # Still connecting (or waiting to retry)
+            self._p2s_cancel_connect()
         if self.c2p_state == Session.State.CLOSED:
             self.remove_session()
         
 
-    @logger(LoggerOptions.LOG_CLOSE_OP)
+    def abort(self):
+        """
+        Close both connections now with a RST (SO_LINGER 0) , the queued data is dropped
+        """
+        for stream in (self.c2p_stream,self.p2s_stream):
+            if stream is not None:
+                maproxy.admission.reset_on_close(stream)
+        self.c2p_start_close(gracefully=False)
+        self.p2s_start_close(gracefully=False)
+
     def on_c2p_close(self):
         """
         Client closed the connection.
@@ -383,67 +526,276 @@ class Session(object):
         3. if p2s already closed - we can remove the session
         """
         self.c2p_state=Session.State.CLOSED
+        if self.c2p_read_paused or self.c2p_read_throttled:
+            # The reading was paused (back-pressure or bandwidth-shaping), so the stream may still hold data that
+            # we didn't read yet. Read it first, _on_c2p_read_chunk will complete the close when there's no more data
+            self.c2p_read_paused=False
+            self.c2p_read_throttled=False
+            if not self.c2p_reading:
+                self.c2p_start_read()
+            if self.c2p_reading:
+                return
+        self._on_c2p_closed()
+
+    def _on_c2p_closed(self):
+        """
+        The client connection is closed and all its data was read.
+        Close the server connection (gracefully), or remove the session if it's already closed
+        """
         if self.p2s_state == Session.State.CLOSED:
             self.remove_session()
         else:
+            self._half_closed()
             self.p2s_start_close(gracefully=True)
             
 
-    @logger(LoggerOptions.LOG_CLOSE_OP)
     def on_p2s_close(self):
         """
         Server closed the connection.
         We need to update the satte, and if the client closed as well - delete the session
         """
+        if self.p2s_state==Session.State.CONNECTED and maproxy.healthcheck.is_connection_reset(self.p2s_stream):
+            self.backend.resets+=1
+            self._report_backend_failure()
         self.p2s_state=Session.State.CLOSED
+        if self.p2s_read_paused or self.p2s_read_throttled:
+            # The reading was paused (back-pressure or bandwidth-shaping), so the stream may still hold data that
+            # we didn't read yet. Read it first, _on_p2s_read_chunk will complete the close when there's no more data
+            self.p2s_read_paused=False
+            self.p2s_read_throttled=False
+            if not self.p2s_reading:
+                self.p2s_start_read()
+            if self.p2s_reading:
+                return
+        self._on_p2s_closed()
+
+    def _on_p2s_closed(self):
+        """
+        The server connection is closed and all its data was read.
+        Close the client connection (gracefully), or remove the session if it's already closed
+        """
         if self.c2p_state == Session.State.CLOSED:
             self.remove_session()
         else:
+            self._half_closed()
             self.c2p_start_close(gracefully=True)
         
     ########################
     ## Connect-Completion ##
     ########################
-    @logger(LoggerOptions.LOG_CONNECT_OP)
+    def _on_p2s_connected(self,stream):
+        """
+        The proxy connected the Proxy->Server stream (stream is None if we could not connect)
+        """
+        self.p2s_connector=None
+        if stream is None:
+            # We could not connect to the server
+            self.backend.connect_failures+=1
+            self.proxy.metrics.connect_failures+=1
+            self._report_backend_failure()
+            hooks=self.proxy.hooks.on_connect_failure
+            if hooks:
+                maproxy.hooks.run(hooks,self,self.backend)
+            if self.p2s_failed_backends is None:
+                self.p2s_failed_backends=[]
+            self.p2s_failed_backends.append(self.backend)
+            if len(self.p2s_failed_backends) <= self.proxy.connect_retries:
+                self._p2s_retry_connect()
+                return
+            # Same as if the stream was closed while connecting
+            self.on_p2s_close()
+            return
+        self.p2s_stream=stream
+        self._observe_connect(stream)
+        # Let us now when the server disconnects (callback on_p2s_close)
+        self.p2s_stream.set_close_callback(  self.on_p2s_close )
+        self.on_p2s_done_connect()
+
+    def _p2s_retry_connect(self):
+        """
+        Connect again (the data that the client has sent is still queued , so it will be sent after the connect).
+        We prefer another backend (fail-over). If we retry a backend that already failed, we wait a bit (back-off)
+        """
+        self.proxy.release_backend(self.backend)
+        self.backend=self.proxy.select_backend(self,exclude=self.p2s_failed_backends)
+        retries=self.p2s_failed_backends.count(self.backend)
+        delay=0
+        if retries:
+            delay=self.proxy.retry_backoff * 2**(retries-1) * random.uniform(0.5,1.5)
+        self.p2s_retry_timeout=tornado.ioloop.IOLoop.current().add_timeout(time.time()+delay,self._p2s_retry_now)
+
+    def _p2s_retry_now(self):
+        self.p2s_retry_timeout=None
+        self.p2s_connector=self.proxy.connect(self.backend,self._on_p2s_connected)
+
+    def _p2s_cancel_connect(self):
+        if self.p2s_connector is not None:
+            self.p2s_connector.close()
+            self.p2s_connector=None
+        if self.p2s_retry_timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.p2s_retry_timeout)
+            self.p2s_retry_timeout=None
+
     def on_p2s_done_connect(self):
         assert(self.p2s_state==Session.State.CONNECTING)
         self.p2s_state=Session.State.CONNECTED
+        if self.proxy.health_checker is not None:
+            self.proxy.health_checker.report_success(self.backend)
+        hooks=self.proxy.hooks.on_connect
+        if hooks:
+            maproxy.hooks.run(hooks,self)
         # Start reading from the socket
         self.p2s_start_read()
         assert(not self.p2s_writing)    # As expect no current write-operation ...
         
         # If we have pending-data to write, start writing...
         if self.c2s_queued_data:
-            # TRICKY: get thte frst item , and write it...
+            # TRICKY: get thte frst batch , and write it...
             # this is tricky since the "start-write" will 
             # write this item even if there are queued-items... (since self.p2s_writing=False)
-            self.p2s_start_write( self.c2s_queued_data.pop(0)  )
+            self.p2s_start_write( self._p2s_dequeue_data()  )
     
+    ##############
+    ## Timeouts ##
+    ##############
+    def _schedule_timeout(self):
+        """
+        Add a timer (to the proxy's timer-wheel) for the nearest timeout of this session
+        """
+        proxy=self.proxy
+        deadlines=[]
+        if proxy.idle_timeout:
+            deadlines.append(self.last_activity+proxy.idle_timeout)
+        if proxy.max_lifetime:
+            deadlines.append(self.start_time+proxy.max_lifetime)
+        if proxy.half_close_timeout and self.half_closed_time is not None:
+            deadlines.append(self.half_closed_time+proxy.half_close_timeout)
+        if deadlines:
+            self.timeout_timer=proxy.timer_wheel.add(min(deadlines),self._on_timeout)
+
+    def _cancel_timeout(self):
+        if self.timeout_timer is not None:
+            self.proxy.timer_wheel.cancel(self.timeout_timer)
+            self.timeout_timer=None
+
+    def _on_timeout(self):
+        """
+        The timer of the session has expired. Since we don't update the timer on every read (we only update
+        last_activity), we have to check which timeout (if any) has really expired
+        """
+        self.timeout_timer=None
+        proxy=self.proxy
+        now=proxy.timer_wheel.now
+        expired=(proxy.idle_timeout and now >= self.last_activity+proxy.idle_timeout) or \
+                (proxy.max_lifetime and now >= self.start_time+proxy.max_lifetime) or \
+                (proxy.half_close_timeout and self.half_closed_time is not None and \
+                 now >= self.half_closed_time+proxy.half_close_timeout)
+        if not expired:
+            self._schedule_timeout()
+            return
+        # Reap the session
+        self.c2p_start_close(gracefully=False)
+        self.p2s_start_close(gracefully=False)
+
+    def _half_closed(self):
+        """
+        One side was closed, while the other side is still open
+        """
+        if self.half_closed_time is not None:
+            return
+        self.half_closed_time=time.time()
+        if self.proxy.half_close_timeout and self.proxy.timer_wheel is not None:
+            # The half-close timeout may be sooner than the current timer
+            self._cancel_timeout()
+            self._schedule_timeout()
+
+    #############
+    ## Metrics ##
+    #############
+    def _observe_connect(self,stream):
+        """
+        The Proxy->Server stream is connected: add the connect time (and the SSL handshake time) to the histograms
+        """
+        metrics=self.proxy.metrics
+        metrics.connect_time.observe(time.time()-self.p2s_connect_start)
+        ssl_handshake_time=getattr(stream,"ssl_handshake_time",None)
+        if ssl_handshake_time is not None:
+            metrics.ssl_handshake_time.observe(ssl_handshake_time)
+
+    def _observe_first_byte(self):
+        self.proxy.metrics.time_to_first_byte.observe(time.time()-self.start_time)
+
     ###########
     ## UTILS ##
     ###########
-    @logger(LoggerOptions.LOG_REMOVE_SESSION)
+    def _report_backend_failure(self):
+        """
+        Let the health-checker know that the backend failed (passive health-check)
+        """
+        if self.proxy.health_checker is not None:
+            self.proxy.health_checker.report_failure(self.backend)
+
     def remove_session(self):
+        self._cancel_timeout()
         self.proxy.remove_session(self)
 
+    def reset(self):
+        """
+        The session was removed and is about to be reused (see SessionFactory's pool_size):
+        drop the references to the streams, the proxy, the backend,... and empty the buffers (they are kept,
+        new_connection reuses them)
+        """
+        self.proxy=None
+        self.backend=None
+        self.c2p_stream=None
+        self.c2p_address=None
+        self.p2s_stream=None
+        self.p2s_connector=None
+        self.p2s_retry_timeout=None
+        self.p2s_failed_backends=None
+        self.timeout_timer=None
+        self.shaper_state=None
+        self.c2s_queued_data.clear()
+        self.s2c_queued_data.clear()
+
 
 class SessionFactory(object):
     """
-    This is  the default session-factory. it simply returns a "Session" object
+    This is  the default session-factory. it returns "session_class" (Session) objects.
+    If pool_size is set, the removed sessions are kept (up to pool_size sessions) and reused by the next
+    connections, instead of allocating a new session (and its buffers) for each connection.
+    A session is returned to the pool on the next IOLoop iteration (after the callbacks of its closed streams)
     """
-    def __init__(self):
-        pass
+    session_class=Session
+
+    def __init__(self,pool_size=0):
+        """
+        Input Parameters:
+            pool_size   : maximum number of removed sessions to keep for reuse (0 - no pool)
+        """
+        self.pool_size=pool_size
+        self.pool=[]
+        self.reused=0       # Number of sessions that were taken from the pool
         
     def new(self,*args,**kwargs):
         """
         The caller needs a Session objet (constructed with *args,**kwargs).
-        In this implementation we're simply creating a new object. you can enhance and create a pool or add logs..
+        We reuse a session from the pool (if any) , or create a new object.
         """
-        return Session(*args,**kwargs)
+        if self.pool:
+            self.reused+=1
+            return self.pool.pop()
+        return self.session_class(*args,**kwargs)
     def delete(self,session):
         """
-        Delete a session object
+        Delete a session object (keep it in the pool , if there's room)
         """
         assert( isinstance(session,Session))
-        del session
+        if len(self.pool) < self.pool_size and type(session) is self.session_class:
+            tornado.ioloop.IOLoop.current().add_callback(self._recycle,session)
+
+    def _recycle(self,session):
+        if len(self.pool) < self.pool_size:
+            session.reset()
+            self.pool.append(session)
         
\ No newline at end of file
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import collections
+import heapq
+
+
+
+class SessionTable(object):
+    """
+    The sessions of a ProxyServer (replaces the plain list).
+    - Each session gets a session_id (unique in the table) when it is added
+    - Adding/removing a session is O(1)
+    - Secondary indexes: by the client's host (session.c2p_address[0]) and by the backend (session.backend)
+    - Iteration is by age (the oldest session first)
+    - when_empty() registers a callback for the moment the table becomes empty (e.g. a graceful stop)
+    The backend index is updated by the proxy when a session switches to another backend (connect fail-over)
+    """
+    def __init__(self):
+        self._sessions=collections.OrderedDict()    # session_id->session (oldest first)
+        self._by_client={}                          # client's host->set of sessions
+        self._by_backend={}                         # backend->set of sessions
+        self._next_id=1
+        self._empty_callbacks=[]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def __contains__(self,session):
+        return self._sessions.get(getattr(session,"session_id",None)) is session
+
+    ############
+    ## Update ##
+    ############
+    def add(self,session):
+        """
+        Add the session (assigns session.session_id) , returns the session_id
+        """
+        session.session_id=self._next_id
+        self._next_id+=1
+        self._sessions[session.session_id]=session
+        SessionTable._index_add(self._by_client,SessionTable._client_host(session),session)
+        backend=getattr(session,"backend",None)
+        if backend is not None:
+            SessionTable._index_add(self._by_backend,backend,session)
+        return session.session_id
+
+    def remove(self,session):
+        del self._sessions[session.session_id]
+        SessionTable._index_remove(self._by_client,SessionTable._client_host(session),session)
+        backend=getattr(session,"backend",None)
+        if backend is not None:
+            SessionTable._index_remove(self._by_backend,backend,session)
+        if self._empty_callbacks and not self._sessions:
+            callbacks,self._empty_callbacks=self._empty_callbacks,[]
+            for callback in callbacks:
+                callback()
+
+    def when_empty(self,callback):
+        """
+        Call callback() once, when the last session is removed (immediately if the table is already empty).
+        NOTE: the callback is called from remove() , in the middle of the session's close
+        """
+        if not self._sessions:
+            callback()
+            return
+        self._empty_callbacks.append(callback)
+
+    def update_backend(self,session,backend):
+        """
+        The session switches from session.backend to another backend (does nothing if the session is not in the table)
+        """
+        if session not in self:
+            return
+        if getattr(session,"backend",None) is not None:
+            SessionTable._index_remove(self._by_backend,session.backend,session)
+        SessionTable._index_add(self._by_backend,backend,session)
+
+    @staticmethod
+    def _client_host(session):
+        address=session.c2p_address
+        return address[0] if isinstance(address,tuple) else address
+
+    @staticmethod
+    def _index_add(index,key,session):
+        sessions=index.get(key)
+        if sessions is None:
+            sessions=index[key]=set()
+        sessions.add(session)
+
+    @staticmethod
+    def _index_remove(index,key,session):
+        sessions=index.get(key)
+        if sessions is None:
+            return
+        sessions.discard(session)
+        if not sessions:
+            del index[key]
+
+    #############
+    ## Queries ##
+    #############
+    def get(self,session_id):
+        """
+        The session (or None)
+        """
+        return self._sessions.get(session_id)
+
+    def by_client(self,host):
+        """
+        The sessions of a client (by the client's host/IP)
+        """
+        return list(self._by_client.get(host,()))
+
+    def by_backend(self,backend):
+        return list(self._by_backend.get(backend,()))
+
+    def count_by_client(self,host):
+        return len(self._by_client.get(host,()))
+
+    def count_by_backend(self,backend):
+        return len(self._by_backend.get(backend,()))
+
+    def clients(self):
+        """
+        {client's host: number of sessions}
+        """
+        return dict((host,len(sessions)) for host,sessions in self._by_client.items())
+
+    def oldest(self,n=1):
+        """
+        The n oldest sessions (the oldest first) , O(n)
+        """
+        result=[]
+        for session in self._sessions.values():
+            if len(result) == n:
+                break
+            result.append(session)
+        return result
+
+    def most_bytes(self,n=1):
+        """
+        The n sessions that transferred the most bytes (both directions) , the biggest first.
+        NOTE: the byte counters change all the time, so they are not indexed: this query walks the sessions
+              (O(sessions*log(n)))
+        """
+        return heapq.nlargest(n,self._sessions.values(),key=lambda session: session.c2s_bytes+session.s2c_bytes)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import time
+import tornado.ioloop
+import maproxy.hooks
+
+
+
+# Directions (the same as the hooks' , the buckets are kept per direction , the rates are (c2s,s2c) tuples)
+C2S,S2C=maproxy.hooks.C2S,maproxy.hooks.S2C
+DIRECTIONS=(C2S,S2C)
+
+
+class TokenBucket(object):
+    """
+    Token-bucket of bytes: "rate" bytes per second, up to "burst" bytes. The tokens may go below zero (a chunk
+    that was already read is never split) , the reading is paused until the bucket is refilled
+    """
+    __slots__=("rate","burst","tokens","time")
+
+    def __init__(self,rate,burst,now):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=burst
+        self.time=now
+
+    def refill(self,now):
+        if now > self.time:
+            self.tokens=min(self.burst,self.tokens+(now-self.time)*self.rate)
+            self.time=now
+
+    def set_rate(self,rate,burst):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=min(self.tokens,burst)
+
+
+class BandwidthShaper(object):
+    """
+    Bandwidth limits of a ProxyServer's sessions: token-buckets per session, per client IP and for the whole proxy,
+    for each direction (client->server , server->client).
+    - The session consumes tokens for every chunk that it reads (from all its buckets). When a bucket is empty,
+      the session stops reading in that direction (the data is not buffered, the sockets' buffers fill up and TCP
+      slows the sender down)
+    - The buckets are refilled by the elapsed time (when they are used) , and one periodic tick (that runs only
+      while some sessions are paused) resumes the paused sessions whose buckets have tokens again
+    - The rates can be changed at any time (set_rates , set_session_rate)
+    Each rate is bytes-per-second: None (no limit), a number (both directions) or a (c2s,s2c) tuple
+    """
+    def __init__(self,session_rate=None,client_rate=None,proxy_rate=None,burst=1.0,interval=0.05):
+        """
+        Input Parameters:
+            session_rate    : the rate of each session
+            client_rate     : the rate of all the sessions of a client IP
+            proxy_rate      : the rate of all the proxy's sessions
+            burst           : the size of each bucket (seconds of its rate)
+            interval        : the tick (seconds) that resumes the paused sessions
+        """
+        self.burst=burst
+        self.interval=interval
+        self.proxy=None
+        self.session_rate=self.client_rate=self.proxy_rate=(None,None)
+        self._proxy_buckets={C2S:None,S2C:None}
+        self._clients={}            # client's host->[{direction:bucket},number of sessions]
+        self._paused=set()          # (session,direction)
+        self._periodic_callback=None
+        self.set_rates(session_rate,client_rate,proxy_rate)
+
+    def attach(self,proxy):
+        """
+        Called by the ProxyServer (every proxy needs its own BandwidthShaper)
+        """
+        assert self.proxy is None , "The BandwidthShaper is already attached to a proxy"
+        self.proxy=proxy
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback=None
+
+    ###########
+    ## Rates ##
+    ###########
+    @staticmethod
+    def _rates(rate):
+        return tuple(rate) if isinstance(rate,(tuple,list)) else (rate,rate)
+
+    def _update_buckets(self,buckets,rates,now):
+        for direction,rate in zip(DIRECTIONS,rates):
+            if rate is None:
+                buckets[direction]=None
+            elif buckets[direction] is None:
+                buckets[direction]=TokenBucket(rate,rate*self.burst,now)
+            else:
+                buckets[direction].set_rate(rate,rate*self.burst)
+
+    _UNCHANGED=object()
+
+    def set_rates(self,session_rate=_UNCHANGED,client_rate=_UNCHANGED,proxy_rate=_UNCHANGED):
+        """
+        Change the rates (the rates that are not passed are not changed) . Applies to the open sessions as well
+        """
+        now=time.time()
+        if session_rate is not BandwidthShaper._UNCHANGED:
+            self.session_rate=BandwidthShaper._rates(session_rate)
+        if client_rate is not BandwidthShaper._UNCHANGED:
+            self.client_rate=BandwidthShaper._rates(client_rate)
+            for client in self._clients.values():
+                self._update_buckets(client[0],self.client_rate,now)
+        if proxy_rate is not BandwidthShaper._UNCHANGED:
+            self.proxy_rate=BandwidthShaper._rates(proxy_rate)
+            self._update_buckets(self._proxy_buckets,self.proxy_rate,now)
+        if self.proxy is not None:
+            for session in self.proxy.sessions:
+                if session.shaper_state is not None:
+                    if session_rate is not BandwidthShaper._UNCHANGED and not session.shaper_state.custom_rate:
+                        self._update_buckets(session.shaper_state.buckets,self.session_rate,now)
+                    session.shaper_state.update(self)
+        # A higher rate (or no limit) may resume sessions now
+        self._on_tick()
+
+    def set_session_rate(self,session,rate):
+        """
+        Change the rate of one session (None: no limit)
+        """
+        state=self._state(session)
+        state.custom_rate=True
+        self._update_buckets(state.buckets,BandwidthShaper._rates(rate),time.time())
+        state.update(self)
+        self._on_tick()
+
+    #############
+    ## Session ##
+    #############
+    def _state(self,session):
+        state=session.shaper_state
+        if state is None:
+            state=session.shaper_state=SessionShaping(self,session)
+        return state
+
+    def consume(self,session,direction,size):
+        """
+        The session read "size" bytes in the direction. Returns True if the session should stop reading in
+        this direction (then resume(session,direction) is called when it can read again)
+        """
+        buckets=self._state(session).checked[direction]
+        if not buckets:
+            return False
+        now=time.time()
+        empty=False
+        for bucket in buckets:
+            bucket.refill(now)
+            bucket.tokens-=size
+            if bucket.tokens < 0:
+                empty=True
+        if empty:
+            self._paused.add((session,direction))
+            if self._periodic_callback is None:
+                self._periodic_callback=tornado.ioloop.PeriodicCallback(self._on_tick,self.interval*1000)
+                self._periodic_callback.start()
+        return empty
+
+    def session_closed(self,session):
+        """
+        Called by the ProxyServer when the session is removed
+        """
+        state=session.shaper_state
+        if state is None:
+            return
+        session.shaper_state=None
+        self._paused.discard((session,C2S))
+        self._paused.discard((session,S2C))
+        if state.client_host is not None:
+            client=self._clients[state.client_host]
+            client[1]-=1
+            if not client[1]:
+                del self._clients[state.client_host]
+
+    def _on_tick(self):
+        """
+        Resume the paused sessions that have tokens again (in all their buckets)
+        """
+        now=time.time()
+        for session,direction in list(self._paused):
+            state=session.shaper_state
+            if state is not None:
+                for bucket in state.checked[direction]:
+                    bucket.refill(now)
+                    if bucket.tokens < 0:
+                        break
+                else:
+                    state=None
+            if state is None:
+                self._paused.discard((session,direction))
+                if session.shaper_state is not None:
+                    session.resume_shaped_read(direction)
+        if not self._paused:
+            self.stop()
+
+
+class SessionShaping(object):
+    """
+    The shaping state of a session (session.shaper_state): its own buckets, and the buckets that it checks
+    for each direction (its own , its client's and the proxy's)
+    """
+    __slots__=("buckets","client_host","custom_rate","checked")
+
+    def __init__(self,shaper,session):
+        now=time.time()
+        self.buckets={C2S:None,S2C:None}
+        self.custom_rate=False
+        shaper._update_buckets(self.buckets,shaper.session_rate,now)
+        address=session.c2p_address
+        self.client_host=address[0] if isinstance(address,tuple) else address
+        client=shaper._clients.get(self.client_host)
+        if client is None:
+            client=shaper._clients[self.client_host]=[{C2S:None,S2C:None},0]
+            shaper._update_buckets(client[0],shaper.client_rate,now)
+        client[1]+=1
+        self.update(shaper)
+
+    def update(self,shaper):
+        client_buckets=shaper._clients[self.client_host][0]
+        self.checked={direction:tuple(bucket for bucket in (self.buckets[direction],client_buckets[direction],
+                                                             shaper._proxy_buckets[direction]) if bucket is not None)
+                      for direction in DIRECTIONS}
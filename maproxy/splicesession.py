@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import tornado.ioloop
+import tornado.iostream
+import maproxy.session
+import maproxy.hooks
+import maproxy.admission
+
+
+
+class SpliceSession(maproxy.session.Session):
+    """
+    Zero-copy session for TCP->TCP proxies on Linux.
+    Instead of reading the data into Python (and writing it again), the data is moved by the kernel with
+    os.splice(): socket -> pipe -> socket , a pipe per direction. The IOLoop still tells us when the sockets
+    are readable/writable.
+    - The session is used only when the proxy has no SSL (client_ssl_options and server_ssl_options are None)
+      and os.splice is available (Python 3.10+ , Linux) . Otherwise it's a regular Session
+    - The client's socket is not read until we're connected to the server (the kernel buffers the client's data)
+    - Since the data never gets to Python, the on_c2p_done_read/on_p2s_done_read notifications (and the on_data
+      hooks) are not called
+    - The close semantics are the same as the Session's: when one side closes the connection, we send the data
+      that we already have to the other side, and close it.
+    - If we can't connect to the server, or the server's stream already has buffered data (e.g. a pooled
+      connection that got a banner), the session falls back to the regular Session behavior
+    """
+    # Capacity of each pipe (the amount of data "in flight" per direction)
+    PIPE_SIZE=65536
+
+    __slots__=("splice_state","c2p_socket","p2s_socket","_ioloop","_splice_pipes","_splice_bytes","_splice_eof",
+               "_splice_src","_splice_dst","_splice_events")
+
+    class SpliceState:
+        CONNECTING,ACTIVE=range(2)
+
+    @staticmethod
+    def is_supported(proxy):
+        return hasattr(os,"splice") and proxy.client_ssl_options is None and proxy.server_ssl_options is None
+
+    def _init_c2p_stream(self):
+        if not SpliceSession.is_supported(self.proxy):
+            self.splice_state=None
+            super(SpliceSession,self)._init_c2p_stream()
+            return
+        # Take over the client's socket: duplicate it and close the stream (so Tornado never reads from it)
+        self.splice_state=SpliceSession.SpliceState.CONNECTING
+        self.c2p_socket=self._detach(self.c2p_stream)
+        self.c2p_socket.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+    @staticmethod
+    def _detach(stream):
+        sock=socket.socket(fileno=os.dup(stream.socket.fileno()))
+        stream.set_close_callback(None)
+        stream.close()
+        return sock
+
+    def c2p_start_read(self):
+        if self.splice_state is not None:
+            return  # We don't read the client's data (it's spliced)
+        super(SpliceSession,self).c2p_start_read()
+
+    def _on_p2s_connected(self,stream):
+        if self.splice_state != SpliceSession.SpliceState.CONNECTING:
+            super(SpliceSession,self)._on_p2s_connected(stream)
+            return
+        if stream is None or getattr(stream,"_read_buffer_size",0) or stream.socket is None:
+            # Failed to connect (the retries and the close are handled by the regular Session),
+            # the stream already has data , or it has no socket (e.g. a maproxy.tunnel.TunnelStream)
+            self._splice_fallback()
+            super(SpliceSession,self)._on_p2s_connected(stream)
+            return
+        self._splice_start(stream)
+
+    def _splice_fallback(self):
+        """
+        Go back to the regular Session behavior (only while we're connecting)
+        """
+        self.splice_state=None
+        self.c2p_stream=tornado.iostream.IOStream(self.c2p_socket)
+        self.c2p_socket=None
+        super(SpliceSession,self)._init_c2p_stream()
+        self.c2p_start_read()
+
+    ##################
+    ## Close (API) ##
+    ##################
+    def c2p_start_close(self,gracefully=True):
+        if self.splice_state == SpliceSession.SpliceState.CONNECTING:
+            self._splice_fallback()
+        if self.splice_state is None:
+            super(SpliceSession,self).c2p_start_close(gracefully)
+        elif gracefully:
+            # Stop reading from the server, send what we have to the client and close
+            self._splice_eof[maproxy.hooks.S2C]=True
+            self._splice_update()
+        else:
+            self._splice_close()
+
+    def p2s_start_close(self,gracefully=True):
+        if self.splice_state == SpliceSession.SpliceState.CONNECTING:
+            self._splice_fallback()
+        if self.splice_state is None:
+            super(SpliceSession,self).p2s_start_close(gracefully)
+        elif gracefully:
+            # Stop reading from the client, send what we have to the server and close
+            self._splice_eof[maproxy.hooks.C2S]=True
+            self._splice_update()
+        else:
+            self._splice_close()
+
+    def abort(self):
+        if self.splice_state is not None:
+            for sock in (self.c2p_socket,getattr(self,"p2s_socket",None)):
+                if sock is not None:
+                    maproxy.admission.reset_on_close(sock)
+        super(SpliceSession,self).abort()
+
+    ############
+    ## Splice ##
+    ############
+    # Per direction (maproxy.hooks.C2S/S2C): the other direction (the fd that is the source of one direction is
+    # the destination of the other)
+    OPPOSITE={maproxy.hooks.C2S:maproxy.hooks.S2C,maproxy.hooks.S2C:maproxy.hooks.C2S}
+
+    def _splice_start(self,stream):
+        self.splice_state=SpliceSession.SpliceState.ACTIVE
+        self.p2s_stream=stream
+        self.p2s_socket=self._detach(stream)
+        self.p2s_state=maproxy.session.Session.State.CONNECTED
+        self._observe_connect(stream)
+        if self.proxy.health_checker is not None:
+            self.proxy.health_checker.report_success(self.backend)
+        hooks=self.proxy.hooks.on_connect
+        if hooks:
+            maproxy.hooks.run(hooks,self)
+
+        # Per direction: the pipe (read-fd,write-fd) , the number of bytes in the pipe , and whether the source closed
+        c2s,s2c=maproxy.hooks.C2S,maproxy.hooks.S2C
+        self._splice_pipes={c2s:os.pipe2(os.O_NONBLOCK|os.O_CLOEXEC),s2c:os.pipe2(os.O_NONBLOCK|os.O_CLOEXEC)}
+        self._splice_bytes={c2s:0,s2c:0}
+        self._splice_eof={c2s:False,s2c:False}
+        # Per direction: source and destination fds
+        c2p_fd,p2s_fd=self.c2p_socket.fileno(),self.p2s_socket.fileno()
+        self._splice_src={c2s:c2p_fd,s2c:p2s_fd}
+        self._splice_dst={c2s:p2s_fd,s2c:c2p_fd}
+        self._splice_events={c2p_fd:None,p2s_fd:None}
+
+        self._ioloop=tornado.ioloop.IOLoop.current()
+        self._ioloop.add_handler(c2p_fd,self._on_splice_events,tornado.ioloop.IOLoop.READ)
+        self._ioloop.add_handler(p2s_fd,self._on_splice_events,tornado.ioloop.IOLoop.READ)
+        self._splice_events[c2p_fd]=self._splice_events[p2s_fd]=tornado.ioloop.IOLoop.READ
+
+    def _on_splice_events(self,fd,events):
+        if self.splice_state != SpliceSession.SpliceState.ACTIVE:
+            return
+        # The fd is the source of one direction, and the destination of the other
+        direction=maproxy.hooks.C2S if fd == self._splice_src[maproxy.hooks.C2S] else maproxy.hooks.S2C
+        if events & tornado.ioloop.IOLoop.WRITE:
+            if not self._splice_flush(SpliceSession.OPPOSITE[direction]):
+                return
+        if events & (tornado.ioloop.IOLoop.READ|tornado.ioloop.IOLoop.ERROR):
+            if not self._splice_fill(direction):
+                return
+        self._splice_update()
+
+    def _splice_fill(self,direction):
+        """
+        Move data from the source socket into the pipe (and from the pipe to the destination)
+        Returns False if the session was closed
+        """
+        pipe_w=self._splice_pipes[direction][1]
+        src=self._splice_src[direction]
+        shaper=self.proxy.shaper
+        while not self._splice_eof[direction] and self._splice_bytes[direction] < SpliceSession.PIPE_SIZE and \
+              not self._splice_throttled(direction):
+            try:
+                n=os.splice(src,pipe_w,SpliceSession.PIPE_SIZE-self._splice_bytes[direction],
+                            flags=os.SPLICE_F_MOVE|os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                break
+            except OSError:
+                self._splice_close()
+                return False
+            if n == 0:
+                self._splice_eof[direction]=True
+                break
+            self._splice_bytes[direction]+=n
+            if direction == maproxy.hooks.C2S:
+                self.c2s_bytes+=n
+                self.c2s_chunks+=1
+            else:
+                self.s2c_bytes+=n
+                self.s2c_chunks+=1
+                if self.s2c_chunks == 1:
+                    self._observe_first_byte()
+            if self.timeout_timer is not None:
+                self.last_activity=self.proxy.timer_wheel.now
+            if shaper is not None and shaper.consume(self,direction,n):
+                if direction == maproxy.hooks.C2S:
+                    self.c2p_read_throttled=True
+                else:
+                    self.p2s_read_throttled=True
+        return self._splice_flush(direction)
+
+    def _splice_throttled(self,direction):
+        return self.c2p_read_throttled if direction == maproxy.hooks.C2S else self.p2s_read_throttled
+
+    def resume_shaped_read(self,direction):
+        if self.splice_state is None:
+            super(SpliceSession,self).resume_shaped_read(direction)
+            return
+        if direction == maproxy.hooks.C2S:
+            self.c2p_read_throttled=False
+        else:
+            self.p2s_read_throttled=False
+        self._splice_update()
+
+    def _splice_flush(self,direction):
+        """
+        Move data from the pipe to the destination socket
+        Returns False if the session was closed
+        """
+        pipe_r=self._splice_pipes[direction][0]
+        dst=self._splice_dst[direction]
+        while self._splice_bytes[direction]:
+            try:
+                n=os.splice(pipe_r,dst,self._splice_bytes[direction],flags=os.SPLICE_F_MOVE|os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                break
+            except OSError:
+                self._splice_close()
+                return False
+            self._splice_bytes[direction]-=n
+        if self._splice_eof[direction] and not self._splice_bytes[direction]:
+            # The source was closed and all its data was sent: close the session
+            self._splice_close()
+            return False
+        return True
+
+    def _splice_update(self):
+        """
+        Update the events that we wait for: read from a socket if its pipe is not full,
+        write to a socket if its (incoming) pipe is not empty
+        """
+        if self.splice_state != SpliceSession.SpliceState.ACTIVE:
+            return
+        for direction in (maproxy.hooks.C2S,maproxy.hooks.S2C):
+            if self._splice_eof[direction] and not self._splice_bytes[direction]:
+                self._splice_close()
+                return
+        for fd in self._splice_events:
+            direction=maproxy.hooks.C2S if fd == self._splice_src[maproxy.hooks.C2S] else maproxy.hooks.S2C
+            events=0
+            if not self._splice_eof[direction] and self._splice_bytes[direction] < SpliceSession.PIPE_SIZE and \
+               not self._splice_throttled(direction):
+                events|=tornado.ioloop.IOLoop.READ
+            if self._splice_bytes[SpliceSession.OPPOSITE[direction]]:
+                events|=tornado.ioloop.IOLoop.WRITE
+            if events != self._splice_events[fd]:
+                self._splice_events[fd]=events
+                self._ioloop.update_handler(fd,events)
+
+    def _splice_close(self):
+        if self.splice_state != SpliceSession.SpliceState.ACTIVE:
+            return
+        self.splice_state=None
+        for fd in self._splice_events:
+            self._ioloop.remove_handler(fd)
+        for pipe_r,pipe_w in self._splice_pipes.values():
+            os.close(pipe_r)
+            os.close(pipe_w)
+        self.c2p_socket.close()
+        self.p2s_socket.close()
+        self.c2p_state=self.p2s_state=maproxy.session.Session.State.CLOSED
+        self.remove_session()
+
+    def reset(self):
+        super(SpliceSession,self).reset()
+        self.c2p_socket=None
+        self.p2s_socket=None
+        self._ioloop=None
+        self._splice_pipes=None
+        self._splice_events=None
+
+
+class SpliceSessionFactory(maproxy.session.SessionFactory):
+    """
+    Session-factory that creates SpliceSession objects (zero-copy TCP->TCP proxy)
+    """
+    session_class=SpliceSession
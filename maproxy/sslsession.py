@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import ssl
+import time
+import tornado.iostream
+
+
+
+class SSLSessionCache(object):
+    """
+    TLS-session cache of a backend (Proxy->Server SSL connections).
+    We keep the last TLS session that we got from the backend, and use it for the next connection
+    so the backend can resume the session (abbreviated handshake) instead of a full handshake.
+    """
+    def __init__(self):
+        self.session=None
+        # Counters
+        self.hits=0         # Number of handshakes that resumed a session
+        self.misses=0       # Number of full handshakes
+
+    def handshake_done(self,sslsocket):
+        if getattr(sslsocket,"session_reused",False):
+            self.hits+=1
+        else:
+            self.misses+=1
+        self.store(sslsocket)
+
+    def store(self,sslsocket):
+        session=getattr(sslsocket,"session",None)
+        if session is not None:
+            self.session=session
+
+
+class ResumingSSLIOStream(tornado.iostream.SSLIOStream):
+    """
+    SSLIOStream (client side) that resumes the TLS sessions that are kept in a SSLSessionCache
+    NOTE: Tornado does not let us pass the session to wrap_socket, but the session can be set on the SSL
+          socket until the handshake starts. So we hook Tornado's (internal) connect/handshake completion.
+    The stream also measures the handshake (ssl_handshake_time, in seconds, once the handshake is done)
+    """
+    def __init__(self,*args,**kwargs):
+        self.session_cache=kwargs.pop("session_cache")
+        self.ssl_handshake_time=None
+        self._ssl_handshake_start=None
+        super(ResumingSSLIOStream,self).__init__(*args,**kwargs)
+
+    def _handle_connect(self):
+        # The TCP connection is established, and the socket was just wrapped (the handshake did not start yet)
+        self._ssl_handshake_start=time.time()
+        super(ResumingSSLIOStream,self)._handle_connect()
+        if self.closed() or self.session_cache.session is None:
+            return
+        try:
+            self.socket.session=self.session_cache.session
+        except (AttributeError,ValueError,ssl.SSLError):
+            # Python without session support, or the session does not fit the context anymore
+            self.session_cache.session=None
+
+    def _run_ssl_connect_callback(self):
+        # The handshake is done
+        if self._ssl_handshake_start is not None:
+            self.ssl_handshake_time=time.time()-self._ssl_handshake_start
+        self.session_cache.handshake_done(self.socket)
+        super(ResumingSSLIOStream,self)._run_ssl_connect_callback()
+
+    def close_fd(self):
+        # With TLS 1.3 the session tickets are sent after the handshake, so keep the latest session
+        if isinstance(self.socket,ssl.SSLSocket) and not self._ssl_accepting:
+            self.session_cache.store(self.socket)
+        super(ResumingSSLIOStream,self).close_fd()
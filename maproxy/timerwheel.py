@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import time
+import math
+import tornado.ioloop
+
+
+
+class Timer(object):
+    """
+    A timer in the TimerWheel (returned by TimerWheel.add , and can be passed to TimerWheel.cancel)
+    """
+    __slots__=("deadline","callback","rounds","slot")
+
+
+class TimerWheel(object):
+    """
+    Hashed timer-wheel: many coarse timers (e.g. a timeout per session) for the cost of a single periodic
+    IOLoop callback.
+    The wheel has "size" slots, each slot is "tick" seconds. A timer is added to the slot of its deadline
+    (adding/cancelling a timer is O(1)) . Every tick we move to the next slot and fire its timers (timers that
+    are more than one revolution away wait for their "rounds").
+    The periodic callback runs only while there are timers in the wheel.
+    """
+    def __init__(self,tick=1.0,size=512):
+        self.tick=tick
+        self._slots=[set() for i in range(size)]
+        self._position=0
+        self._count=0
+        self._periodic_callback=None
+        self.now=time.time()        # Updated every tick (a cheap "current time" for the callers)
+
+    def __len__(self):
+        return self._count
+
+    def add(self,deadline,callback):
+        """
+        Call callback() at "deadline" (a time.time() value. the precision is one tick)
+        """
+        if self._periodic_callback is None:
+            self.now=time.time()
+        ticks=max(1,int(math.ceil((deadline-self.now)/self.tick)))
+        timer=Timer()
+        timer.deadline=deadline
+        timer.callback=callback
+        timer.rounds=(ticks-1)//len(self._slots)
+        timer.slot=self._slots[(self._position+ticks) % len(self._slots)]
+        timer.slot.add(timer)
+        self._count+=1
+        if self._periodic_callback is None:
+            self._periodic_callback=tornado.ioloop.PeriodicCallback(self._on_tick,self.tick*1000)
+            self._periodic_callback.start()
+        return timer
+
+    def cancel(self,timer):
+        if timer.slot is None:
+            return  # Already fired (or cancelled)
+        timer.slot.discard(timer)
+        timer.slot=None
+        self._count-=1
+        if self._count == 0:
+            self._stop()
+
+    def _stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback=None
+
+    def _on_tick(self):
+        self.now=time.time()
+        self._position=(self._position+1) % len(self._slots)
+        slot=self._slots[self._position]
+        expired=[]
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds-=1
+            else:
+                expired.append(timer)
+        for timer in expired:
+            slot.discard(timer)
+            timer.slot=None
+        self._count-=len(expired)
+        for timer in expired:
+            timer.callback()
+        if self._count == 0:
+            self._stop()
@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+
+import errno
+import socket
+import struct
+import logging
+import functools
+import collections
+import tornado.ioloop
+import tornado.iostream
+import maproxy.proxyserver
+import maproxy.session
+import maproxy.connector
+
+
+
+# Frame types
+OPEN,DATA,WINDOW,CLOSE,RESET=range(1,6)
+
+# Frame header: type , stream-id , payload length
+HEADER=struct.Struct("!BII")
+WINDOW_UPDATE=struct.Struct("!I")
+
+
+class Tunnel(object):
+    """
+    One physical connection (a Tornado IOStream , plain or SSL) between two maproxy instances, that carries the
+    streams (TunnelStream) of many sessions. Every stream is a sequence of frames:
+        OPEN    : a new stream (sent by the near side , TunnelProxyServer)
+        DATA    : the stream's data (up to MAX_FRAME bytes)
+        WINDOW  : the receiver has consumed data: the sender may send this number of bytes more
+        CLOSE   : the stream was closed (after all its data)
+        RESET   : the stream was aborted (its unsent data was dropped)
+    Flow control is per stream: a sender never has more than the receiver's window (WINDOW bytes, or more if the
+    receiver grants it) unconsumed, so a slow session never stops the other sessions' streams (the tunnel is always
+    read) and the memory of each stream is bounded.
+    The stream-ids are never reused: once they're used up the tunnel opens no more streams (exhausted) , and it's
+    closed when its last stream is closed (TunnelGroup connects a new tunnel in the meantime)
+    """
+    # The last stream-id (a 32 bits field of the header)
+    MAX_STREAM_ID=0xffffffff
+    # Maximum payload of a frame
+    MAX_FRAME=65536
+    # The initial window of every stream (both directions)
+    WINDOW=262144
+
+    def __init__(self,stream,window=WINDOW,on_open=None,on_close=None):
+        """
+        Input Parameters:
+            stream      : the physical (connected) IOStream
+            window      : the receive window of our streams (at least Tunnel.WINDOW)
+            on_open     : on_open(tunnel_stream) is called when the other side opens a stream (the far side)
+            on_close    : on_close(tunnel) is called when the physical connection is closed
+        """
+        assert window >= Tunnel.WINDOW , "The window must be at least %d" % Tunnel.WINDOW
+        self.stream=stream
+        self.window=window
+        self.on_open=on_open
+        self.on_close=on_close
+        self.streams={}             # stream-id->TunnelStream
+        self.closed=False
+        self._next_id=1
+        self._buffer=bytearray()
+        stream.set_close_callback(self._on_close)
+        stream.set_nodelay(True)
+        try:
+            stream.socket.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        except (AttributeError,OSError,socket.error):
+            pass
+        self._read()
+
+    def open_stream(self):
+        """
+        Open a new stream (the near side) . The data can be written immediately (the far side connects to
+        the target in the meantime)
+        """
+        assert not self.exhausted() , "The tunnel's stream-ids are used up"
+        stream_id=self._next_id
+        self._next_id+=1
+        self.send_frame(OPEN,stream_id)
+        stream=self.streams[stream_id]=TunnelStream(self,stream_id)
+        return stream
+
+    def exhausted(self):
+        """
+        True if the tunnel can't open more streams (all the stream-ids were used)
+        """
+        return self._next_id > Tunnel.MAX_STREAM_ID
+
+    def close(self):
+        self.stream.close()
+
+    def remove_stream(self,stream_id):
+        """
+        Called when the stream is closed (by either side) . The last stream closes an exhausted tunnel
+        """
+        if self.streams.pop(stream_id,None) is not None and not self.streams and self.exhausted():
+            self.close()
+
+    def send_frame(self,type,stream_id,payload=b""):
+        if self.closed:
+            return
+        try:
+            self.stream.write(b"".join((HEADER.pack(type,stream_id,len(payload)),payload)))
+        except tornado.iostream.StreamClosedError:
+            pass    # We'll get _on_close
+
+    ############
+    ## Frames ##
+    ############
+    def _read(self):
+        try:
+            self.stream.read_bytes(self.stream.read_chunk_size,self._on_read,partial=True)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def _on_read(self,data):
+        buffer=self._buffer
+        buffer+=data
+        pos=0
+        size=len(buffer)
+        while size-pos >= HEADER.size:
+            type,stream_id,length=HEADER.unpack_from(buffer,pos)
+            if length > Tunnel.MAX_FRAME:
+                self._protocol_error("frame too long (%d bytes)" % length)
+                return
+            if size-pos-HEADER.size < length:
+                break
+            payload=bytes(buffer[pos+HEADER.size:pos+HEADER.size+length])
+            pos+=HEADER.size+length
+            self._on_frame(type,stream_id,payload)
+            if self.closed:
+                return
+        del buffer[:pos]
+        self._read()
+
+    def _on_frame(self,type,stream_id,payload):
+        stream=self.streams.get(stream_id)
+        if type == DATA:
+            # Frames of a stream that we already closed are dropped
+            if stream is not None:
+                stream._on_data(payload)
+        elif type == WINDOW:
+            if stream is not None and len(payload) == WINDOW_UPDATE.size:
+                stream._on_window(WINDOW_UPDATE.unpack(payload)[0])
+        elif type == CLOSE or type == RESET:
+            if stream is not None:
+                self.remove_stream(stream_id)
+                stream._on_remote_close(type == RESET)
+        elif type == OPEN:
+            if self.on_open is None or stream is not None:
+                self._protocol_error("unexpected OPEN (stream %d)" % stream_id)
+                return
+            stream=self.streams[stream_id]=TunnelStream(self,stream_id)
+            self.on_open(stream)
+        else:
+            self._protocol_error("unknown frame type %d" % type)
+
+    def _protocol_error(self,message):
+        logging.warning("maproxy: tunnel protocol error: %s , closing the tunnel",message)
+        self.stream.close()
+
+    def _on_close(self):
+        self.closed=True
+        streams=list(self.streams.values())
+        self.streams.clear()
+        for stream in streams:
+            stream._on_remote_close(True)
+        if self.on_close is not None:
+            self.on_close(self)
+
+
+class TunnelStream(object):
+    """
+    A stream of a Tunnel . The sessions use it like a Tornado IOStream (read_bytes , write , close ,
+    set_close_callback) . The callbacks are called on the next IOLoop iteration (like Tornado's)
+    """
+    read_chunk_size=65536
+    socket=None
+
+    def __init__(self,tunnel,stream_id):
+        self.tunnel=tunnel
+        self.stream_id=stream_id
+        self.error=None
+        self._closed=False              # We closed the stream
+        self._remote_closed=False       # The other side closed the stream (we may still have data to deliver)
+        self._close_callback=None
+        self._close_done=False
+        self._reset=False               # close() sends a RESET (instead of a CLOSE)
+        # Receive
+        self._recv=collections.deque()
+        self._recv_size=0
+        self._read_callback=None
+        self._read_size=0
+        self._delivering=False
+        self._unacked=0                 # Bytes that we consumed and didn't report (WINDOW) yet
+        # Send
+        self._send=collections.deque()
+        self._send_offset=0             # How much of the first item of _send was sent
+        self._send_window=Tunnel.WINDOW
+        self._write_callback=None
+        if tunnel.window > Tunnel.WINDOW:
+            tunnel.send_frame(WINDOW,stream_id,WINDOW_UPDATE.pack(tunnel.window-Tunnel.WINDOW))
+
+    def closed(self):
+        return self._closed or self._remote_closed
+
+    def set_nodelay(self,value):
+        pass
+
+    def set_close_callback(self,callback):
+        self._close_callback=callback
+
+    ##########
+    ## Read ##
+    ##########
+    def read_bytes(self,num_bytes,callback,partial=False):
+        """
+        callback(data) with up to num_bytes bytes (only partial reads are supported)
+        """
+        assert self._read_callback is None , "Already reading"
+        if self._closed or (self._remote_closed and not self._recv):
+            raise tornado.iostream.StreamClosedError(real_error=self.error)
+        self._read_callback=callback
+        self._read_size=num_bytes
+        self._schedule_delivery()
+
+    def _on_data(self,payload):
+        if self._closed:
+            return
+        self._recv.append(payload)
+        self._recv_size+=len(payload)
+        if self._recv_size > self.tunnel.window:
+            logging.warning("maproxy: tunnel stream %d exceeded its window",self.stream_id)
+            self._abort(errno.EPROTO)
+            return
+        self._schedule_delivery()
+
+    def _schedule_delivery(self):
+        if self._read_callback is not None and self._recv and not self._delivering:
+            self._delivering=True
+            tornado.ioloop.IOLoop.current().add_callback(self._deliver)
+
+    def _deliver(self):
+        self._delivering=False
+        callback=self._read_callback
+        if callback is None or not self._recv:
+            return
+        recv=self._recv
+        size=self._read_size
+        if len(recv[0]) >= size:
+            data=recv.popleft()
+            if len(data) > size:
+                recv.appendleft(data[size:])
+                data=data[:size]
+        else:
+            chunks=[]
+            n=0
+            while recv and n+len(recv[0]) <= size:
+                chunks.append(recv.popleft())
+                n+=len(chunks[-1])
+            data=b"".join(chunks)
+        self._recv_size-=len(data)
+        self._read_callback=None
+        # Let the sender send more
+        self._unacked+=len(data)
+        if not self.closed() and self._unacked >= self.tunnel.window//2:
+            self.tunnel.send_frame(WINDOW,self.stream_id,WINDOW_UPDATE.pack(self._unacked))
+            self._unacked=0
+        callback(data)
+        self._maybe_run_close_callback()
+
+    ###########
+    ## Write ##
+    ###########
+    def write(self,data,callback=None):
+        """
+        Send data (callback() when all the data was passed to the tunnel: the window may delay it)
+        """
+        if self.closed():
+            raise tornado.iostream.StreamClosedError(real_error=self.error)
+        if data:
+            self._send.append(data)
+        self._write_callback=callback
+        self._flush()
+
+    def _on_window(self,size):
+        self._send_window+=size
+        self._flush()
+
+    def _flush(self):
+        send=self._send
+        while send and self._send_window > 0:
+            data=send[0]
+            n=min(len(data)-self._send_offset,self._send_window,Tunnel.MAX_FRAME)
+            if n == len(data):
+                payload=data
+            else:
+                payload=memoryview(data)[self._send_offset:self._send_offset+n]
+            self.tunnel.send_frame(DATA,self.stream_id,payload)
+            self._send_window-=n
+            self._send_offset+=n
+            if self._send_offset == len(data):
+                send.popleft()
+                self._send_offset=0
+        if not send and self._write_callback is not None:
+            callback,self._write_callback=self._write_callback,None
+            tornado.ioloop.IOLoop.current().add_callback(callback)
+
+    ###########
+    ## Close ##
+    ###########
+    def close(self):
+        """
+        Close the stream (the unsent data is dropped: then the other side gets a RESET instead of a CLOSE)
+        """
+        if self._closed:
+            return
+        self._closed=True
+        if not self._remote_closed:
+            self.tunnel.send_frame(RESET if self._reset or self._send else CLOSE,self.stream_id)
+            self.tunnel.remove_stream(self.stream_id)
+        self._release()
+        self._maybe_run_close_callback()
+
+    def set_reset_on_close(self):
+        """
+        close() sends a RESET: the other side gets a connection-reset (like SO_LINGER with a zero timeout ,
+        see maproxy.admission.reset_on_close)
+        """
+        self._reset=True
+
+    def reset(self):
+        """
+        Abort the stream (the other side gets a RESET)
+        """
+        self._reset=True
+        self.close()
+
+    def _abort(self,error):
+        self.error=OSError(error,"Tunnel stream aborted")
+        self.reset()
+
+    def _on_remote_close(self,reset):
+        self._remote_closed=True
+        if reset:
+            self.error=OSError(errno.ECONNRESET,"Tunnel stream reset")
+            self._recv.clear()
+            self._recv_size=0
+        self._send.clear()
+        self._write_callback=None
+        self._maybe_run_close_callback()
+
+    def _release(self):
+        self._recv.clear()
+        self._recv_size=0
+        self._send.clear()
+        self._read_callback=None
+        self._write_callback=None
+
+    def _maybe_run_close_callback(self):
+        """
+        The close-callback is called once the stream is closed and all its data was delivered
+        """
+        if self._close_done or self._recv or not self.closed():
+            return
+        self._close_done=True
+        self._read_callback=None
+        tornado.ioloop.IOLoop.current().add_callback(self._run_close_callback)
+
+    def _run_close_callback(self):
+        callback,self._close_callback=self._close_callback,None
+        if callback is not None:
+            callback()
+
+
+class TunnelGroup(object):
+    """
+    The tunnels (physical connections) of a TunnelProxyServer to one backend (a TunnelServer) . The streams are
+    opened on the tunnel with the fewest streams. The tunnels are connected when they're needed (up to "size"),
+    and reconnected after they're closed. An exhausted tunnel (see Tunnel) isn't counted: it only serves its
+    open streams until it's closed
+    """
+    def __init__(self,proxy,backend,size,window):
+        self.proxy=proxy
+        self.backend=backend
+        self.size=size
+        self.window=window
+        self.tunnels=[]
+        self._connecting=0
+        self._pending=collections.deque()       # TunnelOpen requests that wait for a tunnel
+
+    def open(self,callback):
+        request=TunnelOpen(self,callback)
+        tunnels=self._usable()
+        if len(tunnels)+self._connecting < self.size and \
+           (not tunnels or min(len(tunnel.streams) for tunnel in tunnels)):
+            self._connect()
+        if tunnels:
+            tornado.ioloop.IOLoop.current().add_callback(request.finish)
+        else:
+            self._pending.append(request)
+        return request
+
+    def select(self):
+        """
+        The tunnel with the fewest streams (or None)
+        """
+        tunnels=self._usable()
+        if not tunnels:
+            return None
+        return min(tunnels,key=lambda tunnel: len(tunnel.streams))
+
+    def close(self):
+        for tunnel in list(self.tunnels):
+            tunnel.close()
+
+    def _usable(self):
+        return [tunnel for tunnel in self.tunnels if not tunnel.exhausted()]
+
+    def _connect(self):
+        self._connecting+=1
+        maproxy.connector.Connector(self.proxy,self.backend,self._on_connected,self.proxy.connect_timeout).start()
+
+    def _on_connected(self,stream):
+        self._connecting-=1
+        if stream is None:
+            if not self._usable() and not self._connecting:
+                # No tunnel: the sessions that wait fail to connect (they may retry)
+                pending,self._pending=self._pending,collections.deque()
+                for request in pending:
+                    request.finish()
+            return
+        self.tunnels.append(Tunnel(stream,self.window,on_close=self._on_tunnel_closed))
+        pending,self._pending=self._pending,collections.deque()
+        for request in pending:
+            request.finish()
+
+    def _on_tunnel_closed(self,tunnel):
+        self.tunnels.remove(tunnel)
+
+
+class TunnelOpen(object):
+    """
+    A session's request for a stream (returned by TunnelProxyServer.connect , like a Connector: close() cancels it)
+    """
+    def __init__(self,group,callback):
+        self.group=group
+        self.callback=callback
+
+    def close(self):
+        self.callback=None
+
+    def finish(self):
+        callback,self.callback=self.callback,None
+        if callback is None:
+            return
+        tunnel=self.group.select()
+        stream=None
+        if tunnel is not None:
+            try:
+                stream=tunnel.open_stream()
+            except Exception:
+                # The session fails to connect (it may retry)
+                logging.exception("maproxy: failed to open a tunnel stream")
+        callback(stream)
+
+
+class TunnelProxyServer(maproxy.proxyserver.ProxyServer):
+    """
+    The near side of a maproxy-to-maproxy tunnel. The sessions' Proxy->Server connections are streams of a few
+    long-lived connections (tunnels) to the backends, which are the far side's TunnelServer(s) . A new session
+    doesn't connect (nor do an SSL handshake): it opens a stream on a connected tunnel and sends its data right
+    away (the far side connects to the target in the meantime)
+    Same parameters as ProxyServer (server_ssl_options encrypts the tunnels) , and:
+        tunnel_connections  : maximum number of tunnels per backend
+        tunnel_window       : the receive window of each stream (see Tunnel)
+    NOTE: the Tornado engine only (not the asyncio engine) , connection_pool is not supported , the splice
+          session can't splice the streams (it falls back to the regular Session) , and the health-checker's
+          probes open (and close) a stream: they check the tunnel , not the far side's targets
+    """
+    def __init__(self,*args,**kwargs):
+        self.tunnel_connections=kwargs.pop("tunnel_connections",2)
+        self.tunnel_window=kwargs.pop("tunnel_window",Tunnel.WINDOW)
+        super(TunnelProxyServer,self).__init__(*args,**kwargs)
+        assert self.connection_pool is None , "connection_pool is not supported by TunnelProxyServer"
+        self.tunnel_groups={}       # backend->TunnelGroup
+
+    def connect(self,backend,callback):
+        group=self.tunnel_groups.get(backend)
+        if group is None:
+            group=self.tunnel_groups[backend]=TunnelGroup(self,backend,self.tunnel_connections,self.tunnel_window)
+        return group.open(callback)
+
+    def close_tunnels(self):
+        """
+        Close all the tunnels (and their sessions)
+        """
+        for group in self.tunnel_groups.values():
+            group.close()
+
+
+class TunnelSession(maproxy.session.Session):
+    """
+    The session of a TunnelServer: the client's stream is a TunnelStream
+    """
+    __slots__=()
+
+    def _init_c2p_stream(self):
+        self.c2p_stream.set_close_callback(self.on_c2p_close)
+
+
+class TunnelSessionFactory(maproxy.session.SessionFactory):
+    session_class=TunnelSession
+
+
+class TunnelServer(maproxy.proxyserver.ProxyServer):
+    """
+    The far side of a maproxy-to-maproxy tunnel: accepts the tunnels of TunnelProxyServer(s) (client_ssl_options
+    decrypts them) and connects every stream to the target (the backends) , as a session.
+    The sessions' c2p_address is the address of the tunnel (the near side proxy)
+    Same parameters as ProxyServer , and:
+        tunnel_window       : the receive window of each stream (see Tunnel)
+    """
+    def __init__(self,*args,**kwargs):
+        self.tunnel_window=kwargs.pop("tunnel_window",Tunnel.WINDOW)
+        kwargs.setdefault("session_factory",TunnelSessionFactory())
+        super(TunnelServer,self).__init__(*args,**kwargs)
+        assert issubclass(self.session_factory.session_class,TunnelSession) , \
+               "TunnelServer requires a TunnelSessionFactory"
+        self.tunnels=set()
+
+    def handle_stream(self,stream,address):
+        """
+        A new tunnel
+        """
+        tunnel=Tunnel(stream,self.tunnel_window,on_open=functools.partial(self._on_tunnel_stream,address),
+                      on_close=self.tunnels.discard)
+        self.tunnels.add(tunnel)
+
+    def _on_tunnel_stream(self,address,stream):
+        if self.admission is not None and not self.admission.admit(stream,address):
+            return
+        self.start_session(stream,address)
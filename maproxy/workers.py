@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import os
+import errno
+import signal
+import threading
+import logging
+import traceback
+import multiprocessing
+import multiprocessing.sharedctypes
+
+
+
+class WorkerPool(object):
+    """
+    Multi-process mode of the IOManager.
+    The WorkerPool forks N worker processes, each worker runs all the IOManager's servers on its own IOLoop.
+    The parent process does not handle connections, it only supervises the workers:
+    - restarts workers that crashed (killed by a signal, or exited with non-zero exit code)
+    - collects the connections-count of all the workers (each worker publishes its count in shared memory)
+    - stops the workers (SIGTERM) when the IOManager is stopped
+
+    The listeners are shared by the workers in one of two ways:
+    - reuse_port=False: the sockets that were bound (server.bind(...)) in the parent are inherited by the workers
+    - reuse_port=True : each worker binds its own sockets (same addresses) with SO_REUSEPORT, so the kernel
+                        balances the incoming connections between the workers
+    NOTE: servers must be bound with server.bind() (NOT server.listen()) before the IOManager is started
+    """
+    # How often (seconds) each worker publishes its connections-count
+    PUBLISH_INTERVAL=1.0
+
+    def __init__(self,iomanager,workers,reuse_port=False,max_restarts=100):
+        """
+        Input Parameters:
+            iomanager       : the IOManager
+            workers         : number of worker processes. 0 or None means "one worker per CPU"
+            reuse_port      : bind a socket per worker with SO_REUSEPORT (instead of sharing the parent's sockets)
+            max_restarts    : maximum number of times the workers are restarted (all together) after a crash
+        """
+        assert hasattr(os,"fork") , "Worker processes are not supported on this platform"
+        if not workers:
+            workers=multiprocessing.cpu_count()
+        self.iomanager=iomanager
+        self.workers=workers
+        self.reuse_port=reuse_port
+        self.max_restarts=max_restarts
+        self.restarts=0
+
+        self._pids={}               # pid->worker-id
+        self._stopping=False
+        self._supervisor_thread=None
+
+        # Shared memory (created before the fork, so all the workers share it):
+        # connections-count per worker , and how to stop (-1: not gracefully, 0: wait forever, >0: timeout)
+        self._connections=multiprocessing.sharedctypes.RawArray('l',workers)
+        self._stop_timeout=multiprocessing.sharedctypes.RawValue('d',-1)
+
+        # Listeners that each worker binds for itself (reuse_port mode): server->[(port,address,family),...]
+        self._listeners={}
+
+    def get_connections_count(self):
+        """
+        Total number of connections (all the workers)
+        """
+        return sum(self._connections)
+
+    def is_alive(self):
+        return bool(self._pids)
+
+    def start(self,thread=True):
+        """
+        Fork the workers and supervise them.
+            thread = True : supervise from a new thread (this call returns immediately)
+            thread = False: supervise from this thread (blocking call, returns when all the workers exited)
+        This function never returns in the worker processes.
+        """
+        for server in self.iomanager._servers.values():
+            # TCPServer.listen() registers the sockets in the (parent's) IOLoop, we need bind()
+            assert not server._sockets , "Worker processes require server.bind() instead of server.listen()"
+            if self.reuse_port:
+                # Remember the addresses and close the parent's sockets, each worker will bind its own
+                listeners=[]
+                for sock in server._pending_sockets:
+                    sockname=sock.getsockname()
+                    listeners.append((sockname[1],sockname[0],sock.family))
+                    sock.close()
+                server._pending_sockets=[]
+                self._listeners[server]=listeners
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        if thread:
+            self._supervisor_thread=threading.Thread(target=self._supervise)
+            self._supervisor_thread.start()
+        else:
+            self._supervise()
+
+    def stop(self,gracefully=False,wait=False):
+        """
+        Stop all the workers (the "gracefully" parameter has the same meaning as in IOManager.stop)
+        """
+        self._stopping=True
+        if gracefully is False or gracefully is None:
+            self._stop_timeout.value=-1
+        elif gracefully is True:
+            self._stop_timeout.value=0
+        else:
+            self._stop_timeout.value=max(gracefully,0.001)
+        for pid in list(self._pids):
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except OSError:
+                pass
+        if wait and self._supervisor_thread:
+            self._supervisor_thread.join()
+
+    #########################
+    ## Parent (supervisor) ##
+    #########################
+    def _spawn(self,worker_id):
+        self._connections[worker_id]=0
+        pid=os.fork()
+        if pid == 0:
+            # Worker process: run the IOLoop, and never return to the caller
+            exit_code=0
+            try:
+                self._run_worker(worker_id)
+            except:
+                traceback.print_exc()
+                exit_code=1
+            finally:
+                os._exit(exit_code)
+        self._pids[pid]=worker_id
+
+    def _supervise(self):
+        while self._pids:
+            try:
+                pid,status=os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            worker_id=self._pids.pop(pid,None)
+            if worker_id is None:
+                continue
+            self._connections[worker_id]=0
+            if self._stopping:
+                continue
+            if os.WIFSIGNALED(status):
+                logging.warning("worker %d (pid %d) killed by signal %d, restarting",worker_id,pid,os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status) != 0:
+                logging.warning("worker %d (pid %d) exited with status %d, restarting",worker_id,pid,os.WEXITSTATUS(status))
+            else:
+                # The worker exited on purpose
+                continue
+            self.restarts+=1
+            if self.restarts > self.max_restarts:
+                logging.error("Too many worker restarts (%d), giving up",self.restarts)
+                self.stop(gracefully=False)
+                continue
+            self._spawn(worker_id)
+        self._pids.clear()
+        self.iomanager._on_workers_stopped()
+
+    ############
+    ## Worker ##
+    ############
+    def _run_worker(self,worker_id):
+        # We don't want to handle the parent's signals the same way (e.g. the parent stops the workers
+        # with SIGTERM, and usually Ctrl-C is sent to the whole process-group)
+        signal.signal(signal.SIGINT,signal.SIG_IGN)
+        iomanager=self.iomanager
+
+        if self.reuse_port:
+            for server,listeners in self._listeners.items():
+                for port,address,family in listeners:
+                    server.bind(port,address,family,reuse_port=True)
+
+        def publish():
+            self._connections[worker_id]=iomanager.get_connections_count()
+
+        def on_sigterm(sig,frame):
+            timeout=self._stop_timeout.value
+            gracefully=False if timeout < 0 else (True if timeout == 0 else timeout)
+            iomanager.ioloop().add_callback_from_signal(iomanager.stop,gracefully=gracefully)
+        signal.signal(signal.SIGTERM,on_sigterm)
+
+        iomanager._start_worker(worker_id,publish,WorkerPool.PUBLISH_INTERVAL)
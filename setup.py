@@ -18,7 +18,7 @@ setup(name='maproxy',
     keywords = "TCP proxy ssl http https certificates",
     long_description=open('README.rst').read(),
 
-    install_requires=["tornado >= 3.2"],
+    install_requires=["tornado >= 4.0"],
 
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",